@@ -1,18 +1,37 @@
-from flask import Flask, render_template, request, send_from_directory, url_for, redirect, flash
+from flask import (Flask, render_template, request, send_from_directory, url_for, redirect, flash, abort,
+                   jsonify, Response, stream_with_context)
 import os
-import json
 import glob
 from datetime import datetime
-from models import db, Image, init_db
+from models import db, Image, Tag, TagCount, Job, DETAIL_COLUMNS, init_db, init_read_only_requests
 from config import Config
 import logging
-from tqdm import tqdm
-from sqlalchemy import func, or_
-from wand.image import Image as WandImage
-from multiprocessing import Pool, cpu_count
-from math import ceil
+import click
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from sqlalchemy import func
+from sqlalchemy.orm import undefer_group
 import warnings
 from settings import Settings
+from stats import image_count
+from cache import create_page_cache, cached_page, library_generation
+from neighbors import NeighborIndex
+from migrations import migrate, check_query_plans
+from tag_index import TagBitmapIndex
+from query import parse_query, compile_query, query_order, CompiledQuery, QueryError
+from autocomplete import TagCompleter
+from similar import SimilarityIndex, find_duplicate_groups
+from metrics import init_metrics, render_metrics
+from jobs import JobRunner, job_info
+from watcher import LibraryWatcher
+from sprites import SpriteService, SPRITE_KEY
+from ingest import load_images_from_json
+from media import (storage_mode, originals_dir, link_images, resolve_original, send_immutable,
+                   MD5_PATTERN)
+from thumbnails import (update_thumbnails, ThumbnailService, thumbnail_sizes, thumbnail_formats,
+                        variant_filename, thumbnail_settings_hash)
+from pagination import keyset_paginate, listing_query, listing_rows, InvalidCursor, SORT_COLUMNS
+from export import parse_fields, post_dict, iter_posts, ndjson
+from tags import TAG_CATEGORIES, normalize_tag, rebuild_tag_index, rebuild_tag_counts, top_tags
 
 # Configure logging
 logging.basicConfig(
@@ -24,214 +43,60 @@ logger = logging.getLogger(__name__)
 # Load settings
 settings = Settings()
 
-def generate_single_thumbnail(args):
-    """Generate a single thumbnail using ImageMagick."""
-    source_path, thumb_path, width = args
-    try:
-        with WandImage(filename=source_path) as img:
-            # Strip metadata to reduce size
-            img.strip()
-            
-            # Calculate height maintaining aspect ratio
-            ratio = width / img.width
-            height = int(img.height * ratio)
-            
-            # Resize using high-quality Lanczos filter
-            img.resize(width, height, filter='lanczos2')
-            
-            # Set compression quality
-            img.compression_quality = settings.get('thumbnails', 'quality')
-            
-            # Optimize output format based on original
-            if thumb_path.lower().endswith('.png'):
-                img.format = 'png'
-                img.options['png:compression-level'] = str(settings.get('thumbnails', 'compression_level'))
-            else:
-                img.format = 'jpeg'
-            
-            img.save(filename=thumb_path)
-            return True
-    except Exception as e:
-        logger.error(f"Error generating thumbnail for {source_path}: {str(e)}")
-        return False
-
 def setup_image_paths(app):
     """Setup image directories and process images/thumbnails."""
-    images_dir = os.path.join(app.static_folder, settings.get('paths', 'images_folder'))
-    thumbnails_dir = os.path.join(app.static_folder, settings.get('paths', 'thumbnails_folder'))
+    images_dir = originals_dir(app.static_folder)
+    thumbnails_dir = os.path.join(app.static_folder, settings.get('paths', 'thumbnails_folder', default='thumbnails'))
     
     # Create directories if they don't exist
     os.makedirs(images_dir, exist_ok=True)
     os.makedirs(thumbnails_dir, exist_ok=True)
+
+    # On-demand thumbnail generation for serve_thumbnail
+    app.extensions['thumbnails'] = ThumbnailService(
+        app, images_dir, thumbnails_dir,
+        max_workers=settings.get('thumbnails', 'workers', default=2)
+    )
     
-    # Flag files to track processing status
-    flag_file = os.path.join(images_dir, '.images_copied')
-    thumbnail_flag = os.path.join(thumbnails_dir, '.thumbnails_generated')
-    
-    def process_images():
-        """Copy images and generate thumbnails if needed."""
-        if not os.path.exists(flag_file):
-            logger.info("Copying images to static directory...")
-            copy_images(images_dir)
-            
-        if not os.path.exists(thumbnail_flag):
-            logger.info("Generating thumbnails...")
+    def process_images(prewarm=False, progress=None):
+        """Link new originals into place and bring thumbnails up to date.
+
+        With ``prewarm`` the thumbnails are filled in one at a time at low
+        priority instead of with a process pool.
+        """
+        mode = storage_mode()
+        if mode != 'direct':
+            logger.info(f"Adding new images to static directory ({mode})...")
+            link_images(settings.get('paths', 'source_images'), images_dir, mode)
             
-            # Get list of images that need thumbnails
-            image_files = []
-            for filename in os.listdir(images_dir):
-                if any(filename.endswith(ext) for ext in ['.jpg', '.png', '.gif', '.jpeg']):
-                    thumb_path = os.path.join(thumbnails_dir, filename)
-                    if not os.path.exists(thumb_path):
-                        source_path = os.path.join(images_dir, filename)
-                        image_files.append((source_path, thumb_path, settings.get('thumbnails', 'width')))
-
-            if image_files:
-                # Use configured percentage of CPU cores
-                num_processes = ceil(cpu_count() * (settings.get('processing', 'cpu_usage_percent') / 100))
-                logger.info(f"Starting thumbnail generation with {num_processes} processes")
-                
-                with Pool(processes=num_processes) as pool:
-                    results = list(tqdm(
-                        pool.imap_unordered(generate_single_thumbnail, image_files),
-                        total=len(image_files),
-                        desc="Generating thumbnails"
-                    ))
-                    
-                    successful = sum(1 for r in results if r)
-                    logger.info(f"Successfully generated {successful} thumbnails")
-
-            # Create flag file
-            with open(thumbnail_flag, 'w') as f:
-                f.write(f"Thumbnails generated on {datetime.now()}")
+        logger.info("Checking thumbnails...")
+        if prewarm:
+            app.extensions['thumbnails'].prewarm(progress=progress)
+        else:
+            update_thumbnails(images_dir, thumbnails_dir, progress=progress)
     
     return process_images
 
-def copy_images(images_dir):
-    """Copy images from source directory to static folder."""
-    source_dir = settings.get('paths', 'source_images')
-    
-    # Count total files to copy
-    total_files = len([f for f in os.listdir(source_dir) 
-                      if any(f.endswith(ext) for ext in ['.jpg', '.png', '.gif', '.jpeg'])])
-    
-    if total_files == 0:
-        logger.warning("No image files found in source directory")
-        return
-    
-    # Copy files with progress bar
-    copied = 0
-    for filename in tqdm(os.listdir(source_dir), total=total_files, desc="Copying images"):
-        if any(filename.endswith(ext) for ext in ['.jpg', '.png', '.gif', '.jpeg']):
-            src_path = os.path.join(source_dir, filename)
-            dst_path = os.path.join(images_dir, filename)
-            
-            if not os.path.exists(dst_path):
-                try:
-                    os.copy2(src_path, dst_path)
-                    copied += 1
-                    if copied % 1000 == 0:
-                        logger.info(f"Copied {copied}/{total_files} images")
-                except Exception as e:
-                    logger.error(f"Error copying {filename}: {str(e)}")
-
-def load_images_from_json(path):
-    """Load image data from JSON files into database."""
-    batch_size = settings.get('processing', 'batch_size')
-    processed = 0
-    json_files = [f for f in os.listdir(path) if f.endswith('.json')]
-    
-    for i in tqdm(range(0, len(json_files), batch_size)):
-        batch_files = json_files[i:i + batch_size]
-        batch = []
-        
-        for filename in batch_files:
-            try:
-                with open(os.path.join(path, filename), 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                    # Convert tag arrays to comma-separated strings
-                    tags_general = ','.join(data.get('tags_general', [])) if isinstance(data.get('tags_general'), list) else data.get('tags_general', '')
-                    tags_artist = ','.join(data.get('tags_artist', [])) if isinstance(data.get('tags_artist'), list) else data.get('tags_artist', '')
-                    tags_character = ','.join(data.get('tags_character', [])) if isinstance(data.get('tags_character'), list) else data.get('tags_character', '')
-                    tags_copyright = ','.join(data.get('tags_copyright', [])) if isinstance(data.get('tags_copyright'), list) else data.get('tags_copyright', '')
-                    tags_meta = ','.join(data.get('tags_meta', [])) if isinstance(data.get('tags_meta'), list) else data.get('tags_meta', '')
-
-                    def parse_datetime(dt_str):
-                        if not dt_str:
-                            return None
-                        try:
-                            return datetime.fromisoformat(dt_str)
-                        except (ValueError, TypeError):
-                            return None
-
-                    image = Image(
-                        id=data['id'],
-                        created_at=parse_datetime(data['created_at']) or datetime.min,
-                        updated_at=parse_datetime(data['updated_at']) or datetime.min,
-                        up_score=int(data.get('up_score', 0)),
-                        down_score=int(data.get('down_score', 0)),
-                        score=int(data.get('score', 0)),
-                        source=str(data.get('source', '')),
-                        md5=str(data.get('md5', '')),
-                        rating=str(data.get('rating', '')),
-                        is_pending=bool(data.get('is_pending', False)),
-                        is_flagged=bool(data.get('is_flagged', False)),
-                        is_deleted=bool(data.get('is_deleted', False)),
-                        uploader_id=data.get('uploader_id'),
-                        approver_id=data.get('approver_id'),
-                        last_noted_at=parse_datetime(data.get('last_noted_at')),
-                        last_comment_bumped_at=parse_datetime(data.get('last_comment_bumped_at')),
-                        fav_count=int(data.get('fav_count', 0)),
-                        tag_string=str(data.get('tag_string', '')),
-                        tag_count=int(data.get('tag_count', 0)),
-                        tag_count_general=int(data.get('tag_count_general', 0)),
-                        tag_count_artist=int(data.get('tag_count_artist', 0)),
-                        tag_count_character=int(data.get('tag_count_character', 0)),
-                        tag_count_copyright=int(data.get('tag_count_copyright', 0)),
-                        file_ext=str(data.get('file_ext', '')),
-                        file_size=int(data.get('file_size', 0)),
-                        image_width=int(data.get('image_width', 0)),
-                        image_height=int(data.get('image_height', 0)),
-                        parent_id=data.get('parent_id'),
-                        has_children=bool(data.get('has_children', False)),
-                        is_banned=bool(data.get('is_banned', False)),
-                        pixiv_id=str(data.get('pixiv_id', '')),
-                        last_commented_at=parse_datetime(data.get('last_commented_at')),
-                        has_active_children=bool(data.get('has_active_children', False)),
-                        bit_flags=int(data.get('bit_flags', 0)),
-                        tag_count_meta=int(data.get('tag_count_meta', 0)),
-                        has_large=bool(data.get('has_large', False)),
-                        has_visible_children=bool(data.get('has_visible_children', False)),
-                        tags_general=tags_general,
-                        tags_artist=tags_artist,
-                        tags_character=tags_character,
-                        tags_copyright=tags_copyright,
-                        tags_meta=tags_meta
-                    )
-                    batch.append(image)
-            except Exception as e:
-                logger.error(f"Error processing {filename}: {str(e)}")
-                continue
-        
-        if batch:
-            try:
-                db.session.bulk_save_objects(batch)
-                db.session.commit()
-                processed += len(batch)
-                logger.info(f"Processed {processed}/{len(json_files)} files")
-            except Exception as e:
-                logger.error(f"Error committing batch: {str(e)}")
-                db.session.rollback()
-
-def booru_webui(config_class=Config):
-    """Create and configure the Flask application."""
+def serving():
+    """False while a flask CLI command other than ``run`` is loading the app."""
+    context = click.get_current_context(silent=True)
+    return context is None or context.info_name == 'run'
+
+def booru_webui(config_class=Config, background=None):
+    """Create and configure the Flask application.
+
+    ``background`` runs the job runner and download watcher in this
+    process; by default they run when serving, outside the debug
+    reloader's parent process.
+    """
     app = Flask(__name__, 
                 static_folder=os.path.join(os.path.dirname(__file__), 'static'),
                 static_url_path='/static')
     
     # Load configuration
     app.config.from_object(config_class)
+    # Templates read settings through config.settings; from_object only copies upper-case names
+    app.config['settings'] = settings
     
     # Ensure static directories exist
     os.makedirs(app.static_folder, exist_ok=True)
@@ -244,94 +109,290 @@ def booru_webui(config_class=Config):
     
     # Setup image processing
     process_images = setup_image_paths(app)
+
+    if settings.get('database', 'read_only_requests', default=True):
+        init_read_only_requests()
+
+    # Request timing and per-route SQL counts for /metrics
+    if settings.get('metrics', 'enabled', default=True):
+        init_metrics(app)
+
+    # Rendered pages, valid until the next ingest changes the library
+    app.extensions['page_cache'] = create_page_cache()
+    app.extensions['neighbors'] = NeighborIndex(window=settings.get('gallery', 'neighbor_window', default=50))
+    app.extensions['autocomplete'] = TagCompleter(app, limit=settings.get('ui', 'autocomplete_limit', default=10))
+    app.extensions['similar'] = SimilarityIndex()
+
+    # Optional sprite sheets: one atlas image per gallery page instead of a request per thumbnail
+    if settings.get('sprites', 'enabled', default=False):
+        app.extensions['sprites'] = SpriteService(
+            app.extensions['thumbnails'],
+            os.path.join(app.static_folder, settings.get('sprites', 'folder', default='sprites')),
+            max_sheets=settings.get('sprites', 'max_sheets', default=2000)
+        )
+
+    # Optional NumPy tag index for heavy tag searches
+    if settings.get('tag_index', 'enabled', default=False):
+        if TagBitmapIndex.supported():
+            app.extensions['tag_index'] = TagBitmapIndex(
+                app, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  settings.get('tag_index', 'path', default='tag_index')),
+                rebuild_interval=settings.get('tag_index', 'rebuild_interval', default=10.0)
+            )
+        else:
+            logger.warning("tag_index.enabled is set but NumPy is not installed; searching with SQL only")
     
+    def sync_library(context):
+        """Job: sync new and changed JSON files into the database."""
+        path = settings.get('paths', 'source_json')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Data directory not found: {path}")
+
+        if Image.query.first() and not Tag.query.first():
+            context.progress(0, message="Building tag index for existing images")
+            indexed = rebuild_tag_index(settings.get('processing', 'batch_size'))
+            logger.info(f"Indexed tags for {indexed} images")
+        elif Tag.query.first() and not TagCount.query.first():
+            context.progress(0, message="Building tag counts")
+            rebuild_tag_counts()
+
+        context.progress(0, message="Syncing new and changed JSON files")
+        synced = load_images_from_json(path, full=context.params.get('full', False), progress=context.progress)
+        context.message = f"{synced} posts added or updated"
+
+    # Ingest and thumbnail work runs on a background job runner, so the app
+    # serves whatever is already indexed from the start
+    app.extensions['jobs'] = JobRunner(app,
+                                       progress_interval=settings.get('jobs', 'progress_interval', default=2.0),
+                                       history=settings.get('jobs', 'history', default=100))
+    # Ingest goes first: it preempts a running thumbnail job, which resumes afterwards
+    app.extensions['jobs'].register('ingest', sync_library, priority=1)
+    app.extensions['jobs'].register('thumbnails', lambda context: process_images(
+        prewarm=context.params.get('prewarm', False), progress=context.progress))
+
+    def ingest_downloads(json_files, image_files):
+        """Watcher batch: sync new JSON sidecars and start thumbnails for their images."""
+        mode = storage_mode()
+        if image_files and mode != 'direct':
+            link_images(settings.get('paths', 'source_images'), app.extensions['thumbnails'].images_dir, mode,
+                        filenames=image_files)
+        if json_files:
+            load_images_from_json(settings.get('paths', 'source_json'), files=json_files)
+        app.extensions['thumbnails'].queue(image_files)
+
+    def resync_downloads():
+        """Watcher fallback when events were lost: an ordinary incremental sync."""
+        mode = storage_mode()
+        if mode != 'direct':
+            link_images(settings.get('paths', 'source_images'), app.extensions['thumbnails'].images_dir, mode)
+        load_images_from_json(settings.get('paths', 'source_json'))
+
+    # In the server, watcher batches run on the job runner, which is the only writer
+    app.extensions['jobs'].register('downloads', lambda context: ingest_downloads(
+        context.params.get('json', []), context.params.get('images', [])), priority=1)
+
+    def submit_downloads(json_files, image_files):
+        app.extensions['jobs'].submit('downloads', {'json': json_files, 'images': image_files})
+
+    def submit_resync():
+        app.extensions['jobs'].submit('ingest')
+
+    def create_watcher(use_jobs=False):
+        """Watcher for new gallery-dl downloads, or None if the source directories are missing.
+
+        With ``use_jobs`` the batches are queued as jobs for this process's
+        job runner; otherwise (``flask watch``) the watcher writes them itself.
+        """
+        json_dir = settings.get('paths', 'source_json')
+        images_dir = settings.get('paths', 'source_images')
+        for path in (json_dir, images_dir):
+            if not os.path.isdir(path):
+                logger.warning(f"Not watching for new downloads: {path} does not exist")
+                return None
+        handle, resync = (submit_downloads, submit_resync) if use_jobs else (ingest_downloads, resync_downloads)
+        return LibraryWatcher(
+            app, json_dir, images_dir, handle, resync,
+            backend=settings.get('watch', 'backend', default='auto'),
+            interval=settings.get('watch', 'interval', default=2.0),
+            debounce=settings.get('watch', 'debounce', default=1.0),
+            max_delay=settings.get('watch', 'max_delay', default=5.0),
+            pair_timeout=settings.get('watch', 'pair_timeout', default=30.0),
+            batch_size=settings.get('watch', 'batch_size', default=100)
+        )
+
     with app.app_context():
-        # Create database tables
+        # Create missing tables, then migrate older databases
         db.create_all()
+        migrate()
+        check_query_plans()
+        if 'tag_index' in app.extensions:
+            # Map the saved index, or start building it in the background
+            app.extensions['tag_index'].ready(library_generation())
         
-        # Process images if not in debug/reloader mode
-        if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
-            process_images()
+        # Run jobs if serving and not in debug/reloader mode
+        if background is None:
+            background = serving() and (not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
+        if background:
+            app.extensions['jobs'].start()
+            if settings.get('jobs', 'sync_on_startup', default=True):
+                app.extensions['jobs'].submit('ingest')
+            if settings.get('thumbnails', 'mode', default='lazy') == 'eager':
+                app.extensions['jobs'].submit('thumbnails')
+            elif settings.get('thumbnails', 'prewarm', default=True):
+                # Thumbnails are generated on request and pre-warmed behind
+                app.extensions['jobs'].submit('thumbnails', {'prewarm': True})
+            if settings.get('watch', 'enabled', default=False):
+                watcher = create_watcher(use_jobs=True)
+                if watcher is not None:
+                    app.extensions['watcher'] = watcher
+                    watcher.start()
     
+    def use_keyset_pagination():
+        """Whether this request pages by cursor (the default) or by page number."""
+        if 'cursor' in request.args:
+            return True
+        if 'page' in request.args:
+            return False
+        return settings.get('gallery', 'pagination', default='keyset') == 'keyset'
+
+    def search_query(text):
+        """Compile a booru-style search into a CompiledQuery over the configured filters.
+
+        Sorting falls back to the gallery settings unless the search has an
+        order: metatag. Raises QueryError for malformed or unbounded searches.
+        """
+        query = Image.query
+        if settings.get('filters', 'exclude_deleted'):
+            query = query.filter(Image.is_deleted == False)
+        if settings.get('filters', 'exclude_banned'):
+            query = query.filter(Image.is_banned == False)
+
+        compiled = compile_query(query, parse_query(text)) if text else CompiledQuery(query)
+        default_sort_by, default_sort_order = search_order('')
+        compiled.sort_by = compiled.sort_by or default_sort_by
+        compiled.sort_order = compiled.sort_order or default_sort_order
+        return compiled
+
+    def search_order(text):
+        """(sort_by, sort_order) for a search, without touching the database."""
+        sort_by, sort_order = query_order(parse_query(text)) if text else (None, None)
+        return (sort_by or settings.get('gallery', 'sort_by'),
+                sort_order or settings.get('gallery', 'sort_order'))
+
+    def thumbnail_url(filename):
+        """URL of a thumbnail, versioned by the render settings so it can be cached forever."""
+        return url_for('static', filename='thumbnails/' + filename, v=thumbnail_settings_hash())
+
+    def thumbnail_srcset(image, fmt):
+        """srcset value listing an image's thumbnail variants in one format."""
+        sizes = thumbnail_sizes()
+        widths = [width for width in sizes if width <= (image.image_width or 0)] or sizes[:1]
+        filename = f"{image.md5}.{image.file_ext}"
+        return ', '.join(
+            f"{thumbnail_url(variant_filename(filename, width, fmt))} {width}w"
+            for width in widths
+        )
+
+    def sprite_sheet(images):
+        """The sprite sheet for a page of images, or None when sprites are off."""
+        sprites = app.extensions.get('sprites')
+        return sprites.sheet_for(images) if sprites is not None else None
+
+    def sprite_url(sheet):
+        return url_for('serve_sprite', filename=f"{sheet.key}.{app.extensions['sprites'].extension}")
+
     # Context processor for templates
     @app.context_processor
     def inject_settings():
         return {
             'settings': settings,
-            'now': datetime.now()
+            'now': datetime.now(),
+            'thumbnail_formats': thumbnail_formats(),
+            'thumbnail_url': thumbnail_url,
+            'thumbnail_srcset': thumbnail_srcset,
+            'sprite_sheet': sprite_sheet,
+            'sprite_url': sprite_url
         }
     
     @app.route('/')
+    @cached_page
     def index():
         """Home page route."""
         # Get basic statistics
-        total_images = Image.query.count()
-        active_images = Image.query.filter(
-            Image.is_deleted == False,
-            Image.is_banned == False
-        ).count()
-
-        # Get top tags
-        tags = {}
-        for image in Image.query.limit(1000):
-            for tag_type in ['general', 'artist', 'character', 'copyright', 'meta']:
-                tags_str = getattr(image, f'tags_{tag_type}', '')
-                if tags_str:
-                    for tag in tags_str.split(','):
-                        tag = tag.strip()
-                        if tag:
-                            tags[tag] = tags.get(tag, 0) + 1
-
-        top_tags = dict(sorted(tags.items(), 
-                             key=lambda x: x[1], 
-                             reverse=True)[:settings.get('ui', 'tag_cloud_limit')])
+        total_images = image_count(False, False)
+        active_images = image_count(True, True)
+
+        # Get top tags from the maintained tag counts
+        top_tags_dict = top_tags(settings.get('ui', 'tag_cloud_limit'),
+                                 settings.get('filters', 'exclude_deleted'),
+                                 settings.get('filters', 'exclude_banned'))
 
         stats = {
             'total_images': total_images,
             'active_images': active_images,
-            'top_tags': top_tags
+            'top_tags': top_tags_dict
         }
 
         return render_template('index.html', stats=stats)
 
     @app.route('/gallery')
+    @cached_page
     def gallery():
         """Gallery page route."""
         try:
-            page = request.args.get('page', 1, type=int)
             images_per_page = settings.get('gallery', 'images_per_page')
+            exclude_deleted = settings.get('filters', 'exclude_deleted')
+            exclude_banned = settings.get('filters', 'exclude_banned')
             
             # Build base query
             query = Image.query
 
             # Apply filters
-            if settings.get('filters', 'exclude_deleted'):
+            if exclude_deleted:
                 query = query.filter(Image.is_deleted == False)
-            if settings.get('filters', 'exclude_banned'):
+            if exclude_banned:
                 query = query.filter(Image.is_banned == False)
             
-            # Get total count for pagination
-            total_count = query.count()
+            # Total count is cached and refreshed on ingest
+            total_count = image_count(exclude_deleted, exclude_banned)
             max_pages = (total_count + images_per_page - 1) // images_per_page
 
+            sort_by = settings.get('gallery', 'sort_by')
+            sort_order = settings.get('gallery', 'sort_order')
+
+            # Cursor pagination unless an explicit page number was requested
+            if use_keyset_pagination():
+                try:
+                    keyset_page = keyset_paginate(query, sort_by, sort_order, images_per_page,
+                                                  cursor=request.args.get('cursor'),
+                                                  total=total_count)
+                except InvalidCursor:
+                    return redirect(url_for('gallery'))
+
+                return render_template('gallery.html',
+                                     images=keyset_page.items,
+                                     keyset_page=keyset_page,
+                                     total_pages=max_pages)
+
             # Validate page number
+            page = request.args.get('page', 1, type=int)
             page = max(1, min(page, max_pages))
 
             # Apply sorting
-            sort_by = settings.get('gallery', 'sort_by')
-            sort_order = settings.get('gallery', 'sort_order')
-            
             if sort_order == 'desc':
-                query = query.order_by(getattr(Image, sort_by).desc())
+                query = query.order_by(getattr(Image, sort_by).desc(), Image.id.desc())
             else:
-                query = query.order_by(getattr(Image, sort_by).asc())
+                query = query.order_by(getattr(Image, sort_by).asc(), Image.id.asc())
 
             # Paginate results
-            pagination = query.paginate(
+            pagination = listing_query(query).paginate(
                 page=page,
                 per_page=images_per_page,
-                error_out=False
+                error_out=False,
+                count=False
             )
+            pagination.items = listing_rows(pagination.items)
+            pagination.total = total_count
 
             return render_template('gallery.html',
                                  images=pagination.items,
@@ -347,64 +408,79 @@ def booru_webui(config_class=Config):
     def view_image(image_id):
         """Single image view route."""
         try:
-            image = Image.query.get_or_404(image_id)
-
-            # Get previous and next image IDs
-            prev_image = Image.query.filter(
-                Image.id < image_id,
-                Image.is_deleted == False,
-                Image.is_banned == False
-            ).order_by(Image.id.desc()).first()
+            image = Image.query.options(undefer_group(DETAIL_COLUMNS)).get_or_404(image_id)
 
-            next_image = Image.query.filter(
-                Image.id > image_id,
-                Image.is_deleted == False,
-                Image.is_banned == False
-            ).order_by(Image.id.asc()).first()
+            # Step through the list the viewer came from: the gallery order or a search
+            search_text = request.args.get('q', '').strip()
+            try:
+                sort_by, sort_order = search_order(search_text)
+            except QueryError:
+                search_text = ''
+                sort_by, sort_order = search_order(search_text)
+            try:
+                prev_id, next_id, upcoming = app.extensions['neighbors'].neighbors(
+                    search_text,
+                    lambda: search_query(search_text).query,
+                    sort_by,
+                    sort_order,
+                    image,
+                    library_generation(),
+                    prefetch=settings.get('gallery', 'prefetch', default=3)
+                )
+            except QueryError:
+                # Parses but does not compile (a bad metatag value, too many terms): no stepping
+                prev_id, next_id, upcoming = None, None, []
 
             return render_template('image.html',
                                  image=image,
-                                 prev_id=prev_image.id if prev_image else None,
-                                 next_id=next_image.id if next_image else None)
+                                 prev_id=prev_id,
+                                 next_id=next_id,
+                                 upcoming=upcoming,
+                                 search_text=search_text or None)
 
         except Exception as e:
             logger.error(f"Error viewing image {image_id}: {str(e)}")
             return f"Error viewing image: {str(e)}", 500
 
+    @app.route('/image/<int:image_id>/similar')
+    def similar_images(image_id):
+        """Images whose perceptual hash is close to this one's: re-encodes, resizes, crops."""
+        image = Image.query.get_or_404(image_id)
+        limit_distance = settings.get('similar', 'max_distance', default=10)
+        max_distance = max(0, min(request.args.get('distance', limit_distance, type=int), limit_distance))
+        matches = []
+        if image.phash is not None:
+            matches = app.extensions['similar'].similar(image.phash, max_distance,
+                                                        settings.get('similar', 'limit', default=48),
+                                                        library_generation(), exclude_id=image.id)
+        images = {row.id: row for row in listing_rows(listing_query(
+            Image.query.filter(Image.id.in_([image_id for image_id, _ in matches]))))}
+        return render_template('similar.html',
+                               image=image,
+                               matches=[(images[image_id], distance) for image_id, distance in matches
+                                        if image_id in images],
+                               max_distance=max_distance)
+
     @app.route('/tagcloud')
+    @cached_page
     def tagcloud():
         """Tag cloud view route."""
         logger.info("Accessing tag cloud")
-        tag_counts = {}
+        category = request.args.get('category')
+        if category not in TAG_CATEGORIES:
+            category = None
 
-        # Apply filters from settings
-        query = Image.query
-        if settings.get('filters', 'exclude_deleted'):
-            query = query.filter(Image.is_deleted == False)
-        if settings.get('filters', 'exclude_banned'):
-            query = query.filter(Image.is_banned == False)
-
-        # Get all qualified images
-        images = query.all()
-
-        # Process tags
-        for image in images:
-            for tag_type in ['general', 'artist', 'character', 'copyright', 'meta']:
-                tags_str = getattr(image, f'tags_{tag_type}', '')
-                if tags_str:
-                    for tag in tags_str.split(','):
-                        tag = tag.strip()
-                        if tag:
-                            tag_counts[tag] = tag_counts.get(tag, 0) + 1
-
-        # Sort tags by count and take top N as configured
-        tag_limit = settings.get('ui', 'tag_cloud_limit')
-        sorted_tags = dict(sorted(tag_counts.items(),
-                                key=lambda x: x[1],
-                                reverse=True)[:tag_limit])
+        # Read the top N tags for the configured filters from the tag counts
+        sorted_tags = top_tags(settings.get('ui', 'tag_cloud_limit'),
+                               settings.get('filters', 'exclude_deleted'),
+                               settings.get('filters', 'exclude_banned'),
+                               category=category)
 
         logger.info(f"Generated tag cloud with {len(sorted_tags)} tags")
-        return render_template('tagcloud.html', tags=sorted_tags)
+        return render_template('tagcloud.html',
+                               tags=sorted_tags,
+                               categories=TAG_CATEGORIES,
+                               category=category)
 
     @app.route('/search')
     def search():
@@ -416,39 +492,50 @@ def booru_webui(config_class=Config):
             return redirect(url_for('gallery'))
             
         try:
-            # Split query into individual tags
-            search_tags = [tag.strip() for tag in query.split(',') if tag.strip()]
-            
-            # Build base query
-            base_query = Image.query
-            
-            # Apply filters from settings
-            if settings.get('filters', 'exclude_deleted'):
-                base_query = base_query.filter(Image.is_deleted == False)
-            if settings.get('filters', 'exclude_banned'):
-                base_query = base_query.filter(Image.is_banned == False)
-            
-            # Search across all tag types
-            if search_tags:
-                conditions = []
-                for tag in search_tags:
-                    tag_condition = or_(
-                        Image.tags_general.like(f'%{tag}%'),
-                        Image.tags_artist.like(f'%{tag}%'),
-                        Image.tags_character.like(f'%{tag}%'),
-                        Image.tags_copyright.like(f'%{tag}%'),
-                        Image.tags_meta.like(f'%{tag}%')
-                    )
-                    conditions.append(tag_condition)
-                base_query = base_query.filter(*conditions)
+            compiled = search_query(query)
+        except QueryError as e:
+            return render_template('search.html', query=query, images=[], error=str(e)), 400
+
+        try:
+            base_query = compiled.query
+            sort_by = compiled.sort_by
+            sort_order = compiled.sort_order
+            page_size = settings.get('gallery', 'images_per_page')
+
+            if use_keyset_pagination():
+                keyset_page = None
+                tag_index = app.extensions.get('tag_index')
+                try:
+                    if tag_index is not None and tag_index.ready(library_generation()):
+                        # Answered from the in-memory index when the query is pure tag logic
+                        keyset_page = tag_index.paginate(parse_query(query), sort_by, sort_order, page_size,
+                                                         request.args.get('cursor'),
+                                                         settings.get('filters', 'exclude_deleted'),
+                                                         settings.get('filters', 'exclude_banned'))
+                    if keyset_page is None:
+                        keyset_page = keyset_paginate(base_query, sort_by, sort_order, page_size,
+                                                      cursor=request.args.get('cursor'))
+                except InvalidCursor:
+                    # A mangled or outdated cursor: start the search over at its first page
+                    return redirect(url_for('search', q=query))
+                return render_template('search.html',
+                                     query=query,
+                                     images=keyset_page.items,
+                                     keyset_page=keyset_page)
+
+            # Apply sorting
+            if sort_order == 'desc':
+                base_query = base_query.order_by(getattr(Image, sort_by).desc(), Image.id.desc())
+            else:
+                base_query = base_query.order_by(getattr(Image, sort_by).asc(), Image.id.asc())
             
             # Paginate results
-            page_size = settings.get('gallery', 'images_per_page')
-            pagination = base_query.paginate(
+            pagination = listing_query(base_query).paginate(
                 page=page,
                 per_page=page_size,
                 error_out=False
             )
+            pagination.items = listing_rows(pagination.items)
             
             return render_template('search.html',
                                  query=query,
@@ -460,6 +547,117 @@ def booru_webui(config_class=Config):
             flash("An error occurred while searching. Please try again.")
             return redirect(url_for('gallery'))
 
+    @app.route('/api/tags/autocomplete')
+    def autocomplete_tags():
+        """Suggest tags starting with ?q=, most used first."""
+        term = request.args.get('q', '')
+        # Complete the word being typed, without its -/~/( operators or category prefix
+        word = (term.split() or [''])[-1].split(',')[-1].lstrip('-~(').split(':', 1)[-1]
+        prefix = normalize_tag(word.lstrip('"').rstrip('*'))
+        tags = app.extensions['autocomplete'].complete(prefix, library_generation(),
+                                                       limit=request.args.get('limit', type=int))
+        return jsonify([
+            {'name': name, 'category': category, 'post_count': post_count}
+            for name, category, post_count in tags
+        ])
+
+    @app.route('/api/posts')
+    def posts_api():
+        """Posts as JSON, one keyset page at a time.
+
+        Takes the same q= search as /search, fields= to pick columns
+        (comma-separated, or 'all'), limit=, and cursor= from the previous
+        page's next_cursor.
+        """
+        try:
+            fields = parse_fields(request.args.get('fields', ''))
+            compiled = search_query(request.args.get('q', '').strip())
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        limit = request.args.get('limit', settings.get('gallery', 'images_per_page'), type=int)
+        limit = max(1, min(limit, settings.get('api', 'max_limit', default=1000)))
+        sort_by = compiled.sort_by if compiled.sort_by in SORT_COLUMNS else 'id'
+        # The cursor is built from id and the sort column, so they are selected even when not returned
+        columns = tuple(dict.fromkeys(('id', sort_by) + fields))
+        try:
+            page = keyset_paginate(compiled.query, sort_by, compiled.sort_order, limit,
+                                   cursor=request.args.get('cursor'), columns=columns)
+        except InvalidCursor:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        return jsonify({
+            'posts': [post_dict(row, fields) for row in page.items],
+            'next_cursor': page.next_cursor,
+            'prev_cursor': page.prev_cursor,
+        })
+
+    @app.route('/api/posts/export')
+    def export_posts():
+        """Every post matching q= as one streamed NDJSON response in id order; takes fields= like /api/posts."""
+        try:
+            fields = parse_fields(request.args.get('fields', ''))
+            compiled = search_query(request.args.get('q', '').strip())
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        posts = iter_posts(compiled.query, fields, batch_size=settings.get('api', 'export_batch_size', default=1000))
+        return Response(stream_with_context(ndjson(posts)), mimetype='application/x-ndjson',
+                        headers={'Content-Disposition': 'attachment; filename=posts.ndjson'})
+
+    @app.route('/metrics')
+    def metrics():
+        """Request, SQL and job metrics in the Prometheus text format."""
+        if not settings.get('metrics', 'enabled', default=True):
+            abort(404)
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/jobs')
+    def jobs_page():
+        """Status of recent background jobs."""
+        runner = app.extensions['jobs']
+        jobs = [job_info(job, runner.live(job.id)) for job in Job.query.order_by(Job.id.desc()).limit(50)]
+        # Watcher batches are queued by the watcher itself, never by hand
+        kinds = sorted(kind for kind in runner.handlers if kind != 'downloads')
+        return render_template('jobs.html', jobs=jobs, kinds=kinds,
+                               active=any(job['status'] in ('queued', 'running') for job in jobs))
+
+    @app.route('/api/jobs', methods=['GET', 'POST'])
+    def jobs_api():
+        """List recent jobs, or queue one with {"kind": ..., "params": {...}}."""
+        runner = app.extensions['jobs']
+        if request.method == 'GET':
+            limit = min(request.args.get('limit', 50, type=int), 500)
+            return jsonify([job_info(job, runner.live(job.id))
+                            for job in Job.query.order_by(Job.id.desc()).limit(limit)])
+
+        data = request.get_json(silent=True) if request.is_json else request.form
+        if not isinstance(data, dict):
+            abort(400, "Expected a JSON object")
+        params = data.get('params') if request.is_json else {key: value == 'true' for key, value in data.items()
+                                                            if key != 'kind'}
+        if params is not None and not isinstance(params, dict):
+            abort(400, "params must be an object")
+        try:
+            job_id = runner.submit(data.get('kind'), params or {})
+        except ValueError as e:
+            abort(400, str(e))
+        if not request.is_json:
+            return redirect(url_for('jobs_page'))
+        return jsonify(job_info(db.session.get(Job, job_id), runner.live(job_id))), 202
+
+    @app.route('/api/jobs/<int:job_id>')
+    def job_api(job_id):
+        job = db.get_or_404(Job, job_id)
+        return jsonify(job_info(job, app.extensions['jobs'].live(job_id)))
+
+    @app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+    def cancel_job(job_id):
+        """Cancel a queued job, or ask a running one to stop at its next progress report."""
+        db.get_or_404(Job, job_id)
+        cancelled = app.extensions['jobs'].cancel(job_id)
+        if not request.is_json:
+            return redirect(url_for('jobs_page'))
+        return jsonify({'cancelled': cancelled})
+
     @app.route('/debug/images')
     def debug_images():
         """Debug route for checking image processing status."""
@@ -467,7 +665,7 @@ def booru_webui(config_class=Config):
             return "Debug mode is disabled", 403
             
         static_folder = app.static_folder
-        images_dir = os.path.join(static_folder, settings.get('paths', 'images_folder'))
+        images_dir = originals_dir(static_folder)
 
         try:
             files = os.listdir(images_dir)
@@ -482,6 +680,8 @@ def booru_webui(config_class=Config):
                 'total_files': len(files),
                 'total_images': len(image_files),
                 'sample_files': image_files[:5],
+                'tag_index_bytes': app.extensions['tag_index'].memory_usage()
+                                   if 'tag_index' in app.extensions else None,
                 'database_records': [
                     {
                         'id': img.id,
@@ -497,37 +697,108 @@ def booru_webui(config_class=Config):
         except Exception as e:
             return f"Error: {str(e)}", 500
 
-    @app.before_first_request
-    def load_data():
-        """Load initial data from JSON files if database is empty."""
-        logger.info("Checking database status...")
+    @app.cli.command('sync')
+    @click.option('--full', is_flag=True, help='Re-parse every JSON file, ignoring sync watermarks.')
+    def sync_command(full):
+        """Sync new and changed gallery-dl JSON files into the database."""
         path = settings.get('paths', 'source_json')
-    
         if not os.path.exists(path):
-            logger.error(f"Data directory not found: {path}")
-            return
-        
-        if not Image.query.first():
-            logger.info("No images in database, loading from JSON...")
-            try:
-                file_count = len([f for f in os.listdir(path) if f.endswith('.json')])
-                logger.info(f"Found {file_count} JSON files to process")
-                load_images_from_json(path)
-                logger.info("Data loading completed")
-            except Exception as e:
-                logger.error(f"Error loading data: {str(e)}")
-        else:
-            logger.info("Database already contains images, skipping load")
+            raise click.ClickException(f"Data directory not found: {path}")
+        synced = load_images_from_json(path, full=full)
+        click.echo(f"{synced} posts added or updated")
+
+    @app.cli.command('watch')
+    def watch_command():
+        """Add new gallery-dl downloads to the library as they arrive, until interrupted."""
+        watcher = create_watcher()
+        if watcher is None:
+            raise click.ClickException("The source directories in settings.json do not exist")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+
+    @app.cli.command('export')
+    @click.option('--output', '-o', default='-', help='File to write, or - for standard output.')
+    @click.option('--query', '-q', 'text', default=None,
+                  help='Only posts matching this search, with the configured filters. Default: every post.')
+    @click.option('--fields', default='all', help="Comma-separated columns, or 'all'.")
+    def export_command(output, text, fields):
+        """Dump posts as newline-delimited JSON."""
+        try:
+            fields = parse_fields(fields)
+            query = search_query(text).query if text else Image.query
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        exported = 0
+        with click.open_file(output, 'w', encoding='utf-8') as f:
+            for line in ndjson(iter_posts(query, fields,
+                                          batch_size=settings.get('api', 'export_batch_size', default=1000))):
+                f.write(line)
+                exported += 1
+        click.echo(f"Exported {exported} posts", err=True)
+
+    @app.cli.command('find-duplicates')
+    @click.option('--distance', type=int, default=None,
+                  help='Largest Hamming distance between hashes that counts as a duplicate.')
+    def find_duplicates_command(distance):
+        """Report groups of images with near-identical perceptual hashes."""
+        if distance is None:
+            distance = settings.get('similar', 'duplicate_distance', default=4)
+        try:
+            groups = find_duplicate_groups(distance)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        md5s = dict(db.session.query(Image.id, Image.md5).filter(
+            Image.id.in_([image_id for group in groups for image_id, _ in group])))
+        for group in groups:
+            click.echo(f"{len(group)} images:")
+            for image_id, image_distance in group:
+                click.echo(f"  #{image_id}  {md5s.get(image_id)}  distance {image_distance}")
+        click.echo(f"{len(groups)} duplicate groups, {sum(len(group) for group in groups)} images")
 
     @app.route('/static/images/<path:filename>')
     def serve_image(filename):
-        """Serve image files from static directory."""
-        return send_from_directory(app.static_folder + '/images', filename)
+        """Serve an original by file name or bare md5 from the configured storage location."""
+        stored = resolve_original(filename)
+        if stored is None:
+            abort(404)
+        images_dir = app.extensions['thumbnails'].images_dir
+        md5 = os.path.splitext(stored)[0]
+        if MD5_PATTERN.match(md5):
+            # Originals are named by the md5 of their content
+            return send_immutable(images_dir, stored, md5)
+        return send_from_directory(images_dir, stored)
+
+    @app.route('/sprites/<filename>')
+    def serve_sprite(filename):
+        """Serve a sprite atlas or its JSON offset map, building the atlas on its first request."""
+        sprites = app.extensions.get('sprites')
+        key, _, extension = filename.partition('.')
+        if sprites is None or not SPRITE_KEY.match(key) or extension not in (sprites.extension, 'json'):
+            abort(404)
+        if extension != 'json' and not sprites.ensure(key):
+            abort(404)
+        if not os.path.exists(os.path.join(sprites.sprites_dir, filename)):
+            abort(404)
+        # The key hashes the members and render settings, so the content never changes
+        return send_immutable(sprites.sprites_dir, filename, key)
 
     @app.route('/static/thumbnails/<path:filename>')
     def serve_thumbnail(filename):
-        """Serve thumbnail files from static directory."""
-        return send_from_directory(app.static_folder + '/thumbnails', filename)
+        """Serve thumbnail files from static directory, generating missing ones on demand."""
+        try:
+            if not app.extensions['thumbnails'].ensure(filename, timeout=30):
+                abort(404)
+        except FutureTimeoutError:
+            return "Thumbnail is still being generated", 503, {'Retry-After': '5'}
+        thumbnails_dir = app.extensions['thumbnails'].thumbnails_dir
+        version = thumbnail_settings_hash()
+        if request.args.get('v') == version:
+            # ensure() checked the file against the manifest's settings hash, and the same
+            # source md5 and render settings always give the same file
+            return send_immutable(thumbnails_dir, filename, f"{filename}-{version}")
+        return send_from_directory(thumbnails_dir, filename)
 
     @app.errorhandler(404)
     def not_found_error(error):
@@ -0,0 +1,100 @@
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from heapq import nlargest
+from models import db, Tag
+
+logger = logging.getLogger(__name__)
+
+class TagCompleter:
+    """In-memory prefix index of tag names for search-box suggestions.
+
+    Names are kept sorted so a prefix is a bisect range. The top tags for
+    every one- and two-character prefix are computed up front, since those
+    ranges are too wide to rank per keystroke; longer prefixes are ranked
+    on demand and the last ``memo_size`` of them memoized.
+
+    When the library generation changes, the tag table is re-read on a
+    background thread and suggestions keep coming from the previous
+    snapshot until the new one is ready. Only the very first load blocks.
+    """
+
+    PRECOMPUTED_PREFIX = 2
+
+    def __init__(self, app=None, limit=10, memo_size=4096):
+        self.app = app
+        self.limit = limit
+        self.memo_size = memo_size
+        self._lock = threading.Lock()
+        self._generation = None
+        self._loading = False
+        self._names = []
+        self._tags = []
+        self._top = {}
+        self._memo = OrderedDict()
+
+    def load(self, generation):
+        rows = db.session.query(Tag.name, Tag.category, Tag.post_count) \
+            .filter(Tag.post_count > 0).order_by(Tag.name).all()
+        names = [row.name for row in rows]
+        tags = [(row.name, row.category, row.post_count) for row in rows]
+
+        top = {}
+        for tag in sorted(tags, key=lambda tag: -tag[2]):
+            for length in range(1, self.PRECOMPUTED_PREFIX + 1):
+                bucket = top.setdefault(tag[0][:length], [])
+                if len(bucket) < self.limit:
+                    bucket.append(tag)
+
+        with self._lock:
+            self._names, self._tags, self._top = names, tags, top
+            self._memo = OrderedDict()
+            self._generation = generation
+
+    def _reload(self, generation):
+        try:
+            with self.app.app_context():
+                self.load(generation)
+        except Exception as e:
+            logger.error(f"Error reloading tag suggestions: {str(e)}")
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def refresh(self, generation):
+        """Bring the snapshot up to ``generation``: in the background once there is one to serve meanwhile."""
+        if generation == self._generation:
+            return
+        if self._generation is None or self.app is None:
+            self.load(generation)
+            return
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+        threading.Thread(target=self._reload, args=(generation,), name='autocomplete-reload', daemon=True).start()
+
+    def complete(self, prefix, generation, limit=None):
+        """Return up to ``limit`` (name, category, post_count) tuples starting with ``prefix``, most used first."""
+        limit = min(limit or self.limit, self.limit)
+        self.refresh(generation)
+        if not prefix:
+            return []
+
+        with self._lock:
+            names, tags, top, memo = self._names, self._tags, self._top, self._memo
+            cached = top.get(prefix)
+            if cached is None:
+                cached = memo.get(prefix)
+                if cached is not None:
+                    memo.move_to_end(prefix)
+        if cached is None:
+            start = bisect_left(names, prefix)
+            end = bisect_right(names, prefix + '\U0010ffff', lo=start)
+            cached = nlargest(self.limit, tags[start:end], key=lambda tag: tag[2])
+            with self._lock:
+                memo[prefix] = cached
+                if len(memo) > self.memo_size:
+                    memo.popitem(last=False)
+        return cached[:limit]
@@ -0,0 +1,426 @@
+"""Benchmark ingest, thumbnailing and page latency against a synthetic library.
+
+    python benchmark.py --posts 100000 --images 300 --output results.json
+    python benchmark.py --posts 100000 --compare results.json
+
+A gallery-dl style library (sidecar JSON plus small generated images) is
+written to a scratch directory and served from a scratch database; the
+configured settings.json is only read, never changed.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import platform
+import sqlite3
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from itertools import accumulate
+from math import ceil
+from multiprocessing import cpu_count
+from wand.image import Image as WandImage
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+# Vocabulary size per tag category; tag use follows a Zipf distribution
+VOCABULARY = {'general': 5000, 'character': 2000, 'copyright': 300, 'artist': 1500, 'meta': 50}
+# Tags per post per category: (minimum, maximum)
+TAGS_PER_POST = {'general': (8, 40), 'character': (0, 3), 'copyright': (0, 2), 'artist': (1, 1), 'meta': (0, 3)}
+RATINGS = ('g', 's', 'q', 'e')
+
+# ------------------------------------------------------------------ library
+
+class LibraryGenerator:
+    """Deterministic synthetic posts for a seed, shaped like gallery-dl danbooru metadata."""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.vocabulary = {
+            category: [f'{category}_{rank}' for rank in range(size)]
+            for category, size in VOCABULARY.items()
+        }
+        self.weights = {
+            category: list(accumulate(1 / (rank + 1) for rank in range(size)))
+            for category, size in VOCABULARY.items()
+        }
+        self.started = datetime(2015, 1, 1)
+
+    def tags(self, category):
+        low, high = TAGS_PER_POST[category]
+        count = self.rng.randint(low, high)
+        if not count:
+            return []
+        picked = self.rng.choices(self.vocabulary[category], cum_weights=self.weights[category], k=count)
+        return list(dict.fromkeys(picked))
+
+    def post(self, post_id):
+        rng = self.rng
+        tags = {category: self.tags(category) for category in VOCABULARY}
+        tag_list = [tag for category in VOCABULARY for tag in tags[category]]
+        md5 = hashlib.md5(f'{self.seed}-{post_id}'.encode('ascii')).hexdigest()
+        created_at = self.started + timedelta(minutes=post_id * 7 + rng.randrange(7))
+        score = int(rng.expovariate(1 / 25))
+        width = rng.choice((640, 800, 1024, 1280, 1920))
+        return {
+            'id': post_id,
+            'created_at': created_at.isoformat(),
+            'updated_at': (created_at + timedelta(days=rng.randrange(30))).isoformat(),
+            'up_score': score,
+            'down_score': 0,
+            'score': score,
+            'fav_count': int(score * rng.uniform(0.8, 2.0)),
+            'source': f'https://example.com/{post_id}',
+            'md5': md5,
+            'rating': rng.choice(RATINGS),
+            'is_pending': False,
+            'is_flagged': False,
+            'is_deleted': rng.random() < 0.02,
+            'is_banned': rng.random() < 0.005,
+            'uploader_id': rng.randrange(1, 5000),
+            'tag_string': ' '.join(tag_list),
+            'tag_count': len(tag_list),
+            **{f'tag_count_{category}': len(tags[category]) for category in VOCABULARY},
+            **{f'tags_{category}': tags[category] for category in VOCABULARY},
+            'file_ext': 'jpg',
+            'file_size': rng.randrange(100000, 4000000),
+            'image_width': width,
+            'image_height': int(width * rng.uniform(0.5, 1.6)),
+            'file_url': f'https://example.com/data/{md5}.jpg',
+        }
+
+def write_image(path, width, height, rng):
+    """Write a small noisy gradient JPEG, so thumbnails have real content to resample and encode."""
+    start, end = (f'#{rng.randrange(0x1000000):06x}' for _ in range(2))
+    with WandImage(width=width, height=height, pseudo=f'gradient:{start}-{end}') as img:
+        img.noise('gaussian', attenuate=0.5)
+        img.format = 'jpeg'
+        img.compression_quality = 90
+        img.save(filename=path)
+
+def generate_library(json_dir, images_dir, posts, images, seed=0):
+    """Write ``posts`` sidecar JSON files, and images for the first ``images`` of them."""
+    os.makedirs(json_dir, exist_ok=True)
+    os.makedirs(images_dir, exist_ok=True)
+    generator = LibraryGenerator(seed)
+    image_rng = random.Random(seed + 1)
+    for post_id in range(1, posts + 1):
+        post = generator.post(post_id)
+        filename = f"{post['md5']}.{post['file_ext']}"
+        with open(os.path.join(json_dir, filename + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(post, f)
+        if post_id <= images:
+            # Small originals: the shape matters for thumbnailing, not the pixel count
+            width = 640
+            write_image(os.path.join(images_dir, filename), width,
+                        int(width * post['image_height'] / post['image_width']), image_rng)
+
+# ------------------------------------------------------------------ timing
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(samples)
+    return ordered[max(0, ceil(p / 100 * len(ordered)) - 1)]
+
+def summarize(samples):
+    milliseconds = [sample * 1000 for sample in samples]
+    return {
+        'requests': len(milliseconds),
+        'p50_ms': round(percentile(milliseconds, 50), 3),
+        'p99_ms': round(percentile(milliseconds, 99), 3),
+        'mean_ms': round(sum(milliseconds) / len(milliseconds), 3),
+        'max_ms': round(max(milliseconds), 3),
+    }
+
+def bench_ingest(app, json_dir):
+    from ingest import load_images_from_json
+    with app.app_context():
+        started = time.perf_counter()
+        written = load_images_from_json(json_dir)
+        elapsed = time.perf_counter() - started
+
+        # A second sync with nothing changed only compares watermarks
+        started = time.perf_counter()
+        load_images_from_json(json_dir)
+        noop = time.perf_counter() - started
+    return {
+        'posts': written,
+        'seconds': round(elapsed, 3),
+        'posts_per_second': round(written / elapsed, 1) if elapsed else None,
+        'noop_resync_seconds': round(noop, 3),
+    }
+
+def bench_thumbnails(images_dir, workdir, pool_sizes):
+    from thumbnails import generate_single_thumbnail
+    from pools import process_pool
+    width = settings.get('thumbnails', 'width')
+    sources = sorted(os.listdir(images_dir))
+    results = []
+    for processes in pool_sizes:
+        thumbnails_dir = os.path.join(workdir, f'thumbnails-{processes}')
+        shutil.rmtree(thumbnails_dir, ignore_errors=True)
+        os.makedirs(thumbnails_dir)
+        tasks = [(os.path.join(images_dir, name), os.path.join(thumbnails_dir, name), width) for name in sources]
+        started = time.perf_counter()
+        with process_pool(processes) as pool:
+            generated = sum(phash is not None for phash in pool.imap(generate_single_thumbnail, tasks, chunksize=4))
+        elapsed = time.perf_counter() - started
+        results.append({
+            'processes': processes,
+            'images': generated,
+            'seconds': round(elapsed, 3),
+            'images_per_second': round(generated / elapsed, 2) if elapsed else None,
+        })
+        logger.info(f"Thumbnails with {processes} processes: {results[-1]['images_per_second']} images/sec")
+    return results
+
+def route_urls(app, rng, samples):
+    """The URLs to time, keyed by a stable name so runs can be compared."""
+    from models import db, Image, Tag
+    from migrations import listing_queries
+    from pagination import encode_cursor
+
+    with app.app_context():
+        total = db.session.query(Image.id).count()
+        popular = [name for (name,) in db.session.query(Tag.name)
+                   .filter(Tag.category == 'general').order_by(Tag.post_count.desc()).limit(20)]
+        rare = db.session.query(Tag.name).filter(Tag.post_count > 0).order_by(Tag.post_count.asc()).first()
+        image_ids = [image_id for (image_id,) in db.session.query(Image.id)]
+
+        sort_by = settings.get('gallery', 'sort_by')
+        sort_order = settings.get('gallery', 'sort_order')
+        listing = next(query for s, o, query in listing_queries() if (s, o) == (sort_by, sort_order))
+        deep_row = listing.limit(1).offset(int(total * 0.9)).first()
+        per_page = settings.get('gallery', 'images_per_page')
+
+    urls = {
+        'index': ['/'],
+        'gallery_first_page': ['/gallery'],
+        'gallery_deep_page_number': [f'/gallery?page={max(1, int(total * 0.9) // per_page)}'],
+        'tagcloud': ['/tagcloud'],
+        'search_one_tag': [f'/search?q={name}' for name in popular[:10]],
+        'search_two_tags': [f'/search?q={a}+{b}' for a, b in zip(popular[:10], popular[10:20])],
+        'search_negation': [f'/search?q={a}+-{b}' for a, b in zip(popular[:10], popular[10:20])],
+        'search_rare_tag': [f'/search?q={rare[0]}'] if rare else [],
+        'image': [f'/image/{image_id}' for image_id in rng.sample(image_ids, min(samples, len(image_ids)))],
+    }
+    if deep_row is not None:
+        urls['gallery_deep_cursor'] = [f'/gallery?cursor={encode_cursor(sort_by, deep_row, "next")}']
+    return {name: variants for name, variants in urls.items() if variants}
+
+def bench_routes(app, requests, warmup, seed=0):
+    client = app.test_client()
+    rng = random.Random(seed)
+    results = {}
+    for name, urls in route_urls(app, rng, requests).items():
+        for url in urls[:warmup]:
+            client.get(url)
+        samples = []
+        statuses = set()
+        for i in range(requests):
+            url = urls[i % len(urls)]
+            started = time.perf_counter()
+            response = client.get(url)
+            samples.append(time.perf_counter() - started)
+            statuses.add(response.status_code)
+        results[name] = {'url': urls[0], **summarize(samples), 'statuses': sorted(statuses)}
+        logger.info(f"{name}: p50 {results[name]['p50_ms']} ms, p99 {results[name]['p99_ms']} ms")
+    return results
+
+def bench_listing_rows(app, per_page=100, repeat=20):
+    """Cost of loading one listing page as full Image objects, as deferred Image objects and as ListingRow.
+
+    Bytes per row are SQLite's length() of the selected values; retained and
+    peak KB are tracemalloc deltas for one page.
+    """
+    import tracemalloc
+    from sqlalchemy import select, func
+    from sqlalchemy.orm import undefer_group
+    from models import db, Image, DETAIL_COLUMNS
+    from pagination import LISTING_COLUMNS, listing_query, listing_rows
+
+    deferred = {prop.key for prop in Image.__mapper__.column_attrs if prop.deferred}
+    results = {}
+    with app.app_context():
+        page = Image.query.order_by(Image.id.desc()).limit(per_page)
+        loaders = {
+            'full_orm': (lambda: page.options(undefer_group(DETAIL_COLUMNS)).all(),
+                         [column.key for column in Image.__table__.columns]),
+            'deferred_orm': (lambda: page.all(),
+                             [column.key for column in Image.__table__.columns if column.key not in deferred]),
+            'listing_row': (lambda: listing_rows(listing_query(page)), list(LISTING_COLUMNS)),
+        }
+        for name, (load, columns) in loaders.items():
+            lengths = db.session.execute(
+                select(*(func.coalesce(func.length(getattr(Image, column)), 0) for column in columns))
+                .order_by(Image.id.desc()).limit(per_page)
+            ).all()
+            rows = len(lengths) or 1
+
+            db.session.expunge_all()
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            items = load()
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del items
+
+            started = time.perf_counter()
+            for _ in range(repeat):
+                db.session.expunge_all()
+                load()
+            elapsed = (time.perf_counter() - started) / repeat
+
+            results[name] = {
+                'columns': len(columns),
+                'bytes_per_row': round(sum(sum(row) for row in lengths) / rows, 1),
+                'retained_kb': round((retained - before) / 1024, 1),
+                'peak_kb': round((peak - before) / 1024, 1),
+                'ms_per_page': round(elapsed * 1000, 3),
+            }
+            logger.info(f"{name}: {results[name]['bytes_per_row']} bytes/row, "
+                        f"{results[name]['peak_kb']} KB peak, {results[name]['ms_per_page']} ms per {per_page} rows")
+        db.session.expunge_all()
+    return results
+
+# ------------------------------------------------------------------ reporting
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+    }
+
+def flatten(results):
+    """{metric name: value} for the numbers worth comparing between runs."""
+    metrics = {}
+    ingest = results.get('ingest') or {}
+    if ingest.get('posts_per_second'):
+        metrics['ingest posts/sec'] = ingest['posts_per_second']
+    for run in results.get('thumbnails') or []:
+        metrics[f"thumbnails x{run['processes']} images/sec"] = run['images_per_second']
+    for name, rows in (results.get('listing_rows') or {}).items():
+        metrics[f'{name} bytes/row'] = rows['bytes_per_row']
+        metrics[f'{name} peak KB/page'] = rows['peak_kb']
+        metrics[f'{name} ms/page'] = rows['ms_per_page']
+    for name, route in (results.get('routes') or {}).items():
+        metrics[f'{name} p50 ms'] = route['p50_ms']
+        metrics[f'{name} p99 ms'] = route['p99_ms']
+    return metrics
+
+def compare(previous, current):
+    """Print each metric next to the previous run's, with the relative change."""
+    before, after = flatten(previous), flatten(current)
+    print(f"{'metric':<40} {'before':>12} {'after':>12} {'change':>9}")
+    for name, value in after.items():
+        old = before.get(name)
+        change = f'{(value - old) / old * 100:+.1f}%' if old else ''
+        print(f"{name:<40} {old if old is not None else '-':>12} {value:>12} {change:>9}")
+
+# ------------------------------------------------------------------ main
+
+def configure(workdir, page_cache):
+    """Point this process at the scratch library and database without saving settings.json."""
+    database = os.path.join(workdir, 'booru.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+    settings.set(os.path.join(workdir, 'json'), 'paths', 'source_json', save=False)
+    settings.set(os.path.join(workdir, 'images'), 'paths', 'source_images', save=False)
+    settings.set(database, 'paths', 'database', save=False)
+    settings.set('direct', 'paths', 'storage_mode', save=False)
+    settings.set('lazy', 'thumbnails', 'mode', save=False)
+    settings.set(False, 'thumbnails', 'prewarm', save=False)
+    settings.set(page_cache, 'cache', 'enabled', save=False)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=10000, help='Posts in the synthetic library.')
+    parser.add_argument('--images', type=int, default=200, help='Posts that also get an image file.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Scratch directory; a library already there is reused, '
+                                          'its database is not.')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory afterwards.')
+    parser.add_argument('--pools', default=None,
+                        help='Comma-separated thumbnail pool sizes (default: 1 and the CPU count).')
+    parser.add_argument('--requests', type=int, default=200, help='Timed requests per route.')
+    parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per route first.')
+    parser.add_argument('--page-cache', action='store_true', help='Time routes with the page cache enabled.')
+    parser.add_argument('--skip', default='', help='Comma-separated phases to skip: ingest, thumbnails, rows, routes.')
+    parser.add_argument('--output', default='benchmark.json', help='Where to write the JSON results.')
+    parser.add_argument('--compare', help='Earlier results file to compare this run against.')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    skip = {phase.strip() for phase in args.skip.split(',') if phase.strip()}
+    pool_sizes = ([int(size) for size in args.pools.split(',')] if args.pools
+                  else sorted({1, cpu_count()}))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='booru-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    configure(workdir, args.page_cache)
+    # Ingest always starts from an empty database
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(settings.get('paths', 'database') + suffix):
+            os.remove(settings.get('paths', 'database') + suffix)
+    json_dir = settings.get('paths', 'source_json')
+    images_dir = settings.get('paths', 'source_images')
+
+    # The app reads its database and paths at import time, so it is imported after configure()
+    from app import booru_webui
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    results = {'environment': environment(),
+               'library': {'posts': args.posts, 'images': min(args.images, args.posts), 'seed': args.seed},
+               'settings': {section: settings.get(section) for section in ('gallery', 'thumbnails', 'cache',
+                                                                          'tag_index', 'filters')}}
+    try:
+        if not os.path.isdir(json_dir) or not os.listdir(json_dir):
+            started = time.perf_counter()
+            generate_library(json_dir, images_dir, args.posts, args.images, args.seed)
+            results['library']['generate_seconds'] = round(time.perf_counter() - started, 3)
+            logger.info(f"Generated {args.posts} posts in {results['library']['generate_seconds']}s")
+
+        app = booru_webui()
+        if 'ingest' not in skip:
+            results['ingest'] = bench_ingest(app, json_dir)
+            logger.info(f"Ingest: {results['ingest']['posts_per_second']} posts/sec")
+        if 'thumbnails' not in skip:
+            results['thumbnails'] = bench_thumbnails(images_dir, workdir, pool_sizes)
+        if 'rows' not in skip:
+            results['listing_rows'] = bench_listing_rows(app)
+        if 'routes' not in skip:
+            results['routes'] = bench_routes(app, args.requests, args.warmup, args.seed)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, request
+from settings import Settings
+from stats import current_generation
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+_generation_lock = threading.Lock()
+_generation = {'value': None, 'checked_at': 0.0}
+
+def library_generation(check_interval=1.0):
+    """The stats generation counter, re-read from the database at most every ``check_interval`` seconds."""
+    now = time.monotonic()
+    with _generation_lock:
+        if _generation['value'] is not None and now - _generation['checked_at'] < check_interval:
+            return _generation['value']
+    value = current_generation()
+    with _generation_lock:
+        _generation['value'] = value
+        _generation['checked_at'] = now
+    return value
+
+def cache_key(req):
+    """Route plus query args in a stable order, so ?a=1&b=2 and ?b=2&a=1 share an entry."""
+    args = sorted(req.args.items(multi=True))
+    return f"{req.path}?{urlencode(args)}" if args else req.path
+
+class PageCache:
+    """LRU cache of rendered pages, invalidated by the library generation.
+
+    The generation counter lives in the stats table and is bumped by
+    ingestion. It is polled at most every ``check_interval`` seconds (see
+    library_generation), so hits normally cost a dict lookup. With
+    ``cache_dir`` set, pages are also written to disk where other worker
+    processes can pick them up.
+    """
+
+    def __init__(self, max_entries=256, cache_dir=None, check_interval=1.0):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def generation(self):
+        """Current library generation, dropping every entry when it has moved on."""
+        generation = library_generation(self.check_interval)
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    if self._generation is not None:
+                        logger.info(f"Library changed (generation {generation}), clearing page cache")
+                    self._entries.clear()
+                    self._generation = generation
+                    self._prune_disk(generation)
+        return generation
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self._read_disk(key, generation)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def set(self, key, generation, body):
+        if generation != self._generation:
+            # Rendered from data that has been replaced since
+            return
+        self._remember(key, body)
+        self._write_disk(key, generation, body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = None
+
+    def _remember(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key, generation):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{generation}-{digest}.html')
+
+    def _read_disk(self, key, generation):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key, generation), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, generation, body):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key, generation)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error writing page cache entry {path}: {str(e)}")
+
+    def _prune_disk(self, generation):
+        if not self.cache_dir:
+            return
+        prefix = f'{generation}-'
+        try:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(prefix):
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            # Another worker got there first
+                            pass
+        except OSError as e:
+            logger.error(f"Error pruning page cache: {str(e)}")
+
+def create_page_cache():
+    """Build the PageCache from the cache settings, or None when it is disabled."""
+    if not settings.get('cache', 'enabled', default=True):
+        return None
+    return PageCache(
+        max_entries=settings.get('cache', 'max_entries', default=256),
+        cache_dir=settings.get('cache', 'disk_dir'),
+        check_interval=settings.get('cache', 'check_interval', default=1.0)
+    )
+
+def cached_page(view):
+    """Serve a view's successful HTML responses from the page cache."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get('page_cache')
+        if cache is None or request.method != 'GET':
+            return view(*args, **kwargs)
+
+        key = cache_key(request)
+        generation = cache.generation()
+        body = cache.get(key, generation)
+        if body is not None:
+            return current_app.response_class(body, mimetype='text/html')
+
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and response.mimetype == 'text/html':
+            cache.set(key, generation, response.get_data())
+        return response
+    return wrapper
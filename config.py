@@ -15,6 +15,12 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         f"sqlite:///{os.path.join(BASE_DIR, settings.get('paths', 'database'))}"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # One pooled connection per server thread, plus overflow for background jobs and thumbnail workers
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': settings.get('database', 'pool_size', default=10),
+        'max_overflow': settings.get('database', 'max_overflow', default=10),
+        'pool_timeout': settings.get('database', 'pool_timeout', default=30),
+    }
     
     # Server settings
     HOST = settings.get('server', 'host')
@@ -33,6 +39,7 @@ class Config:
     
     # Add processing settings
     BATCH_SIZE = settings.get('processing', 'batch_size')
+    TRANSACTION_SIZE = settings.get('processing', 'transaction_size')
     CPU_USAGE_PERCENT = settings.get('processing', 'cpu_usage_percent')
     
     # Add filter settings
@@ -0,0 +1,53 @@
+import json
+from datetime import datetime
+from models import Image
+from pagination import LISTING_COLUMNS
+
+# Every images column can be asked for with fields=
+POST_FIELDS = tuple(column.key for column in Image.__table__.columns)
+
+# Returned when no fields= is given: what a thumbnail grid needs, plus rating and tags
+DEFAULT_FIELDS = LISTING_COLUMNS + ('rating', 'tag_string')
+
+def parse_fields(text):
+    """Turn a comma-separated fields= value into a tuple of column names.
+
+    Empty means DEFAULT_FIELDS and 'all' means every column. Raises
+    ValueError for names that are not columns of images.
+    """
+    if not text:
+        return DEFAULT_FIELDS
+    if text.strip() == 'all':
+        return POST_FIELDS
+    fields = []
+    for name in text.split(','):
+        name = name.strip()
+        if not name or name in fields:
+            continue
+        if name not in POST_FIELDS:
+            raise ValueError(f"Unknown field: {name}")
+        fields.append(name)
+    return tuple(fields) or DEFAULT_FIELDS
+
+def post_dict(row, fields):
+    """One result row as a JSON-ready dict of ``fields``."""
+    post = {}
+    for name in fields:
+        value = getattr(row, name)
+        post[name] = value.isoformat() if isinstance(value, datetime) else value
+    return post
+
+def iter_posts(query, fields, batch_size=1000):
+    """Yield post dicts for every row of an Image query in id order.
+
+    Only ``fields`` are selected and rows are fetched ``batch_size`` at a
+    time with yield_per, so memory stays flat however large the result.
+    """
+    columns = [getattr(Image, name) for name in fields]
+    for row in query.with_entities(*columns).order_by(Image.id).yield_per(batch_size):
+        yield post_dict(row, fields)
+
+def ndjson(posts):
+    """Encode post dicts as newline-delimited JSON, one line per post."""
+    for post in posts:
+        yield json.dumps(post, separators=(',', ':'), ensure_ascii=False) + '\n'
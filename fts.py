@@ -0,0 +1,74 @@
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from models import db, Image
+from tags import TAG_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'images_fts'
+FTS_COLUMNS = ('tag_string',) + tuple(f'tags_{category}' for category in TAG_CATEGORIES)
+
+# Keep punctuation that appears inside tag names (blue_hair, k-on!, re:zero) in one
+# token; spaces and commas still separate tags. Anything else splits a tag into
+# several tokens, which the phrase queries below still match in order.
+TOKENIZER = "unicode61 tokenchars '_-!?:.()/&+^~@#$%=;<>[]{}|'"
+
+def create_fts(connection):
+    """Create the FTS5 index over the tag columns, its sync triggers, and fill it."""
+    columns = ', '.join(FTS_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+    old_values = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+    connection.exec_driver_sql(
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+        f'{columns}, content=\'images\', content_rowid=\'id\', tokenize="{TOKENIZER}", prefix=\'2 3\')'
+    )
+    # Triggers keep the index in step with every write to images, including upserts
+    connection.exec_driver_sql(
+        f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON images BEGIN '
+        f'INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values}); END'
+    )
+    connection.exec_driver_sql(
+        f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON images BEGIN '
+        f'INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) VALUES (\'delete\', old.id, {old_values}); END'
+    )
+    connection.exec_driver_sql(
+        f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF {columns} ON images BEGIN '
+        f'INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) VALUES (\'delete\', old.id, {old_values}); '
+        f'INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values}); END'
+    )
+    connection.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+def fts_available():
+    """Whether the FTS index exists (SQLite may have been built without FTS5)."""
+    return db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+    ).first() is not None
+
+def _quote(value):
+    return '"' + value.replace('"', '""') + '"'
+
+def fts_prefix(prefix, category=None):
+    """FTS5 expression for tags starting with ``prefix``, optionally in one category column."""
+    expression = _quote(prefix) + '*'
+    return f'tags_{category} : {expression}' if category else expression
+
+def fts_phrase(words, category=None):
+    """FTS5 expression for tags appearing next to each other, in order."""
+    expression = _quote(' '.join(words))
+    return f'tags_{category} : {expression}' if category else expression
+
+def fts_condition(expression):
+    """Condition restricting Image rows to those whose tags match an FTS5 expression."""
+    matches = (
+        text(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match')
+        .bindparams(match=expression)
+        .columns(db.column('rowid', db.Integer))
+    )
+    return Image.id.in_(matches)
+
+def create_fts_if_supported(connection):
+    try:
+        create_fts(connection)
+    except OperationalError as e:
+        logger.warning(f"Full-text search disabled, SQLite lacks FTS5: {str(e)}")
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import logging
+from datetime import datetime
+from math import ceil
+from multiprocessing import cpu_count
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from tqdm import tqdm
+from models import db, Image, JsonFile
+from settings import Settings
+from stats import refresh_image_counts, bump_generation
+from tags import image_tag_map, sync_image_tags, chunks
+from similar import backfill_phashes
+from metrics import record_job
+from pools import process_pool
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+def parse_datetime(dt_str):
+    if not dt_str:
+        return None
+    try:
+        return datetime.fromisoformat(dt_str)
+    except (ValueError, TypeError):
+        return None
+
+def join_tags(value):
+    """Convert a tag array to a comma-separated string."""
+    if isinstance(value, list):
+        return ','.join(value)
+    return value or ''
+
+def parse_image_json(data):
+    """Normalize one gallery-dl metadata dict into an images row."""
+    return {
+        'id': int(data['id']),
+        'created_at': parse_datetime(data.get('created_at')) or datetime.min,
+        'updated_at': parse_datetime(data.get('updated_at')) or datetime.min,
+        'up_score': int(data.get('up_score', 0)),
+        'down_score': int(data.get('down_score', 0)),
+        'score': int(data.get('score', 0)),
+        'source': str(data.get('source', '')),
+        'md5': str(data.get('md5', '')),
+        'rating': str(data.get('rating', '')),
+        'is_pending': bool(data.get('is_pending', False)),
+        'is_flagged': bool(data.get('is_flagged', False)),
+        'is_deleted': bool(data.get('is_deleted', False)),
+        'uploader_id': data.get('uploader_id'),
+        'approver_id': data.get('approver_id'),
+        'last_noted_at': parse_datetime(data.get('last_noted_at')),
+        'last_comment_bumped_at': parse_datetime(data.get('last_comment_bumped_at')),
+        'fav_count': int(data.get('fav_count', 0)),
+        'tag_string': str(data.get('tag_string', '')),
+        'tag_count': int(data.get('tag_count', 0)),
+        'tag_count_general': int(data.get('tag_count_general', 0)),
+        'tag_count_artist': int(data.get('tag_count_artist', 0)),
+        'tag_count_character': int(data.get('tag_count_character', 0)),
+        'tag_count_copyright': int(data.get('tag_count_copyright', 0)),
+        'file_ext': str(data.get('file_ext', '')),
+        'file_size': int(data.get('file_size', 0)),
+        'image_width': int(data.get('image_width', 0)),
+        'image_height': int(data.get('image_height', 0)),
+        'parent_id': data.get('parent_id'),
+        'has_children': bool(data.get('has_children', False)),
+        'is_banned': bool(data.get('is_banned', False)),
+        'pixiv_id': str(data.get('pixiv_id', '')),
+        'last_commented_at': parse_datetime(data.get('last_commented_at')),
+        'has_active_children': bool(data.get('has_active_children', False)),
+        'bit_flags': int(data.get('bit_flags', 0)),
+        'tag_count_meta': int(data.get('tag_count_meta', 0)),
+        'has_large': bool(data.get('has_large', False)),
+        'has_visible_children': bool(data.get('has_visible_children', False)),
+        'media_asset_id': data.get('media_asset_id'),
+        'file_url': str(data.get('file_url', '')),
+        'large_file_url': data.get('large_file_url'),
+        'preview_file_url': data.get('preview_file_url'),
+        'tags_general': join_tags(data.get('tags_general')),
+        'tags_artist': join_tags(data.get('tags_artist')),
+        'tags_character': join_tags(data.get('tags_character')),
+        'tags_copyright': join_tags(data.get('tags_copyright')),
+        'tags_meta': join_tags(data.get('tags_meta')),
+    }
+
+# Column order of the row tuples produced by parse_json_file
+IMAGE_COLUMNS = tuple(parse_image_json({'id': 0}))
+
+def parse_json_file(args):
+    """Parse one JSON file into a row tuple and its normalized tags. Runs in a worker process.
+
+    Returns (filename, mtime, size, row or None, tag map or None, error or None).
+    """
+    path, filename, mtime, size = args
+    try:
+        with open(os.path.join(path, filename), 'r', encoding='utf-8') as f:
+            row = parse_image_json(json.load(f))
+        return filename, mtime, size, tuple(row[name] for name in IMAGE_COLUMNS), image_tag_map(row), None
+    except Exception as e:
+        return filename, mtime, size, None, None, str(e)
+
+def parse_json_files(path, changed):
+    """Yield parse_json_file results, using a process pool for large change sets."""
+    tasks = [(path, filename, mtime, size) for filename, mtime, size in changed]
+    num_processes = ceil(cpu_count() * (settings.get('processing', 'cpu_usage_percent') / 100))
+
+    # A pool only pays off once there is enough work to spread
+    if num_processes <= 1 or len(tasks) < settings.get('processing', 'batch_size'):
+        yield from map(parse_json_file, tasks)
+        return
+
+    logger.info(f"Parsing JSON with {num_processes} processes")
+    with process_pool(num_processes) as pool:
+        yield from pool.imap_unordered(parse_json_file, tasks, chunksize=64)
+
+def scan_json_files(path):
+    """Return {filename: (mtime, size)} for the JSON files in a directory."""
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime, stat.st_size)
+    return files
+
+def stat_json_files(path, filenames):
+    """Return {filename: (mtime, size)} for the listed files that exist, without listing the directory."""
+    files = {}
+    for filename in filenames:
+        try:
+            stat = os.stat(os.path.join(path, filename))
+        except OSError:
+            continue
+        files[filename] = (stat.st_mtime, stat.st_size)
+    return files
+
+def find_changed_files(path, full=False, filenames=None):
+    """Compare a directory against the stored watermarks.
+
+    Returns (changed, removed): files that are new or whose mtime/size
+    differ, and watermarked files that no longer exist. With
+    ``filenames`` only those files are checked and nothing is reported
+    as removed.
+    """
+    if filenames is None:
+        files = scan_json_files(path)
+        query = select(JsonFile.path, JsonFile.mtime, JsonFile.size)
+        watermarks = {} if full else {name: (mtime, size) for name, mtime, size in db.session.execute(query)}
+    else:
+        files = stat_json_files(path, filenames)
+        watermarks = {}
+        if not full:
+            for chunk in chunks(files):
+                watermarks.update(
+                    (name, (mtime, size)) for name, mtime, size in db.session.execute(
+                        select(JsonFile.path, JsonFile.mtime, JsonFile.size).where(JsonFile.path.in_(chunk))
+                    )
+                )
+    changed = [
+        (name, mtime, size)
+        for name, (mtime, size) in files.items()
+        if watermarks.get(name) != (mtime, size)
+    ]
+    removed = [] if filenames is not None else [name for name in watermarks if name not in files]
+    return changed, removed
+
+def upsert_images(session, rows, tag_maps=None):
+    """Insert or update image rows by id and re-sync their tags.
+
+    ``tag_maps`` optionally carries the already normalized tags per image
+    id. Rows whose md5 already belongs to a different post are skipped
+    rather than failing the batch. Returns the rows that were written.
+    """
+    tag_maps = tag_maps or {}
+    by_id = {}
+    for row in rows:
+        by_id[row['id']] = row
+    by_md5 = {}
+    for row in by_id.values():
+        by_md5.setdefault(row['md5'], row)
+
+    existing = {}
+    md5_owners = {}
+    for chunk in chunks(by_id):
+        existing.update(
+            (row.id, (bool(row.is_deleted), bool(row.is_banned)))
+            for row in session.execute(
+                select(Image.id, Image.is_deleted, Image.is_banned).where(Image.id.in_(chunk))
+            )
+        )
+    for chunk in chunks(by_md5):
+        md5_owners.update(session.execute(
+            select(Image.md5, Image.id).where(Image.md5.in_(chunk))
+        ).all())
+
+    accepted = []
+    for row in by_id.values():
+        owner = md5_owners.get(row['md5'], row['id'])
+        if by_md5[row['md5']] is not row or owner != row['id']:
+            logger.warning(f"Skipping post {row['id']}: md5 {row['md5']} already belongs to another post")
+            continue
+        accepted.append(row)
+    if not accepted:
+        return accepted
+
+    table = Image.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['id'],
+        set_={name: stmt.excluded[name] for name in accepted[0] if name != 'id'}
+    )
+    session.execute(stmt, accepted)
+
+    sync_image_tags(
+        session,
+        {row['id']: tag_maps.get(row['id']) or image_tag_map(row) for row in accepted},
+        {row['id']: (row['is_deleted'], row['is_banned']) for row in accepted},
+        {image_id: flags for image_id, flags in existing.items()}
+    )
+    return accepted
+
+def record_watermarks(session, watermarks):
+    """Upsert sync watermarks for processed JSON files."""
+    if not watermarks:
+        return
+    stmt = sqlite_insert(JsonFile.__table__)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['path'],
+            set_={name: stmt.excluded[name] for name in ('mtime', 'size', 'image_id', 'synced_at')}
+        ),
+        watermarks
+    )
+
+def write_batch(rows, watermarks, tag_maps=None):
+    """Write one batch in a single transaction, retrying row by row if it fails."""
+    try:
+        written = upsert_images(db.session, rows, tag_maps)
+        record_watermarks(db.session, watermarks)
+        db.session.commit()
+        return len(written)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        if len(rows) <= 1:
+            logger.error(f"Error writing post {rows[0]['id'] if rows else '?'}: {str(e)}")
+            return 0
+        logger.warning(f"Batch failed ({str(e)}), retrying row by row")
+
+    written = 0
+    marks = {mark['image_id']: mark for mark in watermarks}
+    for row in rows:
+        mark = marks.get(row['id'])
+        written += write_batch([row], [mark] if mark else [], tag_maps)
+    # Files that failed to parse have no row but still get their watermark
+    unparsed = [mark for mark in watermarks if mark['image_id'] is None]
+    if unparsed:
+        record_watermarks(db.session, unparsed)
+        db.session.commit()
+    return written
+
+def load_images_from_json(path, full=False, progress=None, files=None):
+    """Sync image data from JSON files into the database.
+
+    Only files that are new or changed since the last sync (by mtime and
+    size) are parsed, unless ``full`` is set. Parsing is spread over a
+    process pool; this process is the single writer and commits
+    ``processing.transaction_size`` rows per transaction. Returns the number
+    of posts written.
+
+    ``progress(files_done, files_total)`` is called per file. If it raises,
+    the sync stops; committed batches are kept, and their watermarks make
+    the next sync carry on from there.
+
+    ``files`` limits the sync to those file names in ``path``, for
+    callers that already know what changed.
+    """
+    transaction_size = settings.get('processing', 'transaction_size',
+                                    default=settings.get('processing', 'batch_size'))
+    changed, removed = find_changed_files(path, full=full, filenames=files)
+
+    if removed:
+        for chunk in chunks(removed):
+            db.session.execute(delete(JsonFile.__table__).where(JsonFile.path.in_(chunk)))
+        db.session.commit()
+
+    if not changed:
+        logger.info("No new or changed JSON files")
+        return 0
+
+    logger.info(f"Syncing {len(changed)} new or changed JSON files")
+    started = time.perf_counter()
+    processed = 0
+    rows = []
+    tag_maps = {}
+    watermarks = []
+
+    try:
+        with tqdm(total=len(changed), desc="Syncing metadata", unit="files") as bar:
+            for done, (filename, mtime, size, row, tag_map, error) in enumerate(parse_json_files(path, changed), 1):
+                mark = {'path': filename, 'mtime': mtime, 'size': size, 'image_id': None,
+                        'synced_at': datetime.now()}
+                if error:
+                    logger.error(f"Error processing {filename}: {error}")
+                else:
+                    row = dict(zip(IMAGE_COLUMNS, row))
+                    mark['image_id'] = row['id']
+                    rows.append(row)
+                    tag_maps[row['id']] = tag_map
+                watermarks.append(mark)
+                bar.update(1)
+
+                if len(watermarks) >= transaction_size:
+                    processed += write_batch(rows, watermarks, tag_maps)
+                    rows, tag_maps, watermarks = [], {}, []
+                    bar.set_postfix(rows_per_sec=int(processed / (time.perf_counter() - started)))
+                if progress:
+                    progress(done, len(changed))
+
+            if watermarks:
+                processed += write_batch(rows, watermarks, tag_maps)
+    finally:
+        # Publish whatever was committed, also when the sync was stopped part way
+        elapsed = time.perf_counter() - started
+        logger.info(f"Processed {processed}/{len(changed)} files in {elapsed:.1f}s "
+                    f"({processed / elapsed if elapsed else 0:.0f} rows/sec)")
+        record_job('ingest', elapsed, processed)
+
+        refresh_image_counts()
+        if processed:
+            # Posts synced after their thumbnail was made pick up its perceptual hash
+            backfill_phashes()
+            bump_generation()
+    return processed
@@ -0,0 +1,268 @@
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import select, update, delete
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = ('queued', 'running')
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested."""
+
+class JobPreempted(Exception):
+    """Raised inside a job when a job of higher priority is waiting; the job goes back in the queue."""
+
+class JobContext:
+    """Handed to a running job for reporting progress and noticing cancellation.
+
+    Progress is kept in memory for the status page and written to the
+    jobs table at most every ``progress_interval`` seconds. Writing
+    commits db.session, so jobs report at their own transaction
+    boundaries.
+    """
+
+    def __init__(self, job_id, kind, params, progress_interval, outranked_by=()):
+        self.job_id = job_id
+        self.kind = kind
+        self.params = params
+        self.progress_interval = progress_interval
+        # Kinds of job that preempt this one when queued
+        self.outranked_by = tuple(outranked_by)
+        self.done = 0
+        self.total = None
+        self.message = None
+        self.started = time.monotonic()
+        self._cancelled = threading.Event()
+        self._preempted = threading.Event()
+        self._saved_at = 0.0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def preempt(self):
+        self._preempted.set()
+
+    def progress(self, done, total=None, message=None):
+        """Report ``done`` of ``total`` units.
+
+        Raises JobCancelled once cancellation is requested, and
+        JobPreempted when a higher-priority job is waiting.
+        """
+        self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+        if time.monotonic() - self._saved_at >= self.progress_interval:
+            self.save()
+        if self.cancelled():
+            raise JobCancelled()
+        if self._preempted.is_set():
+            raise JobPreempted()
+
+    def save(self):
+        values = {'progress': self.done, 'total': self.total, 'message': self.message,
+                  'updated_at': datetime.now()}
+        db.session.execute(update(Job.__table__).where(Job.id == self.job_id).values(**values))
+        db.session.commit()
+        self._saved_at = time.monotonic()
+        # Cancellation and higher-priority jobs may also come from another process through the table
+        if db.session.execute(select(Job.cancel_requested).where(Job.id == self.job_id)).scalar():
+            self._cancelled.set()
+        if self.outranked_by and db.session.execute(
+            select(Job.id).where(Job.status == 'queued', Job.kind.in_(self.outranked_by)).limit(1)
+        ).scalar() is not None:
+            self._preempted.set()
+
+    def eta(self):
+        """Seconds left at the rate so far, or None while it cannot be estimated."""
+        if not self.total or not self.done:
+            return None
+        elapsed = time.monotonic() - self.started
+        return max(0.0, elapsed / self.done * (self.total - self.done))
+
+class JobRunner:
+    """Runs queued jobs one at a time on a background thread.
+
+    Jobs live in the jobs table, so the queue and history survive
+    restarts. A job left running by a process that died is queued again
+    on start; handlers resume from the work they already committed (the
+    ingest watermarks, the thumbnail manifest). One worker keeps SQLite
+    to a single writer; run the jobs in one process per database.
+
+    Queued jobs run highest priority first. A job of higher priority
+    preempts a running one at its next progress() call, and the
+    preempted job is queued again behind it.
+    """
+
+    def __init__(self, app, progress_interval=2.0, history=100):
+        self.app = app
+        self.progress_interval = progress_interval
+        self.history = history
+        self.handlers = {}
+        self.priorities = {}
+        self._current = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def register(self, kind, handler, priority=0):
+        """Run ``handler(context)`` for jobs of ``kind``, before any queued job of lower ``priority``."""
+        self.handlers[kind] = handler
+        self.priorities[kind] = priority
+
+    def _outranking(self, kind):
+        """Kinds of job with a higher priority than ``kind``."""
+        priority = self.priorities.get(kind, 0)
+        return [other for other, p in self.priorities.items() if p > priority]
+
+    # ------------------------------------------------------------ queue
+
+    def submit(self, kind, params=None):
+        """Queue a job and return its id; an identical job already queued or running is reused."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job type: {kind}")
+        encoded = json.dumps(params or {}, sort_keys=True)
+        existing = db.session.execute(
+            select(Job.id).where(Job.kind == kind, Job.params == encoded, Job.status.in_(ACTIVE))
+        ).scalar()
+        if existing is not None:
+            return existing
+        job = Job(kind=kind, params=encoded, status='queued', created_at=datetime.now())
+        db.session.add(job)
+        db.session.commit()
+        current = self._current
+        if current is not None and kind in self._outranking(current.kind):
+            current.preempt()
+        self._wake.set()
+        return job.id
+
+    def cancel(self, job_id):
+        """Cancel a queued job at once, or ask a running one to stop. Returns False if it already finished."""
+        job = db.session.get(Job, job_id)
+        if job is None or job.status in FINISHED:
+            return False
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            job.finished_at = datetime.now()
+        job.cancel_requested = True
+        db.session.commit()
+        current = self._current
+        if current is not None and current.job_id == job_id:
+            current.cancel()
+        return True
+
+    def live(self, job_id):
+        """The in-memory context of the job this process is running, if it is ``job_id``."""
+        current = self._current
+        return current if current is not None and current.job_id == job_id else None
+
+    # ------------------------------------------------------------ worker
+
+    def start(self):
+        """Requeue jobs interrupted by a previous shutdown, prune old history and start the worker."""
+        with self.app.app_context():
+            db.session.execute(update(Job.__table__).where(Job.status == 'running')
+                               .values(status='queued', message='Resuming after restart'))
+            keep = select(Job.id).where(Job.status.in_(FINISHED)).order_by(Job.id.desc()).limit(self.history)
+            db.session.execute(delete(Job.__table__).where(Job.status.in_(FINISHED), Job.id.not_in(keep)))
+            db.session.commit()
+        self._thread = threading.Thread(target=self._loop, name='job-runner', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._current is not None:
+            self._current.cancel()
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    job = self._claim()
+                    if job is not None:
+                        self._run(job)
+                        continue
+            except Exception as e:
+                logger.error(f"Job runner error: {str(e)}")
+            self._wake.wait(timeout=5)
+            self._wake.clear()
+
+    def _claim(self):
+        """Mark the oldest queued job of the highest priority as running, or return None when the queue is empty."""
+        queued = db.session.execute(
+            select(Job.id, Job.kind).where(Job.status == 'queued').order_by(Job.id)
+        ).all()
+        if not queued:
+            return None
+        job_id = max(queued, key=lambda row: self.priorities.get(row.kind, 0)).id
+        now = datetime.now()
+        claimed = db.session.execute(
+            update(Job.__table__).where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', started_at=now, updated_at=now)
+        ).rowcount
+        db.session.commit()
+        return db.session.get(Job, job_id) if claimed else None
+
+    def _run(self, job):
+        context = JobContext(job.id, job.kind, json.loads(job.params or '{}'), self.progress_interval,
+                             outranked_by=self._outranking(job.kind))
+        handler = self.handlers.get(job.kind)
+        self._current = context
+        logger.info(f"Job {job.id} ({job.kind}) started")
+        status, error = 'succeeded', None
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job type: {job.kind}")
+            handler(context)
+        except JobCancelled:
+            status = 'cancelled'
+        except JobPreempted:
+            status = 'queued'
+            context.message = 'Paused for a higher-priority job'
+        except Exception as e:
+            db.session.rollback()
+            status, error = 'failed', str(e)
+            logger.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+        finally:
+            self._current = None
+
+        context.save()
+        db.session.execute(update(Job.__table__).where(Job.id == job.id).values(
+            status=status, error=error, finished_at=datetime.now() if status in FINISHED else None
+        ))
+        db.session.commit()
+        logger.info(f"Job {job.id} ({job.kind}) {'paused' if status == 'queued' else status}")
+
+def job_info(job, live=None):
+    """A job as a JSON-ready dict, with in-memory progress and an ETA while it runs."""
+    done, total, message = job.progress, job.total, job.message
+    eta = None
+    if live is not None:
+        done, total, message = live.done, live.total, live.message
+        eta = live.eta()
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'params': json.loads(job.params or '{}'),
+        'status': job.status,
+        'progress': done,
+        'total': total,
+        'percent': round(done * 100 / total, 1) if total else None,
+        'message': message,
+        'error': job.error,
+        'eta_seconds': round(eta) if eta is not None else None,
+        'cancel_requested': job.cancel_requested,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
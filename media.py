@@ -0,0 +1,99 @@
+import os
+import re
+import errno
+import shutil
+import logging
+from flask import send_from_directory
+from sqlalchemy import select
+from tqdm import tqdm
+from models import db, Image
+from settings import Settings
+from thumbnails import scan_images
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+# direct: serve from paths.source_images; the others populate static/images
+STORAGE_MODES = ('direct', 'hardlink', 'symlink', 'copy')
+
+MD5_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# One year, the conventional maximum for files that never change under their URL
+IMMUTABLE_MAX_AGE = 31536000
+
+def storage_mode():
+    mode = settings.get('paths', 'storage_mode', default='direct')
+    if mode not in STORAGE_MODES:
+        logger.warning(f"Unknown storage mode {mode!r}, serving originals directly")
+        return 'direct'
+    return mode
+
+def originals_dir(static_folder):
+    """Directory originals are served and thumbnailed from for the configured storage mode."""
+    if storage_mode() == 'direct':
+        return settings.get('paths', 'source_images')
+    return os.path.join(static_folder, settings.get('paths', 'images_folder', default='images'))
+
+def link_images(source_dir, images_dir, mode, filenames=None):
+    """Populate ``images_dir`` with originals it does not have yet.
+
+    ``mode`` is 'hardlink', 'symlink' or 'copy'. Hardlinks fall back to
+    symlinks when the two directories are on different filesystems.
+    ``filenames`` limits the check to those originals instead of listing
+    both directories. Returns the number of files added.
+    """
+    if filenames is None:
+        present = scan_images(images_dir)
+        missing = [name for name in scan_images(source_dir) if name not in present]
+    else:
+        missing = [name for name in filenames if not os.path.lexists(os.path.join(images_dir, name))]
+    if not missing:
+        return 0
+
+    added = 0
+    for filename in tqdm(missing, desc=f"Linking images ({mode})", unit="files"):
+        src_path = os.path.abspath(os.path.join(source_dir, filename))
+        dst_path = os.path.join(images_dir, filename)
+        try:
+            if mode == 'hardlink':
+                try:
+                    os.link(src_path, dst_path)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    logger.warning("Source and static folder are on different filesystems, using symlinks")
+                    mode = 'symlink'
+                    os.symlink(src_path, dst_path)
+            elif mode == 'symlink':
+                os.symlink(src_path, dst_path)
+            else:
+                shutil.copy2(src_path, dst_path)
+            added += 1
+        except OSError as e:
+            logger.error(f"Error linking {filename}: {str(e)}")
+    logger.info(f"Added {added} images to {images_dir}")
+    return added
+
+def resolve_original(filename):
+    """Map a request for ``<md5>`` or ``<md5>.<ext>`` to the stored file name.
+
+    Bare md5s are looked up through the unique images.md5 index, so no
+    directory listing is needed. Returns None for unknown md5s.
+    """
+    stem, ext = os.path.splitext(filename)
+    if ext or not MD5_PATTERN.match(stem):
+        return filename
+    file_ext = db.session.execute(select(Image.file_ext).where(Image.md5 == stem)).scalar()
+    return f'{stem}.{file_ext}' if file_ext else None
+
+def send_immutable(directory, filename, etag):
+    """Send a file whose URL always names the same content.
+
+    ``etag`` identifies that content (an md5 for originals). Conditional
+    requests get a 304 and Range requests a 206 from send_file.
+    """
+    response = send_from_directory(directory, filename, etag=etag, max_age=IMMUTABLE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,197 @@
+import time
+import logging
+import threading
+from collections import Counter as Tally
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+# Route label for SQL run outside a request: ingestion, thumbnail jobs, index builds
+BACKGROUND = 'background'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric with fixed label names, rendered in the Prometheus text format."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in values]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = self.header()
+        for key, (counts, total) in values:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", _number(bound))])} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {counts[-1]}')
+        return lines
+
+REGISTRY = []
+
+REQUESTS = Counter('booru_http_requests_total', 'HTTP requests handled.', ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('booru_http_request_duration_seconds', 'Time to produce a response.',
+                            (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), ('route',))
+SLOW_REQUESTS = Counter('booru_http_slow_requests_total', 'Requests slower than metrics.slow_request_ms.',
+                        ('route',))
+SQL_QUERIES = Counter('booru_sql_queries_total', 'SQL statements executed.', ('route',))
+SQL_SECONDS = Counter('booru_sql_query_seconds_total', 'Time spent executing SQL statements.', ('route',))
+QUERIES_PER_REQUEST = Histogram('booru_sql_queries_per_request', 'SQL statements executed per request.',
+                                (0, 1, 2, 5, 10, 20, 50, 100, 250), ('route',))
+JOB_SECONDS = Histogram('booru_job_duration_seconds', 'Duration of ingestion and thumbnail batches.',
+                        (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600), ('job',))
+JOB_ITEMS = Counter('booru_job_items_total', 'Posts or thumbnails processed by background jobs.', ('job',))
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format."""
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+def record_job(job, seconds, items=0):
+    """Record one run of an ingestion or thumbnail batch."""
+    JOB_SECONDS.observe(seconds, job=job)
+    if items:
+        JOB_ITEMS.inc(items, job=job)
+
+class RequestStats:
+    """Statements run while handling one request, kept for the slow-request log."""
+
+    MAX_STATEMENTS = 1000
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = []
+
+    def add(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        if len(self.statements) < self.MAX_STATEMENTS:
+            self.statements.append((seconds, statement))
+
+def _current_stats():
+    return g.get('request_metrics') if has_request_context() else None
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    stats = _current_stats()
+    route = stats.route if stats else BACKGROUND
+    SQL_QUERIES.inc(route=route)
+    SQL_SECONDS.inc(seconds, route=route)
+    if stats:
+        stats.add(statement, seconds)
+
+def _one_line(statement, limit=500):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+def log_slow_request(stats, elapsed, status):
+    """Log a slow request with its slowest statements and any statement repeated enough to be an N+1 loop."""
+    limit = settings.get('metrics', 'slow_query_limit', default=5)
+    repeat_threshold = settings.get('metrics', 'repeated_query_threshold', default=10)
+    lines = [f"Slow request {request.method} {request.full_path.rstrip('?')} ({stats.route}, {status}): "
+             f"{elapsed * 1000:.0f} ms, {stats.queries} queries, {stats.sql_seconds * 1000:.0f} ms in SQL"]
+    for seconds, statement in sorted(stats.statements, key=lambda item: -item[0])[:limit]:
+        lines.append(f"  {seconds * 1000:8.1f} ms  {_one_line(statement)}")
+    repeated = Tally(statement for _, statement in stats.statements)
+    for statement, count in repeated.most_common(limit):
+        if count < repeat_threshold:
+            break
+        lines.append(f"  repeated {count}x  {_one_line(statement)}")
+    logger.warning('\n'.join(lines))
+
+_listening = False
+
+def init_metrics(app):
+    """Time every request and count its SQL, split by route."""
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+    @app.before_request
+    def start_request_metrics():
+        # The URL rule, not the path, so /image/<int:image_id> is one series
+        g.request_metrics = RequestStats(request.url_rule.rule if request.url_rule else 'unmatched')
+
+    @app.after_request
+    def record_request_metrics(response):
+        stats = g.pop('request_metrics', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        REQUESTS.inc(route=stats.route, method=request.method, status=response.status_code)
+        REQUEST_SECONDS.observe(elapsed, route=stats.route)
+        QUERIES_PER_REQUEST.observe(stats.queries, route=stats.route)
+        if elapsed * 1000 >= settings.get('metrics', 'slow_request_ms', default=500):
+            SLOW_REQUESTS.inc(route=stats.route)
+            log_slow_request(stats, elapsed, response.status_code)
+        return response
@@ -0,0 +1,99 @@
+import logging
+from sqlalchemy import text
+from models import db, Image
+from settings import Settings
+from pagination import SORT_COLUMNS
+from fts import create_fts_if_supported
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+def _create_missing_indexes(connection, *tables):
+    for table in tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+def _listing_indexes(connection):
+    _create_missing_indexes(connection, Image.__table__)
+    connection.exec_driver_sql('ANALYZE images')
+
+def _add_column(connection, table, column, definition):
+    columns = {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _perceptual_hashes(connection):
+    _add_column(connection, 'images', 'phash', 'BIGINT')
+    _add_column(connection, 'thumbnail_manifest', 'phash', 'BIGINT')
+    _create_missing_indexes(connection, Image.__table__)
+
+def _drop_phash_index(connection):
+    # Similar-image lookups scan every hash in memory; nothing filtered or sorted on phash
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_images_phash')
+
+# (version, description, upgrade(connection)). Append only; each step must be
+# safe to re-run, since SQLite DDL is not reliably rolled back on failure.
+MIGRATIONS = [
+    (1, 'Listing indexes on images', _listing_indexes),
+    (2, 'Full-text index over image tags', create_fts_if_supported),
+    (3, 'Perceptual hashes on images and thumbnails', _perceptual_hashes),
+    (4, 'Drop the unused phash index', _drop_phash_index),
+]
+
+def schema_version(connection):
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+def migrate():
+    """Apply pending migrations, tracking the schema version in PRAGMA user_version.
+
+    Tables that do not exist yet come from db.create_all(); migrations only
+    evolve existing databases. Returns the number of steps applied.
+    """
+    applied = 0
+    with db.engine.connect() as connection:
+        version = schema_version(connection)
+        for target, description, upgrade in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Migrating database to version {target}: {description}")
+            upgrade(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version = {int(target)}')
+            connection.commit()
+            applied += 1
+    return applied
+
+def listing_queries():
+    """Yield (sort_by, sort_order, query) for each gallery listing shape the app runs."""
+    filtered = Image.query
+    if settings.get('filters', 'exclude_deleted'):
+        filtered = filtered.filter(Image.is_deleted == False)
+    if settings.get('filters', 'exclude_banned'):
+        filtered = filtered.filter(Image.is_banned == False)
+    for sort_by in SORT_COLUMNS:
+        column = getattr(Image, sort_by)
+        for sort_order in ('asc', 'desc'):
+            if sort_order == 'desc':
+                ordered = filtered.order_by(column.desc(), Image.id.desc())
+            else:
+                ordered = filtered.order_by(column.asc(), Image.id.asc())
+            yield sort_by, sort_order, ordered.limit(24)
+
+def check_query_plans():
+    """Warn about listing queries that SQLite would answer with a table scan or a sort.
+
+    Returns the labels of the queries with a bad plan.
+    """
+    dialect = db.engine.dialect
+    bad = []
+    for sort_by, sort_order, query in listing_queries():
+        label = f'{sort_by} {sort_order}'
+        sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+        # A plain scan is in rowid order, so it stops early when sorting by id
+        table_scan = sort_by != 'id' and any(step.startswith('SCAN') and 'INDEX' not in step for step in plan)
+        temp_sort = any('TEMP B-TREE' in step for step in plan)
+        if table_scan or temp_sort:
+            logger.warning(f"Listing query ({label}) is not index-ordered: {'; '.join(plan)}")
+            bad.append(label)
+    return bad
@@ -1,9 +1,77 @@
+import sqlite3
+from flask import request, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, deferred
+from sqlalchemy.pool import Pool
+from settings import Settings
 
 db = SQLAlchemy()
 
+settings = Settings()
+
+# Applied to every new SQLite connection; database.pragmas in settings.json overrides single keys
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'memory',
+    # Milliseconds to wait for another connection's write lock before failing with "database is locked"
+    'busy_timeout': 5000,
+}
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply the SQLite tuning profile to a new connection."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    pragmas = dict(SQLITE_PRAGMAS, **(settings.get('database', 'pragmas', default={})))
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+# Requests with these methods only read; their connections refuse writes
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+def _query_only_for_reads(session, transaction, connection):
+    if has_request_context() and request.method in READ_ONLY_METHODS:
+        connection.exec_driver_sql('PRAGMA query_only = ON')
+        connection.info['query_only'] = True
+
+def _restore_writes(dbapi_connection, connection_record):
+    # Back in the pool the connection may serve a job or a POST next
+    if connection_record.info.pop('query_only', False) and dbapi_connection is not None:
+        dbapi_connection.execute('PRAGMA query_only = OFF')
+
+_read_only_requests = False
+
+def init_read_only_requests():
+    """Run GET and HEAD requests on query_only connections, so a read route can never write or take the write lock."""
+    global _read_only_requests
+    if not _read_only_requests:
+        event.listen(Session, 'after_begin', _query_only_for_reads)
+        event.listen(Pool, 'checkin', _restore_writes)
+        _read_only_requests = True
+
+# Deferred Image columns: the long text only the single-image view needs, loaded there with
+# undefer_group(DETAIL_COLUMNS) and skipped by every other ORM query
+DETAIL_COLUMNS = 'details'
+
 class Image(db.Model):
     __tablename__ = 'images'
+    __table_args__ = (
+        # Listing order for every gallery sort column, with and without the deleted/banned filters
+        db.Index('ix_images_visible_id', 'is_deleted', 'is_banned', 'id'),
+        db.Index('ix_images_visible_score', 'is_deleted', 'is_banned', 'score', 'id'),
+        db.Index('ix_images_visible_created_at', 'is_deleted', 'is_banned', 'created_at', 'id'),
+        db.Index('ix_images_visible_fav_count', 'is_deleted', 'is_banned', 'fav_count', 'id'),
+        db.Index('ix_images_score', 'score', 'id'),
+        db.Index('ix_images_created_at', 'created_at', 'id'),
+        db.Index('ix_images_fav_count', 'fav_count', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, nullable=False)
@@ -11,7 +79,7 @@ class Image(db.Model):
     up_score = db.Column(db.Integer, default=0)
     down_score = db.Column(db.Integer, default=0)
     score = db.Column(db.Integer, default=0)
-    source = db.Column(db.String(255), nullable=True)
+    source = deferred(db.Column(db.String(255), nullable=True), group=DETAIL_COLUMNS)
     md5 = db.Column(db.String(32), unique=True, nullable=False)
     rating = db.Column(db.String(16), nullable=True)
     is_pending = db.Column(db.Boolean, default=False)
@@ -22,7 +90,7 @@ class Image(db.Model):
     last_noted_at = db.Column(db.DateTime, nullable=True)
     last_comment_bumped_at = db.Column(db.DateTime, nullable=True)
     fav_count = db.Column(db.Integer, default=0)
-    tag_string = db.Column(db.Text, nullable=False)
+    tag_string = deferred(db.Column(db.Text, nullable=False), group=DETAIL_COLUMNS)
     tag_count = db.Column(db.Integer, default=0)
     tag_count_general = db.Column(db.Integer, default=0)
     tag_count_artist = db.Column(db.Integer, default=0)
@@ -43,16 +111,99 @@ class Image(db.Model):
     has_large = db.Column(db.Boolean, default=False)
     has_visible_children = db.Column(db.Boolean, default=False)
     media_asset_id = db.Column(db.Integer, nullable=True)
-    file_url = db.Column(db.String(512), nullable=False)
-    large_file_url = db.Column(db.String(512), nullable=True)
-    preview_file_url = db.Column(db.String(512), nullable=True)
-    tags_general = db.Column(db.Text, nullable=True)
-    tags_artist = db.Column(db.Text, nullable=True)
-    tags_character = db.Column(db.Text, nullable=True)
-    tags_copyright = db.Column(db.Text, nullable=True)
-    tags_meta = db.Column(db.Text, nullable=True)
+    file_url = deferred(db.Column(db.String(512), nullable=False), group=DETAIL_COLUMNS)
+    large_file_url = deferred(db.Column(db.String(512), nullable=True), group=DETAIL_COLUMNS)
+    preview_file_url = deferred(db.Column(db.String(512), nullable=True), group=DETAIL_COLUMNS)
+    tags_general = deferred(db.Column(db.Text, nullable=True), group=DETAIL_COLUMNS)
+    tags_artist = deferred(db.Column(db.Text, nullable=True), group=DETAIL_COLUMNS)
+    tags_character = deferred(db.Column(db.Text, nullable=True), group=DETAIL_COLUMNS)
+    tags_copyright = deferred(db.Column(db.Text, nullable=True), group=DETAIL_COLUMNS)
+    tags_meta = deferred(db.Column(db.Text, nullable=True), group=DETAIL_COLUMNS)
+    # 64-bit perceptual hash (dHash) of the image, stored signed; set by the thumbnail pipeline
+    phash = db.Column(db.BigInteger, nullable=True)
     pass
 
+class Tag(db.Model):
+    __tablename__ = 'tags'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), unique=True, nullable=False)
+    category = db.Column(db.String(16), nullable=False, default='general')
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+
+class ImageTag(db.Model):
+    __tablename__ = 'image_tags'
+    __table_args__ = (
+        db.Index('ix_image_tags_tag_id_image_id', 'tag_id', 'image_id'),
+        {'sqlite_with_rowid': False},
+    )
+
+    image_id = db.Column(db.Integer, db.ForeignKey('images.id'), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
+
+class TagCount(db.Model):
+    __tablename__ = 'tag_counts'
+    __table_args__ = (
+        db.Index('ix_tag_counts_filter_count', 'exclude_deleted', 'exclude_banned', 'count'),
+        db.Index('ix_tag_counts_filter_category_count', 'exclude_deleted', 'exclude_banned', 'category', 'count'),
+        {'sqlite_with_rowid': False},
+    )
+
+    # One row per tag and filters.exclude_deleted/exclude_banned combination
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
+    exclude_deleted = db.Column(db.Boolean, primary_key=True)
+    exclude_banned = db.Column(db.Boolean, primary_key=True)
+    category = db.Column(db.String(16), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class Stat(db.Model):
+    __tablename__ = 'stats'
+
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class JsonFile(db.Model):
+    __tablename__ = 'json_files'
+
+    # Sync watermark for one gallery-dl sidecar file
+    path = db.Column(db.String(1024), primary_key=True)
+    mtime = db.Column(db.Float, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    image_id = db.Column(db.Integer, nullable=True)
+    synced_at = db.Column(db.DateTime, nullable=False)
+
+class ThumbnailManifest(db.Model):
+    __tablename__ = 'thumbnail_manifest'
+
+    # Source image a thumbnail was generated from, and the settings used
+    filename = db.Column(db.String(512), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    settings_hash = db.Column(db.String(16), nullable=False)
+    generated_at = db.Column(db.DateTime, nullable=False)
+    phash = db.Column(db.BigInteger, nullable=True)
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_id', 'status', 'id'),
+    )
+
+    # One run of a background task (ingest, thumbnails); see jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    message = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
 def init_db(app):
     with app.app_context():
         db.create_all()
\ No newline at end of file
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from pagination import keyset_neighbors
+
+class NeighborIndex:
+    """Cached windows of the ordered result list around recently viewed images.
+
+    Each navigation context (sort order, filters and search) keeps one
+    window of (id, md5) pairs. Stepping through images reuses the window
+    until the walk gets close to one of its ends, so most views resolve
+    prev/next without touching the database.
+    """
+
+    def __init__(self, window=50, max_contexts=128):
+        self.window = window
+        self.max_contexts = max_contexts
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def neighbors(self, context, make_query, sort_by, sort_order, image, generation, prefetch=0):
+        """Return (prev_id, next_id, upcoming) for ``image`` within a context.
+
+        ``upcoming`` holds up to ``prefetch`` (id, md5) pairs following the
+        image. ``make_query`` builds the context's Image query; it is only
+        called when the cached window does not cover the image.
+        """
+        key = (context, sort_by, sort_order)
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is not None:
+                self._windows.move_to_end(key)
+        found = self._lookup(entry, image.id, generation, prefetch)
+        if found is None:
+            before, after = keyset_neighbors(make_query(), sort_by, sort_order, image, self.window)
+            entry = {
+                'generation': generation,
+                'ids': before + [(image.id, image.md5)] + after,
+                'at_start': len(before) < self.window,
+                'at_end': len(after) < self.window,
+            }
+            entry['positions'] = {image_id: i for i, (image_id, _) in enumerate(entry['ids'])}
+            with self._lock:
+                self._windows[key] = entry
+                self._windows.move_to_end(key)
+                while len(self._windows) > self.max_contexts:
+                    self._windows.popitem(last=False)
+            found = self._lookup(entry, image.id, generation, prefetch)
+        return found
+
+    def _lookup(self, entry, image_id, generation, prefetch):
+        if entry is None or entry['generation'] != generation:
+            return None
+        i = entry['positions'].get(image_id)
+        if i is None:
+            return None
+        ids = entry['ids']
+        # Refill before running off an edge that is not the real end of the list
+        if (i == 0 and not entry['at_start']) or (i + max(prefetch, 1) >= len(ids) and not entry['at_end']):
+            return None
+        prev_id = ids[i - 1][0] if i > 0 else None
+        next_id = ids[i + 1][0] if i + 1 < len(ids) else None
+        return prev_id, next_id, ids[i + 1:i + 1 + prefetch]
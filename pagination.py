@@ -0,0 +1,161 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import tuple_
+from models import Image
+
+SORT_COLUMNS = ('id', 'score', 'created_at', 'fav_count')
+
+# What a thumbnail grid renders, plus every keyset sort column so rows can become cursors
+LISTING_COLUMNS = ('id', 'md5', 'file_ext', 'image_width', 'image_height', 'score', 'fav_count', 'created_at')
+
+ListingRow = namedtuple('ListingRow', LISTING_COLUMNS)
+
+def listing_query(query, columns=LISTING_COLUMNS):
+    """Narrow an Image query to ``columns``."""
+    return query.with_entities(*(getattr(Image, name) for name in columns))
+
+def listing_rows(rows):
+    """Convert result rows of a listing_query to ListingRow tuples."""
+    return [ListingRow._make(row) for row in rows]
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict) and 'dt' in value:
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+def encode_cursor(sort_by, image, direction):
+    """Build an opaque cursor pointing just past ``image`` in the given direction."""
+    payload = {
+        's': sort_by,
+        'v': _encode_value(getattr(image, sort_by)),
+        'id': image.id,
+        'd': direction
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor into (sort_by, value, id, direction).
+
+    Raises InvalidCursor unless the value has the sort column's type, so a
+    tampered cursor never reaches a comparison.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        sort_by, value, direction = payload['s'], _decode_value(payload['v']), payload['d']
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        if sort_by not in SORT_COLUMNS:
+            raise ValueError(sort_by)
+        expected = datetime if sort_by == 'created_at' else int
+        if value is not None and (not isinstance(value, expected) or isinstance(value, bool)):
+            raise ValueError(value)
+        return sort_by, value, int(payload['id']), direction
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(str(e))
+
+class KeysetPage:
+    """A page of results addressed by cursors instead of an offset."""
+
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+def keyset_paginate(query, sort_by, sort_order, per_page, cursor=None, total=None, columns=None):
+    """Return a KeysetPage of ListingRow items from ``query`` ordered by (sort_by, id).
+
+    The query must not be ordered yet. Each page is a single indexed range
+    scan, so deep pages cost the same as the first one. With ``columns``
+    the items are result rows of just those columns, which must include
+    id and the sort column.
+    """
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'id'
+    column = getattr(Image, sort_by)
+    descending = sort_order == 'desc'
+
+    direction = 'next'
+    if cursor:
+        cursor_sort, value, last_id, direction = decode_cursor(cursor)
+        if cursor_sort != sort_by:
+            # Sort settings changed since the cursor was issued; start over
+            cursor, direction = None, 'next'
+        else:
+            key = tuple_(column, Image.id)
+            # Walking backwards flips both the comparison and the order
+            if descending == (direction == 'next'):
+                query = query.filter(key < tuple_(value, last_id))
+            else:
+                query = query.filter(key > tuple_(value, last_id))
+
+    if descending == (direction == 'next'):
+        query = query.order_by(column.desc(), Image.id.desc())
+    else:
+        query = query.order_by(column.asc(), Image.id.asc())
+
+    if columns is None:
+        items = listing_rows(listing_query(query).limit(per_page + 1))
+    else:
+        items = listing_query(query, columns).limit(per_page + 1).all()
+    return keyset_page(items, sort_by, per_page, direction, cursor is not None, total)
+
+def keyset_page(items, sort_by, per_page, direction, from_cursor, total=None):
+    """Build a KeysetPage from up to ``per_page + 1`` rows fetched in walking order."""
+    has_more = len(items) > per_page
+    items = items[:per_page]
+
+    if direction == 'prev':
+        items.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = from_cursor, has_more
+
+    next_cursor = encode_cursor(sort_by, items[-1], 'next') if items and has_next else None
+    prev_cursor = encode_cursor(sort_by, items[0], 'prev') if items and has_prev else None
+    return KeysetPage(items, next_cursor, prev_cursor, total)
+
+def keyset_neighbors(query, sort_by, sort_order, image, limit):
+    """Return (before, after): up to ``limit`` (id, md5) pairs on each side of ``image``.
+
+    Both lists are in display order, so ``before[-1]`` is the previous
+    image and ``after[0]`` the next one.
+    """
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'id'
+    column = getattr(Image, sort_by)
+    key = tuple_(column, Image.id)
+    value = tuple_(getattr(image, sort_by), image.id)
+    query = query.with_entities(Image.id, Image.md5)
+
+    forward = (column.desc(), Image.id.desc())
+    backward = (column.asc(), Image.id.asc())
+    if sort_order != 'desc':
+        forward, backward = backward, forward
+    ahead = key < value if sort_order == 'desc' else key > value
+    behind = key > value if sort_order == 'desc' else key < value
+
+    after = query.filter(ahead).order_by(*forward).limit(limit).all()
+    before = query.filter(behind).order_by(*backward).limit(limit).all()
+    before.reverse()
+    return [tuple(row) for row in before], [tuple(row) for row in after]
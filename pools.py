@@ -0,0 +1,19 @@
+from multiprocessing import get_context
+from settings import Settings
+
+settings = Settings()
+
+# The server runs request, job, watcher and thumbnail threads; a forked worker
+# would inherit whatever locks they held at that moment (logging, SQLite,
+# ImageMagick) and could hang on them. Spawned workers start from a clean
+# interpreter instead.
+_context = get_context('spawn')
+
+def _init_worker(values):
+    # Carry over changes made with save=False, which a fresh process would not see in settings.json
+    for key, value in values.items():
+        settings.set(value, key, save=False)
+
+def process_pool(processes):
+    """A multiprocessing pool of ``processes`` spawned workers sharing this process's settings."""
+    return _context.Pool(processes=processes, initializer=_init_worker, initargs=(settings.get(),))
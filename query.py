@@ -0,0 +1,375 @@
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_, or_, not_, false
+from models import Image, Tag, ImageTag
+from settings import Settings
+from tags import TAG_CATEGORIES, normalize_tag, filter_by_tags
+from pagination import SORT_COLUMNS
+from fts import fts_available, fts_prefix, fts_phrase, fts_condition
+
+settings = Settings()
+
+class QueryError(ValueError):
+    """Raised for search queries that are malformed or would match without bound."""
+
+# AST nodes
+TagTerm = namedtuple('TagTerm', 'name category')
+Wildcard = namedtuple('Wildcard', 'prefix category')
+Phrase = namedtuple('Phrase', 'words category')
+Meta = namedtuple('Meta', 'name value')
+Not = namedtuple('Not', 'child')
+And = namedtuple('And', 'children')
+Or = namedtuple('Or', 'children')
+
+NUMERIC_METATAGS = {
+    'id': Image.id,
+    'score': Image.score,
+    'favcount': Image.fav_count,
+    'fav_count': Image.fav_count,
+    'width': Image.image_width,
+    'height': Image.image_height,
+    'filesize': Image.file_size,
+    'tagcount': Image.tag_count,
+}
+TEXT_METATAGS = {
+    'md5': Image.md5,
+    'filetype': Image.file_ext,
+    'ext': Image.file_ext,
+}
+ORDER_ALIASES = {'favcount': 'fav_count', 'date': 'created_at', 'created': 'created_at'}
+METATAGS = set(NUMERIC_METATAGS) | set(TEXT_METATAGS) | set(TAG_CATEGORIES) | {'rating', 'date', 'order'}
+
+RANGE_PATTERN = re.compile(r'^(?P<op>>=|<=|>|<|=)?(?P<value>[^.]*)$')
+
+# ---------------------------------------------------------------- parsing
+
+def _is_metatag(word):
+    name, sep, value = word.partition(':')
+    return bool(sep and value) and name.lower() in METATAGS and name.lower() not in TAG_CATEGORIES
+
+def tokenize(text):
+    """Split a query into tokens: '(', ')', '-', '~', 'or' and terms.
+
+    Terms are separated by whitespace. Commas also separate tags (the old
+    search syntax) except inside metatag values such as ``rating:s,q``.
+    Parentheses only group at the edges of a word, so tags such as
+    ``saber_(fate)`` stay intact.
+    """
+    tokens = []
+    for chunk in re.findall(r'"[^"]*"?|\S+', text):
+        if chunk.startswith('"'):
+            tokens.append(('term', chunk))
+            continue
+        for word in ([chunk] if _is_metatag(chunk.lstrip('-~(')) else chunk.split(',')):
+            while len(word) > 1 and word[0] in '-~(':
+                tokens.append((word[0], word[0]))
+                word = word[1:]
+            closers = 0
+            while word.endswith(')') and word.count(')') > word.count('('):
+                word = word[:-1]
+                closers += 1
+            if word == '(':
+                tokens.append(('(', '('))
+            elif word.lower() == 'or':
+                tokens.append(('or', 'or'))
+            elif word:
+                tokens.append(('term', word))
+            tokens.extend([(')', ')')] * closers)
+    return tokens
+
+def parse_term(word):
+    """Turn one term into a TagTerm, Wildcard, Phrase or Meta node."""
+    category = None
+    name, sep, value = word.partition(':')
+    name = name.lower()
+    if sep and value and name in METATAGS:
+        if name not in TAG_CATEGORIES:
+            return Meta(name, value)
+        category, word = name, value
+
+    if word.startswith('"'):
+        words = [normalize_tag(w) for w in word.strip('"').split()]
+        words = [w for w in words if w]
+        if not words:
+            raise QueryError('Empty quoted phrase')
+        return Phrase(tuple(words), category)
+    if '*' in word:
+        prefix = normalize_tag(word[:-1])
+        if not word.endswith('*') or '*' in word[:-1]:
+            raise QueryError(f"Only trailing wildcards are supported: {word}")
+        if len(prefix) < settings.get('search', 'min_wildcard_prefix', default=2):
+            raise QueryError(f"Wildcard {word} is too broad; type a few more characters before the *")
+        return Wildcard(prefix, category)
+    name = normalize_tag(word)
+    if not name:
+        raise QueryError(f"Empty tag in {word!r}")
+    return TagTerm(name, category)
+
+class _Parser:
+    """Recursive descent over the token list.
+
+    expr  := and ('or' and)*
+    and   := ('~'? unary)+   (the ~ terms of one and form a single OR group)
+    unary := '-' unary | '(' expr ')' | term
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expr(self):
+        children = [self.conjunction()]
+        while self.peek() == 'or':
+            self.take()
+            children.append(self.conjunction())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def conjunction(self):
+        children, either = [], []
+        while self.peek() not in (None, ')', 'or'):
+            if self.peek() == '~':
+                self.take()
+                either.append(self.unary())
+            else:
+                children.append(self.unary())
+        if either:
+            children.append(either[0] if len(either) == 1 else Or(tuple(either)))
+        if not children:
+            raise QueryError('Expected a tag')
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def unary(self):
+        kind = self.peek()
+        if kind == '-':
+            self.take()
+            return Not(self.unary())
+        if kind == '~':
+            raise QueryError('~ can only prefix a term inside a group')
+        if kind == '(':
+            self.take()
+            node = self.expr()
+            if self.peek() != ')':
+                raise QueryError('Missing closing parenthesis')
+            self.take()
+            return node
+        if kind == 'term':
+            return parse_term(self.take()[1])
+        raise QueryError(f"Unexpected {self.tokens[self.pos][1]!r}")
+
+def parse_query(text):
+    """Parse a booru-style query into an AST."""
+    tokens = tokenize(text)
+    if not tokens:
+        raise QueryError('Empty query')
+    parser = _Parser(tokens)
+    node = parser.expr()
+    if parser.pos != len(tokens):
+        raise QueryError(f"Unexpected {tokens[parser.pos][1]!r}")
+    return node
+
+# ---------------------------------------------------------------- compiling
+
+def walk(node):
+    yield node
+    if isinstance(node, (And, Or)):
+        for child in node.children:
+            yield from walk(child)
+    elif isinstance(node, Not):
+        yield from walk(node.child)
+
+def _parse_number(value, column):
+    if column is Image.created_at:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise QueryError(f"Invalid date {value!r}, use YYYY-MM-DD")
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryError(f"Invalid number {value!r}")
+
+def range_condition(column, value):
+    """Compile ``>5``, ``<=5``, ``5..10``, ``5..``, ``1,2,3`` or ``5`` against a column."""
+    if '..' in value:
+        low, _, high = value.partition('..')
+        conditions = []
+        if low:
+            conditions.append(column >= _parse_number(low, column))
+        if high:
+            conditions.append(column <= _parse_number(high, column))
+        if not conditions:
+            raise QueryError(f"Empty range {value!r}")
+        return and_(*conditions)
+    if ',' in value:
+        return column.in_([_parse_number(v, column) for v in value.split(',') if v])
+    match = RANGE_PATTERN.match(value)
+    if not match:
+        raise QueryError(f"Invalid value {value!r}")
+    op, number = match.group('op') or '=', _parse_number(match.group('value'), column)
+    if column is Image.created_at and op == '=':
+        # A bare date means that whole day
+        return and_(column >= number, column < number + timedelta(days=1))
+    return {
+        '>': column > number, '>=': column >= number,
+        '<': column < number, '<=': column <= number, '=': column == number,
+    }[op]
+
+def parse_order(value):
+    """Map an order: metatag value to (sort_by, sort_order)."""
+    value = value.lower()
+    sort_order = 'desc'
+    for suffix in ('_asc', '_desc'):
+        if value.endswith(suffix):
+            value, sort_order = value[:-len(suffix)], suffix[1:]
+    sort_by = ORDER_ALIASES.get(value, value)
+    if sort_by not in SORT_COLUMNS:
+        raise QueryError(f"Cannot order by {value!r}; use one of {', '.join(SORT_COLUMNS)}")
+    return sort_by, sort_order
+
+def query_order(node):
+    """Return the (sort_by, sort_order) a query's top-level order: asks for, or (None, None)."""
+    top = node.children if isinstance(node, And) else [node]
+    orders = [n for n in top if isinstance(n, Meta) and n.name == 'order']
+    if len(orders) > 1:
+        raise QueryError('Only one order: is allowed')
+    return parse_order(orders[0].value) if orders else (None, None)
+
+class CompiledQuery:
+    """A parsed search applied to an Image query, plus any order: it asked for."""
+
+    def __init__(self, query, sort_by=None, sort_order=None):
+        self.query = query
+        self.sort_by = sort_by
+        self.sort_order = sort_order
+
+class _Compiler:
+    def __init__(self, tags, use_fts):
+        self.tags = tags
+        self.use_fts = use_fts
+
+    def tag(self, node):
+        tag = self.tags.get(node.name)
+        if tag is None or (node.category and tag.category != node.category):
+            return None
+        return tag
+
+    def cost(self, node):
+        """Rough evaluation order: indexed column checks, then rare tags, then the rest."""
+        if isinstance(node, Meta):
+            return (0, 0) if node.name in ('id', 'md5') else (1, 0)
+        if isinstance(node, TagTerm):
+            tag = self.tag(node)
+            return (2, tag.post_count if tag else 0)
+        if isinstance(node, (Wildcard, Phrase)):
+            return (4, 0)
+        if isinstance(node, Not):
+            return (5, 0)
+        return (3, 0)
+
+    def condition(self, node):
+        if isinstance(node, TagTerm):
+            tag = self.tag(node)
+            if tag is None:
+                # An unknown tag can never match
+                return false()
+            return Image.id.in_(select(ImageTag.image_id).where(ImageTag.tag_id == tag.id))
+        if isinstance(node, Wildcard):
+            if self.use_fts:
+                return fts_condition(fts_prefix(node.prefix, node.category))
+            names = select(Tag.id).where(Tag.name >= node.prefix, Tag.name < node.prefix + '\U0010ffff')
+            if node.category:
+                names = names.where(Tag.category == node.category)
+            return Image.id.in_(select(ImageTag.image_id).where(ImageTag.tag_id.in_(names)))
+        if isinstance(node, Phrase):
+            if self.use_fts:
+                return fts_condition(fts_phrase(node.words, node.category))
+            return and_(*(self.condition(TagTerm(word, node.category)) for word in node.words))
+        if isinstance(node, Meta):
+            return self.meta(node)
+        if isinstance(node, Not):
+            return not_(self.condition(node.child))
+        if isinstance(node, And):
+            return and_(*(self.condition(child) for child in sorted(node.children, key=self.cost)))
+        if isinstance(node, Or):
+            # All plain tags of an OR share one tag_id IN (...) lookup
+            tag_ids = [tag.id for tag in (self.tag(child) for child in node.children
+                                          if isinstance(child, TagTerm)) if tag]
+            conditions = [self.condition(child) for child in node.children if not isinstance(child, TagTerm)]
+            if tag_ids:
+                conditions.insert(0, Image.id.in_(
+                    select(ImageTag.image_id).where(ImageTag.tag_id.in_(tag_ids))
+                ))
+            return or_(*conditions) if conditions else false()
+        raise QueryError(f"Unsupported term {node!r}")
+
+    def meta(self, node):
+        if node.name == 'order':
+            raise QueryError('order: cannot be negated or used inside a group')
+        if node.name in NUMERIC_METATAGS:
+            return range_condition(NUMERIC_METATAGS[node.name], node.value)
+        if node.name == 'date':
+            return range_condition(Image.created_at, node.value)
+        if node.name == 'rating':
+            # rating:s, rating:safe and rating:s,q all work; only the first letter counts
+            ratings = [value[0].lower() for value in node.value.split(',') if value]
+            return Image.rating.in_(ratings)
+        column = TEXT_METATAGS[node.name]
+        return column.in_([value.lower().lstrip('.') for value in node.value.split(',') if value])
+
+def _bounded(node):
+    """Whether ``node`` narrows the search by itself, rather than only ruling posts out."""
+    if isinstance(node, Not):
+        return False
+    if isinstance(node, And):
+        return any(_bounded(child) for child in node.children)
+    if isinstance(node, Or):
+        return all(_bounded(child) for child in node.children)
+    return True
+
+def compile_query(query, node):
+    """Apply a parsed search to an Image query. Returns a CompiledQuery.
+
+    Plain tags at the top level become joins against image_tags, rarest
+    first, so SQLite starts from the smallest posting list. Everything else
+    becomes WHERE conditions ordered from cheapest to most expensive.
+
+    A search made only of negations (``-cat``, ``-a or -b``) would check
+    every post in the library, and is rejected with a QueryError; an
+    order: metatag on its own is plain browsing and is allowed.
+    """
+    nodes = list(walk(node))
+    max_terms = settings.get('search', 'max_terms', default=20)
+    terms = [n for n in nodes if isinstance(n, (TagTerm, Wildcard, Phrase, Meta))]
+    if len(terms) > max_terms:
+        raise QueryError(f"Too many terms ({len(terms)}); the limit is {max_terms}")
+
+    names = {n.name for n in nodes if isinstance(n, TagTerm)}
+    names.update(word for n in nodes if isinstance(n, Phrase) for word in n.words)
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names)).all()} if names else {}
+    compiler = _Compiler(tags, fts_available())
+
+    sort_by, sort_order = query_order(node)
+    top = [n for n in (node.children if isinstance(node, And) else [node])
+           if not (isinstance(n, Meta) and n.name == 'order')]
+    if not top:
+        return CompiledQuery(query, sort_by, sort_order)
+    if not any(_bounded(n) for n in top):
+        raise QueryError("A search needs at least one tag or metatag that is not negated")
+
+    joins = [compiler.tag(n) for n in top if isinstance(n, TagTerm)]
+    if None in joins:
+        # An unknown tag can never match
+        return CompiledQuery(query.filter(false()), sort_by, sort_order)
+    query = filter_by_tags(query, joins)
+    for other in sorted((n for n in top if not isinstance(n, TagTerm)), key=compiler.cost):
+        query = query.filter(compiler.condition(other))
+    return CompiledQuery(query, sort_by, sort_order)
@@ -0,0 +1,127 @@
+"""Production server: the app under waitress, threaded or pre-forked.
+
+    python serve.py                      # one process, server.threads threads
+    python serve.py --workers 4          # four forked processes sharing the socket (not on Windows)
+
+Each process primes its caches before it accepts connections. Background
+jobs and the download watcher run in the first process only.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+def warm_up(app):
+    """Load the in-process indexes and render the warm-up pages before the first real request.
+
+    Rendering fills the page cache, Jinja's template cache, SQLAlchemy's
+    statement cache and SQLite's page cache.
+    """
+    from cache import library_generation
+    started = time.perf_counter()
+    with app.app_context():
+        generation = library_generation()
+        app.extensions['autocomplete'].load(generation)
+        app.extensions['similar'].ensure(generation)
+        if 'tag_index' in app.extensions:
+            # Maps a saved index; a rebuild carries on in the background
+            app.extensions['tag_index'].ready(generation)
+    client = app.test_client()
+    for url in settings.get('server', 'warmup_urls', default=['/', '/gallery', '/tagcloud']):
+        status = client.get(url).status_code
+        if status >= 400:
+            logger.warning(f"Warm-up request {url} returned {status}")
+    logger.info(f"Warmed up in {time.perf_counter() - started:.1f}s")
+
+def create_app(background):
+    # Imported late: the app reads its settings at import time, after main() has applied overrides
+    from app import booru_webui
+    app = booru_webui(background=background)
+    warm_up(app)
+    return app
+
+def serve_threads(host, port, threads):
+    from waitress import serve
+    app = create_app(background=True)
+    logger.info(f"Serving on http://{host}:{port} with {threads} threads")
+    serve(app, host=host, port=port, threads=threads)
+
+def serve_workers(host, port, threads, workers):
+    """Fork ``workers`` processes that accept on one shared listening socket, restarting any that exit."""
+    if not hasattr(os, 'fork'):
+        raise SystemExit("Pre-fork mode needs os.fork; use --workers 1 on this platform")
+    listener = socket.create_server((host, port), backlog=1024)
+    logger.info(f"Serving on http://{host}:{port} with {workers} workers x {threads} threads")
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # Connections, pools and threads are created after the fork, never inherited
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            from waitress import serve
+            try:
+                serve(create_app(background=index == 0), sockets=[listener], threads=threads)
+            finally:
+                os._exit(0)
+        return pid
+
+    children = {spawn(index): index for index in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logger.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting")
+            time.sleep(1)
+            children[spawn(index)] = index
+    listener.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=settings.get('server', 'host', default='localhost'))
+    parser.add_argument('--port', type=int, default=settings.get('server', 'port', default=5000))
+    parser.add_argument('--threads', type=int, default=settings.get('server', 'threads', default=8),
+                        help='Request threads per process.')
+    parser.add_argument('--workers', type=int, default=settings.get('server', 'workers', default=1),
+                        help='Processes; more than one forks workers that share the socket.')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Never the debugger in production; size the pool to the request threads
+    settings.set(False, 'server', 'debug', save=False)
+    pool_size = max(args.threads, settings.get('database', 'pool_size', default=10))
+    settings.set(pool_size, 'database', 'pool_size', save=False)
+
+    if args.workers > 1:
+        serve_workers(args.host, args.port, args.threads, args.workers)
+    else:
+        serve_threads(args.host, args.port, args.threads)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -29,27 +29,105 @@ class Settings:
         default_settings = {
             "paths": {
                 "source_images": "D:\\Downloads\\gdl\\gallery-dl\\atfbooru\\id꞉1..10000",
-                "database": "booru.db"
+                "database": "booru.db",
+                "images_folder": "images",
+                "thumbnails_folder": "thumbnails",
+                "storage_mode": "direct"
             },
             "thumbnails": {
                 "width": 128,
                 "quality": 85,
-                "compression_level": 7
+                "compression_level": 7,
+                "sizes": [128, 256, 512],
+                "formats": ["webp", "jpeg"],
+                "mode": "lazy",
+                "workers": 2,
+                "prewarm": True
             },
             "gallery": {
                 "images_per_page": 24,
                 "sort_order": "desc",
-                "sort_by": "id"
+                "sort_by": "id",
+                "pagination": "keyset",
+                "neighbor_window": 50,
+                "prefetch": 3
             },
             "server": {
                 "host": "localhost",
                 "port": 5000,
-                "debug": True
+                "debug": True,
+                "threads": 8,
+                "workers": 1,
+                "warmup_urls": ["/", "/gallery", "/tagcloud"]
+            },
+            "database": {
+                "pool_size": 10,
+                "max_overflow": 10,
+                "pool_timeout": 30,
+                "read_only_requests": True
             },
             "processing": {
                 "batch_size": 1000,
+                "transaction_size": 10000,
                 "cpu_usage_percent": 75
             },
+            "ui": {
+                "default_theme": "light",
+                "tag_cloud_limit": 100,
+                "autocomplete_limit": 10
+            },
+            "search": {
+                "max_terms": 20,
+                "min_wildcard_prefix": 2
+            },
+            "tag_index": {
+                "enabled": False,
+                "path": "tag_index",
+                "rebuild_interval": 10.0
+            },
+            "similar": {
+                "max_distance": 10,
+                "limit": 48,
+                "duplicate_distance": 4
+            },
+            "sprites": {
+                "enabled": False,
+                "folder": "sprites",
+                "format": "webp",
+                "quality": 80,
+                "columns": 10,
+                "max_sheets": 2000
+            },
+            "api": {
+                "max_limit": 1000,
+                "export_batch_size": 1000
+            },
+            "watch": {
+                "enabled": False,
+                "backend": "auto",
+                "interval": 2.0,
+                "debounce": 1.0,
+                "max_delay": 5.0,
+                "pair_timeout": 30.0,
+                "batch_size": 100
+            },
+            "jobs": {
+                "sync_on_startup": True,
+                "progress_interval": 2.0,
+                "history": 100
+            },
+            "metrics": {
+                "enabled": True,
+                "slow_request_ms": 500,
+                "slow_query_limit": 5,
+                "repeated_query_threshold": 10
+            },
+            "cache": {
+                "enabled": True,
+                "max_entries": 256,
+                "disk_dir": None,
+                "check_interval": 1.0
+            },
             "filters": {
                 "exclude_deleted": True,
                 "exclude_banned": True,
@@ -67,22 +145,23 @@ class Settings:
         with open('settings.json', 'w') as f:
             json.dump(self._settings, f, indent=4)
     
-    def get(self, *keys):
+    def get(self, *keys, default=None):
         """Get a setting value using dot notation"""
         value = self._settings
         for key in keys:
             value = value.get(key)
             if value is None:
-                return None
+                return default
         return value
     
-    def set(self, value, *keys):
-        """Set a setting value using dot notation"""
+    def set(self, value, *keys, save=True):
+        """Set a setting value using dot notation; ``save=False`` changes it for this process only"""
         settings = self._settings
         for key in keys[:-1]:
             settings = settings.setdefault(key, {})
         settings[keys[-1]] = value
-        self.save()
+        if save:
+            self.save()
     
     def update(self, new_settings):
         """Update multiple settings at once"""
@@ -0,0 +1,232 @@
+import os
+import time
+import logging
+import threading
+from sqlalchemy import select, update, func, text, bindparam
+from models import db, Image
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+# dHash compares each pixel of a (HASH_WIDTH + 1) x HASH_HEIGHT greyscale image with its right neighbour
+HASH_WIDTH = 8
+HASH_HEIGHT = 8
+
+def dhash(pixels):
+    """64-bit difference hash of a 9x8 greyscale pixel grid, row-major.
+
+    Returned as a signed integer, which is what SQLite stores.
+    """
+    value = 0
+    row_length = HASH_WIDTH + 1
+    for y in range(HASH_HEIGHT):
+        row = pixels[y * row_length:(y + 1) * row_length]
+        for x in range(HASH_WIDTH):
+            value = (value << 1) | (row[x] < row[x + 1])
+    return value - (1 << HASH_BITS) if value >> (HASH_BITS - 1) else value
+
+def hamming(a, b):
+    return bin((a ^ b) & HASH_MASK).count('1')
+
+def record_phashes(hashes):
+    """Store {source filename: phash} on the images named by the filename's md5 (caller commits)."""
+    rows = [{'b_md5': os.path.splitext(filename)[0], 'b_phash': phash}
+            for filename, phash in hashes.items() if phash is not None]
+    if not rows:
+        return
+    images = Image.__table__
+    db.session.execute(
+        update(images).where(images.c.md5 == bindparam('b_md5')).values(phash=bindparam('b_phash')),
+        rows
+    )
+
+def backfill_phashes():
+    """Copy hashes from the thumbnail manifest to images ingested after their thumbnail was made."""
+    result = db.session.execute(text(
+        "UPDATE images SET phash = (SELECT phash FROM thumbnail_manifest "
+        "WHERE filename = images.md5 || '.' || images.file_ext) "
+        "WHERE phash IS NULL AND md5 || '.' || file_ext IN "
+        "(SELECT filename FROM thumbnail_manifest WHERE phash IS NOT NULL)"
+    ))
+    db.session.commit()
+    return result.rowcount
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance, for when NumPy is not installed.
+
+    Each node keeps its children by their distance to it, so by the
+    triangle inequality a radius search only descends into children whose
+    edge is within ``radius`` of the query's distance to the node.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, phash, image_id):
+        # Nodes are [phash, [image ids], {distance: child}]
+        if self.root is None:
+            self.root = [phash, [image_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(phash, node[0])
+            if distance == 0:
+                node[1].append(image_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [phash, [image_id], {}]
+                return
+            node = child
+
+    def search(self, phash, radius):
+        """Yield (image_id, distance) for every hash within ``radius`` of ``phash``."""
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(phash, node[0])
+            if distance <= radius:
+                for image_id in node[1]:
+                    yield image_id, distance
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+
+if np is not None:
+    # Set bits per byte value, for popcounts on NumPy versions without bitwise_count
+    POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _distances(hashes, phash):
+    """Hamming distances from ``phash`` to every uint64 in ``hashes``."""
+    xor = hashes ^ np.uint64(phash & HASH_MASK)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor)
+    return POPCOUNT[xor.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+class SimilarityIndex:
+    """In-memory Hamming-distance index over Image.phash.
+
+    With NumPy the hashes are one uint64 array and a lookup is a single
+    vectorized XOR and popcount; without it a BK-tree prunes the search.
+    The index is rebuilt when the library generation or the number of
+    hashed images changes, checked at most every ``check_interval`` seconds.
+    """
+
+    def __init__(self, check_interval=10.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._key = None
+        self._checked = 0.0
+        self._ids = None
+        self._hashes = None
+        self._tree = None
+
+    def _current_key(self, generation):
+        return generation, db.session.execute(select(func.count(Image.phash))).scalar()
+
+    def ensure(self, generation):
+        now = time.monotonic()
+        if self._key is not None and self._key[0] == generation and now - self._checked < self.check_interval:
+            return
+        key = self._current_key(generation)
+        self._checked = now
+        if key != self._key:
+            self.load(key)
+
+    def load(self, key):
+        rows = db.session.execute(
+            select(Image.id, Image.phash).where(Image.phash.isnot(None)).order_by(Image.id)
+        ).all()
+        if np is not None:
+            ids = np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows))
+            hashes = np.fromiter((row.phash for row in rows), dtype=np.int64, count=len(rows)).view(np.uint64)
+            tree = None
+        else:
+            ids = hashes = None
+            tree = BKTree()
+            for row in rows:
+                tree.add(row.phash, row.id)
+        with self._lock:
+            self._ids, self._hashes, self._tree = ids, hashes, tree
+            self._key = key
+        logger.info(f"Similarity index loaded with {len(rows)} hashes")
+
+    def similar(self, phash, max_distance, limit, generation, exclude_id=None):
+        """Return up to ``limit`` (image_id, distance) pairs within ``max_distance``, closest first."""
+        self.ensure(generation)
+        with self._lock:
+            ids, hashes, tree = self._ids, self._hashes, self._tree
+        if ids is not None:
+            distances = _distances(hashes, phash)
+            matches = np.flatnonzero(distances <= max_distance)
+            order = np.lexsort((ids[matches], distances[matches]))
+            found = [(int(ids[i]), int(distances[i])) for i in matches[order]]
+        else:
+            found = sorted(tree.search(phash, max_distance), key=lambda pair: (pair[1], pair[0]))
+        return [pair for pair in found if pair[0] != exclude_id][:limit]
+
+def _bit_ranges(parts):
+    """Split the hash bits into ``parts`` contiguous ranges of near-equal width."""
+    bounds = [HASH_BITS * i // parts for i in range(parts + 1)]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(parts)]
+
+def find_duplicate_groups(max_distance):
+    """Group images whose hashes are within ``max_distance`` bits of each other.
+
+    Uses multi-index hashing: split into ``max_distance + 1`` bit ranges,
+    any two hashes that close agree exactly on at least one range, so only
+    images sharing a bucket are compared. Returns lists of
+    (image_id, distance to the group's first image), largest groups first.
+    """
+    if not 0 <= max_distance < HASH_BITS // 2:
+        raise ValueError(f"max_distance must be between 0 and {HASH_BITS // 2 - 1}")
+    rows = db.session.execute(
+        select(Image.id, Image.phash).where(Image.phash.isnot(None)).order_by(Image.id)
+    ).all()
+    ids = [row.id for row in rows]
+    hashes = [row.phash & HASH_MASK for row in rows]
+    if np is not None:
+        array = np.array(hashes, dtype=np.uint64)
+
+    # Union-find over positions in ``ids``
+    parent = list(range(len(ids)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for shift, width in _bit_ranges(max_distance + 1):
+        mask = (1 << width) - 1
+        buckets = {}
+        for i, value in enumerate(hashes):
+            buckets.setdefault((value >> shift) & mask, []).append(i)
+        for members in buckets.values():
+            for n, i in enumerate(members[:-1]):
+                rest = members[n + 1:]
+                if np is not None and len(rest) > 32:
+                    close = [rest[k] for k in np.flatnonzero(_distances(array[rest], hashes[i]) <= max_distance)]
+                else:
+                    close = [j for j in rest if hamming(hashes[i], hashes[j]) <= max_distance]
+                for j in close:
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j:
+                        parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i in range(len(ids)):
+        groups.setdefault(find(i), []).append(i)
+    result = [
+        [(ids[i], hamming(hashes[i], hashes[members[0]])) for i in members]
+        for members in groups.values() if len(members) > 1
+    ]
+    result.sort(key=lambda group: (-len(group), group[0][0]))
+    return result
@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from wand.image import Image as WandImage
+from wand.color import Color
+from thumbnails import (thumbnail_sizes, thumbnail_formats, variant_filename, thumbnail_settings_hash,
+                        FORMAT_EXTENSIONS, _save_atomic)
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+SPRITE_KEY = re.compile(r'^[0-9a-f]{40}$')
+
+# Tallest tile relative to its width; taller thumbnails are scaled down to fit
+MAX_TILE_ASPECT = 2
+
+# tiles maps image id -> (x, y, width, height) inside the atlas
+SpriteSheet = namedtuple('SpriteSheet', 'key width height tiles members')
+
+def tile_width():
+    """Width of a tile: the smallest thumbnail variant, which the tiles are cut from."""
+    return thumbnail_sizes()[0]
+
+def tile_size(image_width, image_height, width):
+    """A tile's (width, height) for an image, keeping its aspect ratio within the tile box."""
+    width = max(1, min(width, image_width or width))
+    height = max(1, round(width * (image_height or width) / (image_width or width)))
+    limit = width * MAX_TILE_ASPECT
+    if height > limit:
+        width, height = max(1, round(width * limit / height)), limit
+    return width, height
+
+def sprite_format():
+    fmt = settings.get('sprites', 'format', default='webp')
+    return fmt if fmt in FORMAT_EXTENSIONS else 'jpeg'
+
+def plan_sheet(images):
+    """Lay out one atlas for a page of images (anything with id, md5, file_ext and dimensions).
+
+    Tiles fill rows of ``sprites.columns`` cells, each row as tall as its
+    tallest tile. The key hashes the members and every setting that
+    changes the pixels, so a sheet's URL always names the same content.
+    """
+    width = tile_width()
+    columns = max(1, settings.get('sprites', 'columns', default=10))
+    members = [f"{image.md5}.{image.file_ext}" for image in images]
+    raw = json.dumps([members, thumbnail_settings_hash(), width, columns, sprite_format(),
+                      settings.get('sprites', 'quality', default=80)]).encode('utf-8')
+    key = hashlib.sha1(raw).hexdigest()
+
+    tiles = {}
+    y = 0
+    for row_start in range(0, len(images), columns):
+        row_height = 0
+        for i, image in enumerate(images[row_start:row_start + columns]):
+            w, h = tile_size(image.image_width, image.image_height, width)
+            tiles[image.id] = (i * width, y, w, h)
+            row_height = max(row_height, h)
+        y += row_height
+    return SpriteSheet(key, width * min(columns, len(images)), y, tiles, members)
+
+class SpriteService:
+    """Packs the thumbnails of a page into one atlas image, so the page needs one image request.
+
+    Rendering a page only plans the layout and writes its JSON offset map.
+    The atlas itself is built from the smallest thumbnail variants the
+    first time it is requested, and served as immutable from then on.
+    """
+
+    def __init__(self, thumbnails, sprites_dir, max_sheets=2000):
+        self.thumbnails = thumbnails
+        self.sprites_dir = sprites_dir
+        self.max_sheets = max_sheets
+        self._lock = threading.Lock()
+        os.makedirs(sprites_dir, exist_ok=True)
+
+    @property
+    def extension(self):
+        return FORMAT_EXTENSIONS[sprite_format()]
+
+    def _path(self, key, extension):
+        return os.path.join(self.sprites_dir, f'{key}.{extension}')
+
+    def sheet_for(self, images):
+        """Plan the atlas for ``images`` and record its offset map. Returns None for an empty page."""
+        if not images:
+            return None
+        sheet = plan_sheet(images)
+        map_path = self._path(sheet.key, 'json')
+        if not os.path.exists(map_path):
+            tiles = []
+            for image, member in zip(images, sheet.members):
+                x, y, w, h = sheet.tiles[image.id]
+                tiles.append({'id': image.id, 'file': member, 'x': x, 'y': y, 'width': w, 'height': h})
+            tmp_path = f'{map_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'width': sheet.width, 'height': sheet.height, 'format': sprite_format(),
+                           'tiles': tiles}, f)
+            os.replace(tmp_path, map_path)
+        return sheet
+
+    def ensure(self, key):
+        """Build the atlas for ``key`` from its offset map if it does not exist yet. False if there is no map."""
+        atlas_path = self._path(key, self.extension)
+        if os.path.exists(atlas_path):
+            return True
+        try:
+            with open(self._path(key, 'json')) as f:
+                layout = json.load(f)
+        except (OSError, ValueError):
+            return False
+        # Missing tiles are generated in parallel, outside the lock, so a cold page only holds up itself
+        ready = self.thumbnails.ensure_all({self._tile_source(tile) for tile in layout['tiles']}, timeout=30)
+        with self._lock:
+            if not os.path.exists(atlas_path):
+                self.build(layout, atlas_path, ready)
+                self.prune()
+        return True
+
+    @staticmethod
+    def _tile_source(tile):
+        """The thumbnail file a tile is cut from."""
+        formats = thumbnail_formats()
+        return variant_filename(tile['file'], tile_width(), formats[0]) if formats else tile['file']
+
+    def build(self, layout, atlas_path, ready):
+        """Composite the tiles whose thumbnails are in ``ready`` and write the atlas; the rest stay blank."""
+        with WandImage(width=layout['width'], height=layout['height'], background=Color('white')) as atlas:
+            for tile in layout['tiles']:
+                source = self._tile_source(tile)
+                try:
+                    if source not in ready:
+                        logger.warning(f"No thumbnail for {tile['file']}, leaving its tile blank")
+                        continue
+                    with WandImage(filename=os.path.join(self.thumbnails.thumbnails_dir, source)) as thumb:
+                        thumb.resize(tile['width'], tile['height'])
+                        atlas.composite(thumb, left=tile['x'], top=tile['y'])
+                except Exception as e:
+                    logger.error(f"Error adding {tile['file']} to sprite sheet: {str(e)}")
+            atlas.format = sprite_format()
+            atlas.compression_quality = settings.get('sprites', 'quality', default=80)
+            _save_atomic(atlas, atlas_path)
+
+    def prune(self):
+        """Delete the least recently written sheets beyond ``max_sheets``."""
+        sheets = {}
+        with os.scandir(self.sprites_dir) as entries:
+            for entry in entries:
+                key = entry.name.split('.', 1)[0]
+                if SPRITE_KEY.match(key):
+                    sheets[key] = max(sheets.get(key, 0), entry.stat().st_mtime)
+        for key in sorted(sheets, key=sheets.get)[:max(0, len(sheets) - self.max_sheets)]:
+            for extension in ('json', self.extension):
+                try:
+                    os.remove(self._path(key, extension))
+                except OSError:
+                    pass
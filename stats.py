@@ -0,0 +1,61 @@
+from sqlalchemy import select, func, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Image, Stat
+
+def _image_count_key(exclude_deleted, exclude_banned):
+    return f'image_count:{int(bool(exclude_deleted))}:{int(bool(exclude_banned))}'
+
+def count_images():
+    """Count images for every deleted/banned filter state."""
+    total, not_deleted, not_banned, active = db.session.query(
+        func.count(Image.id),
+        func.sum(case((Image.is_deleted == False, 1), else_=0)),
+        func.sum(case((Image.is_banned == False, 1), else_=0)),
+        func.sum(case(((Image.is_deleted == False) & (Image.is_banned == False), 1), else_=0))
+    ).one()
+    return {
+        _image_count_key(False, False): total,
+        _image_count_key(True, False): not_deleted,
+        _image_count_key(False, True): not_banned,
+        _image_count_key(True, True): active,
+    }
+
+def refresh_image_counts():
+    """Recount images for every deleted/banned filter state and store the results."""
+    counts = count_images()
+    set_stats(counts)
+    db.session.commit()
+    return counts
+
+def image_count(exclude_deleted, exclude_banned):
+    """Return the cached image count for a filter state, computing it on first use."""
+    key = _image_count_key(exclude_deleted, exclude_banned)
+    stat = db.session.get(Stat, key)
+    if stat is None:
+        # Not stored until the next ingest; counted here without writing, since pages only read
+        return count_images()[key] or 0
+    return stat.value
+
+def set_stats(values):
+    """Upsert {key: value} into the stats table (caller commits)."""
+    stmt = sqlite_insert(Stat.__table__)
+    db.session.execute(
+        stmt.on_conflict_do_update(index_elements=['key'], set_={'value': stmt.excluded.value}),
+        [{'key': key, 'value': value or 0} for key, value in values.items()]
+    )
+
+GENERATION_KEY = 'generation'
+
+def bump_generation():
+    """Mark the library as changed so cached pages are rebuilt."""
+    stmt = sqlite_insert(Stat.__table__)
+    db.session.execute(
+        stmt.on_conflict_do_update(index_elements=['key'], set_={'value': Stat.__table__.c.value + 1}),
+        [{'key': GENERATION_KEY, 'value': 1}]
+    )
+    db.session.commit()
+
+def current_generation():
+    """Return the library generation, bumped by every ingest that changes data."""
+    # A plain select so another process's bump is never hidden by the identity map
+    return db.session.execute(select(Stat.value).where(Stat.key == GENERATION_KEY)).scalar() or 0
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from models import db, Image, Tag
+from pagination import SORT_COLUMNS, decode_cursor, keyset_page, listing_query, listing_rows
+from query import TagTerm, Wildcard, Meta, Not, And, Or, walk
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+# Per-post columns, indexed by dense ordinal (the post's position in id order)
+POST_ARRAYS = ('ids', 'deleted', 'banned', 'score', 'fav_count', 'created_at')
+# Tag postings in CSR layout: postings[offsets[i]:offsets[i + 1]] are the ordinals carrying tag_ids[i]
+TAG_ARRAYS = ('tag_ids', 'offsets', 'postings')
+
+def _timestamp(value):
+    """Datetimes as integer microseconds, so created_at sorts and compares as a number."""
+    if value is None:
+        return 0
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+def _top(values, ids, count, descending):
+    """Positions of the first ``count`` entries in (value, id) order, without sorting every entry.
+
+    np.partition finds the cut-off value; only the entries on the page's
+    side of it, plus as many ties as are needed, are sorted.
+    """
+    if len(values) > count:
+        if descending:
+            kth = np.partition(values, len(values) - count)[len(values) - count]
+            inside = np.flatnonzero(values > kth)
+        else:
+            kth = np.partition(values, count - 1)[count - 1]
+            inside = np.flatnonzero(values < kth)
+        ties = np.flatnonzero(values == kth)
+        needed = count - len(inside)
+        if len(ties) > needed:
+            # Ties on the cut-off value are ordered by id
+            tie_ids = ids[ties]
+            if descending:
+                ties = ties[np.argpartition(tie_ids, len(ties) - needed)[len(ties) - needed:]]
+            else:
+                ties = ties[np.argpartition(tie_ids, needed - 1)[:needed]]
+        candidates = np.concatenate([inside, ties])
+    else:
+        candidates = np.arange(len(values))
+    order = np.lexsort((ids[candidates], values[candidates]))
+    if descending:
+        order = order[::-1]
+    return candidates[order]
+
+class Unsupported(Exception):
+    """The query uses terms the in-memory index cannot answer; fall back to SQL."""
+
+class TagBitmapIndex:
+    """Optional in-process tag index answering tag searches with NumPy set operations.
+
+    Every post gets a dense ordinal and every tag a sorted array of the
+    ordinals carrying it, so AND/OR/NOT are intersect1d/union1d/setdiff1d
+    and counts are free. Only the requested page is then loaded from
+    SQLite. The arrays are saved as .npy files and opened with mmap, so
+    worker processes share the pages and a restart does not rebuild.
+
+    The index is tied to the library generation: when ingestion bumps it,
+    the index is rebuilt in the background and SQL answers until it is
+    ready. One build runs at a time, at most every ``rebuild_interval``
+    seconds, and always for the latest generation asked for, so a burst
+    of ingest batches (watch mode) costs one rebuild rather than one each.
+    """
+
+    def __init__(self, app, path, rebuild_interval=10.0):
+        self.app = app
+        self.path = path
+        self.rebuild_interval = rebuild_interval
+        self.generation = None
+        self.arrays = None
+        self._lock = threading.Lock()
+        self._building = False
+        # Latest generation ready() was asked for, and when the last build started
+        self._wanted = None
+        self._built_at = None
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def supported():
+        return np is not None
+
+    # ------------------------------------------------------------ lifecycle
+
+    def ready(self, generation):
+        """Whether the index matches ``generation``; starts a load or rebuild when it does not."""
+        if self.generation == generation:
+            return True
+        if self._load(generation):
+            return True
+        with self._lock:
+            self._wanted = generation
+            if self._building:
+                return False
+            self._building = True
+        threading.Thread(target=self._rebuild, name='tag-index-build', daemon=True).start()
+        return False
+
+    def _rebuild(self):
+        """Build until the index matches the latest generation asked for."""
+        try:
+            while True:
+                with self._lock:
+                    generation = self._wanted
+                    if generation == self.generation:
+                        return
+                if self._built_at is not None:
+                    wait = self._built_at + self.rebuild_interval - time.monotonic()
+                    if wait > 0:
+                        # Generations asked for meanwhile are covered by the one build after the wait
+                        time.sleep(wait)
+                        continue
+                self._built_at = time.monotonic()
+                if self._load(generation):
+                    continue
+                with self.app.app_context():
+                    arrays = self.build()
+                self._save(arrays, generation)
+                self._load(generation)
+        except Exception as e:
+            logger.error(f"Error building tag index: {str(e)}")
+        finally:
+            with self._lock:
+                self._building = False
+
+    def build(self):
+        """Read the tag associations from SQLite into arrays."""
+        rows = db.session.execute(select(
+            Image.id, Image.is_deleted, Image.is_banned, Image.score, Image.fav_count, Image.created_at
+        ).order_by(Image.id)).all()
+        arrays = {
+            'ids': np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows)),
+            'deleted': np.fromiter((bool(row.is_deleted) for row in rows), dtype=np.bool_, count=len(rows)),
+            'banned': np.fromiter((bool(row.is_banned) for row in rows), dtype=np.bool_, count=len(rows)),
+            'score': np.fromiter((row.score or 0 for row in rows), dtype=np.int64, count=len(rows)),
+            'fav_count': np.fromiter((row.fav_count or 0 for row in rows), dtype=np.int64, count=len(rows)),
+            'created_at': np.fromiter((_timestamp(row.created_at) for row in rows), dtype=np.int64,
+                                      count=len(rows)),
+        }
+        del rows
+
+        # Ordered by the (tag_id, image_id) index, so each tag's postings come out sorted
+        pairs = db.session.connection().exec_driver_sql(
+            'SELECT tag_id, image_id FROM image_tags ORDER BY tag_id, image_id'
+        )
+        flat = np.fromiter((value for pair in pairs for value in pair), dtype=np.int64)
+        tag_column, image_column = flat[0::2], flat[1::2]
+
+        ordinals = np.searchsorted(arrays['ids'], image_column)
+        tag_ids, starts = np.unique(tag_column, return_index=True)
+        arrays['tag_ids'] = tag_ids
+        arrays['offsets'] = np.append(starts, len(tag_column)).astype(np.int64)
+        arrays['postings'] = ordinals.astype(np.uint32)
+        return arrays
+
+    def _file(self, name, generation):
+        return os.path.join(self.path, f'{name}.{generation}.npy')
+
+    def _save(self, arrays, generation):
+        for name, array in arrays.items():
+            tmp_path = self._file(name, generation) + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, self._file(name, generation))
+        # The manifest is written last; it is what makes a generation visible
+        manifest = os.path.join(self.path, 'manifest.json')
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump({'generation': generation}, f)
+        os.replace(manifest + '.tmp', manifest)
+        for filename in os.listdir(self.path):
+            if filename.endswith('.npy') and f'.{generation}.' not in filename:
+                try:
+                    os.remove(os.path.join(self.path, filename))
+                except OSError:
+                    pass
+
+    def _load(self, generation):
+        try:
+            with open(os.path.join(self.path, 'manifest.json')) as f:
+                if json.load(f)['generation'] != generation:
+                    return False
+            arrays = {name: np.load(self._file(name, generation), mmap_mode='r')
+                      for name in POST_ARRAYS + TAG_ARRAYS}
+        except (OSError, ValueError, KeyError):
+            return False
+        with self._lock:
+            self.arrays = arrays
+            self.generation = generation
+        logger.info(f"Tag index ready: {len(arrays['ids'])} posts, {len(arrays['tag_ids'])} tags, "
+                    f"{self.memory_usage() / 1048576:.1f} MB")
+        return True
+
+    def memory_usage(self):
+        """Bytes held by the index arrays (mapped, so shared between processes)."""
+        arrays = self.arrays
+        return sum(array.nbytes for array in arrays.values()) if arrays else 0
+
+    # ------------------------------------------------------------ evaluation
+
+    def _postings(self, arrays, tag_id):
+        i = np.searchsorted(arrays['tag_ids'], tag_id)
+        if i >= len(arrays['tag_ids']) or arrays['tag_ids'][i] != tag_id:
+            return np.empty(0, dtype=np.uint32)
+        return arrays['postings'][arrays['offsets'][i]:arrays['offsets'][i + 1]]
+
+    def _union(self, sets):
+        sets = list(sets)
+        if not sets:
+            return np.empty(0, dtype=np.uint32)
+        return np.unique(np.concatenate(sets))
+
+    def evaluate(self, arrays, node, tags, universe):
+        """Return the sorted ordinals matching ``node`` within ``universe``."""
+        if isinstance(node, TagTerm):
+            tag = tags.get(node.name)
+            if tag is None or (node.category and tag.category != node.category):
+                return np.empty(0, dtype=np.uint32)
+            return self._postings(arrays, tag.id)
+        if isinstance(node, Wildcard):
+            query = select(Tag.id).where(Tag.name >= node.prefix, Tag.name < node.prefix + '\U0010ffff')
+            if node.category:
+                query = query.where(Tag.category == node.category)
+            return self._union(self._postings(arrays, tag_id) for tag_id in db.session.execute(query).scalars())
+        if isinstance(node, Not):
+            return np.setdiff1d(universe, self.evaluate(arrays, node.child, tags, universe), assume_unique=True)
+        if isinstance(node, And):
+            children = [child for child in node.children if not (isinstance(child, Meta) and child.name == 'order')]
+            # Smallest sets first keeps every intersection small
+            results = sorted((self.evaluate(arrays, child, tags, universe) for child in children), key=len)
+            result = results[0] if results else universe
+            for other in results[1:]:
+                result = np.intersect1d(result, other, assume_unique=True)
+            return result
+        if isinstance(node, Or):
+            return self._union(self.evaluate(arrays, child, tags, universe) for child in node.children)
+        if isinstance(node, Meta) and node.name == 'order':
+            return universe
+        raise Unsupported(node)
+
+    def paginate(self, node, sort_by, sort_order, per_page, cursor, exclude_deleted, exclude_banned):
+        """Return a KeysetPage for a parsed query, or None if the index cannot answer it."""
+        arrays = self.arrays
+        if arrays is None:
+            return None
+
+        names = {n.name for n in walk(node) if isinstance(n, TagTerm)}
+        tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names)).all()} if names else {}
+
+        visible = np.ones(len(arrays['ids']), dtype=np.bool_)
+        if exclude_deleted:
+            visible &= ~np.asarray(arrays['deleted'])
+        if exclude_banned:
+            visible &= ~np.asarray(arrays['banned'])
+        universe = np.flatnonzero(visible).astype(np.uint32)
+        try:
+            matches = self.evaluate(arrays, node, tags, universe)
+        except Unsupported:
+            return None
+        matches = matches[visible[matches]]
+        total = len(matches)
+
+        if sort_by not in SORT_COLUMNS:
+            sort_by = 'id'
+        descending = sort_order == 'desc'
+        direction, value, last_id = 'next', None, None
+        if cursor:
+            cursor_sort, value, last_id, direction = decode_cursor(cursor)
+            if cursor_sort != sort_by:
+                cursor, direction = None, 'next'
+            elif isinstance(value, datetime):
+                value = _timestamp(value)
+        # Whether the page walks from high (sort value, id) to low
+        downward = descending == (direction == 'next')
+        count = per_page + 1
+
+        # Matches are ordinals in id order, so ids come out sorted and an id page is one slice
+        ids = np.asarray(arrays['ids'])[matches]
+        if sort_by == 'id':
+            if downward:
+                end = np.searchsorted(ids, last_id, side='left') if cursor else len(ids)
+                page = ids[max(0, end - count):end][::-1]
+            else:
+                start = np.searchsorted(ids, last_id, side='right') if cursor else 0
+                page = ids[start:start + count]
+        else:
+            values = np.asarray(arrays[sort_by])[matches]
+            if cursor:
+                if downward:
+                    keep = (values < value) | ((values == value) & (ids < last_id))
+                else:
+                    keep = (values > value) | ((values == value) & (ids > last_id))
+                ids, values = ids[keep], values[keep]
+            page = ids[_top(values, ids, count, downward)]
+        page_ids = [int(image_id) for image_id in page]
+
+        # Hydrate only the rows on this page
+        rows = {row.id: row for row in listing_rows(listing_query(Image.query.filter(Image.id.in_(page_ids))))}
+        items = [rows[image_id] for image_id in page_ids if image_id in rows]
+        return keyset_page(items, sort_by, per_page, direction, cursor is not None, total)
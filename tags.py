@@ -0,0 +1,253 @@
+from collections import Counter
+from sqlalchemy import select, delete, insert, update, and_, bindparam, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import aliased
+from models import db, Image, Tag, ImageTag, TagCount
+from stats import bump_generation
+
+TAG_CATEGORIES = ('general', 'artist', 'character', 'copyright', 'meta')
+
+# Stay well below SQLite's bound-parameter limit for IN (...) lookups
+CHUNK_SIZE = 500
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def normalize_tag(name):
+    """Normalize a tag name the way boorus store them."""
+    return '_'.join(str(name).strip().lower().split())
+
+def split_tags(value):
+    """Split a comma-separated tag column (or a list) into normalized names."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [tag for tag in (normalize_tag(v) for v in value) if tag]
+
+def image_tag_map(image):
+    """Return {category: [tag names]} for an Image, a row, or a dict of image columns."""
+    if isinstance(image, dict):
+        return {category: split_tags(image.get(f'tags_{category}')) for category in TAG_CATEGORIES}
+    return {
+        category: split_tags(getattr(image, f'tags_{category}', ''))
+        for category in TAG_CATEGORIES
+    }
+
+def filter_states(is_deleted, is_banned):
+    """Return the (exclude_deleted, exclude_banned) filter combinations a post is visible under."""
+    return [
+        (exclude_deleted, exclude_banned)
+        for exclude_deleted in (False, True)
+        for exclude_banned in (False, True)
+        if not (exclude_deleted and is_deleted) and not (exclude_banned and is_banned)
+    ]
+
+def get_or_create_tags(session, tag_maps):
+    """Resolve tag names to ids, creating missing tags. Returns {name: id}."""
+    categories = {}
+    for tag_map in tag_maps:
+        for category, names in tag_map.items():
+            for name in names:
+                categories.setdefault(name, category)
+
+    tag_ids = {}
+    for chunk in chunks(categories):
+        tag_ids.update(session.execute(
+            select(Tag.name, Tag.id).where(Tag.name.in_(chunk))
+        ).all())
+
+    missing = [name for name in categories if name not in tag_ids]
+    if missing:
+        session.execute(
+            insert(Tag.__table__).prefix_with('OR IGNORE'),
+            [{'name': name, 'category': categories[name], 'post_count': 0} for name in missing]
+        )
+        for chunk in chunks(missing):
+            tag_ids.update(session.execute(
+                select(Tag.name, Tag.id).where(Tag.name.in_(chunk))
+            ).all())
+
+    return tag_ids
+
+def sync_image_tags(session, image_tags, flags, previous_flags=None):
+    """Replace the tag associations of the given images and update tag counts.
+
+    ``image_tags`` maps image id to {category: [tag names]} and ``flags`` maps
+    image id to its (is_deleted, is_banned) state. ``previous_flags`` holds the
+    state stored before this write for images that were already indexed;
+    images missing from it are assumed to keep their flags. Only the
+    difference against the stored associations is written.
+    """
+    if not image_tags:
+        return
+    previous_flags = previous_flags or {}
+
+    tag_ids = get_or_create_tags(session, image_tags.values())
+    new_pairs = {
+        (image_id, tag_ids[name])
+        for image_id, tag_map in image_tags.items()
+        for names in tag_map.values()
+        for name in names
+    }
+
+    # Plain tuples: Row objects are not accepted as executemany parameters below
+    old_pairs = set()
+    for chunk in chunks(image_tags):
+        old_pairs.update(tuple(row) for row in session.execute(
+            select(ImageTag.image_id, ImageTag.tag_id).where(ImageTag.image_id.in_(chunk))
+        ))
+
+    added = new_pairs - old_pairs
+    removed = old_pairs - new_pairs
+
+    # Plain DB-API executemany: these are the highest-volume writes of an import
+    connection = session.connection()
+    if removed:
+        connection.exec_driver_sql(
+            'DELETE FROM image_tags WHERE image_id = ? AND tag_id = ?', list(removed)
+        )
+    if added:
+        connection.exec_driver_sql(
+            'INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)', list(added)
+        )
+
+    delta = Counter(tag_id for _, tag_id in added)
+    delta.subtract(tag_id for _, tag_id in removed)
+    changes = [{'b_id': tag_id, 'b_delta': d} for tag_id, d in delta.items() if d]
+    if changes:
+        table = Tag.__table__
+        session.execute(
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .values(post_count=table.c.post_count + bindparam('b_delta')),
+            changes
+        )
+
+    # Per filter-state counts: retract what each image contributed before, add what it contributes now
+    old_states = {image_id: filter_states(*previous_flags.get(image_id, flags[image_id]))
+                  for image_id in image_tags}
+    new_states = {image_id: filter_states(*flags[image_id]) for image_id in image_tags}
+    state_delta = Counter()
+    for image_id, tag_id in old_pairs:
+        for state in old_states[image_id]:
+            state_delta[(tag_id,) + state] -= 1
+    for image_id, tag_id in new_pairs:
+        for state in new_states[image_id]:
+            state_delta[(tag_id,) + state] += 1
+    update_tag_counts(session, state_delta, {tag_ids[name]: category
+                                             for tag_map in image_tags.values()
+                                             for category, names in tag_map.items()
+                                             for name in names})
+
+def update_tag_counts(session, state_delta, categories):
+    """Apply {(tag_id, exclude_deleted, exclude_banned): delta} to the tag_counts aggregate."""
+    rows = [
+        {'tag_id': tag_id, 'exclude_deleted': exclude_deleted, 'exclude_banned': exclude_banned,
+         'category': categories.get(tag_id, 'general'), 'count': d}
+        for (tag_id, exclude_deleted, exclude_banned), d in state_delta.items() if d
+    ]
+    if not rows:
+        return
+
+    stmt = sqlite_insert(TagCount.__table__)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['tag_id', 'exclude_deleted', 'exclude_banned'],
+            set_={'count': TagCount.__table__.c.count + stmt.excluded.count}
+        ),
+        rows
+    )
+    for chunk in chunks({row['tag_id'] for row in rows}):
+        session.execute(
+            delete(TagCount.__table__).where(TagCount.tag_id.in_(chunk), TagCount.count <= 0)
+        )
+
+def rebuild_tag_counts():
+    """Recompute the tag_counts aggregate from image_tags in SQL."""
+    db.session.execute(delete(TagCount.__table__))
+    for exclude_deleted in (False, True):
+        for exclude_banned in (False, True):
+            query = (
+                select(
+                    ImageTag.tag_id,
+                    db.literal(exclude_deleted),
+                    db.literal(exclude_banned),
+                    Tag.category,
+                    func.count()
+                )
+                .join(Image, Image.id == ImageTag.image_id)
+                .join(Tag, Tag.id == ImageTag.tag_id)
+                .group_by(ImageTag.tag_id)
+            )
+            if exclude_deleted:
+                query = query.where(Image.is_deleted == False)
+            if exclude_banned:
+                query = query.where(Image.is_banned == False)
+            db.session.execute(insert(TagCount.__table__).from_select(
+                ['tag_id', 'exclude_deleted', 'exclude_banned', 'category', 'count'], query
+            ))
+    db.session.commit()
+    bump_generation()
+
+def top_tags(limit, exclude_deleted, exclude_banned, category=None):
+    """Return {name: count} of the most used tags for a filter state, read from tag_counts."""
+    query = (
+        db.session.query(Tag.name, TagCount.count)
+        .join(Tag, Tag.id == TagCount.tag_id)
+        .filter(
+            TagCount.exclude_deleted == bool(exclude_deleted),
+            TagCount.exclude_banned == bool(exclude_banned)
+        )
+    )
+    if category:
+        query = query.filter(TagCount.category == category)
+    query = query.order_by(TagCount.count.desc())
+    if limit:
+        query = query.limit(limit)
+    return dict(query.all())
+
+def resolve_tags(names):
+    """Look up exact tag names. Returns a list of Tag rows, or None if any tag is unknown."""
+    names = list(dict.fromkeys(normalize_tag(name) for name in names if normalize_tag(name)))
+    if not names:
+        return []
+    tags = Tag.query.filter(Tag.name.in_(names)).all()
+    if len(tags) != len(names):
+        return None
+    return tags
+
+def filter_by_tags(query, tags):
+    """Restrict an Image query to posts carrying every tag, joining rarest tags first."""
+    for tag in sorted(tags, key=lambda t: t.post_count):
+        image_tag = aliased(ImageTag)
+        query = query.join(image_tag, and_(
+            image_tag.image_id == Image.id,
+            image_tag.tag_id == tag.id
+        ))
+    return query
+
+def rebuild_tag_index(batch_size=1000):
+    """Build the tag tables from the tags_* columns of every stored image."""
+    columns = [Image.id, Image.is_deleted, Image.is_banned] + \
+        [getattr(Image, f'tags_{category}') for category in TAG_CATEGORIES]
+    last_id = None
+    indexed = 0
+    while True:
+        query = db.session.query(*columns).order_by(Image.id)
+        if last_id is not None:
+            query = query.filter(Image.id > last_id)
+        rows = query.limit(batch_size).all()
+        if not rows:
+            break
+        sync_image_tags(db.session,
+                        {row.id: image_tag_map(row) for row in rows},
+                        {row.id: (bool(row.is_deleted), bool(row.is_banned)) for row in rows})
+        db.session.commit()
+        last_id = rows[-1].id
+        indexed += len(rows)
+    if indexed:
+        bump_generation()
+    return indexed
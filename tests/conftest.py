@@ -0,0 +1,91 @@
+import os
+import sys
+import copy
+import json
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Settings reads and writes settings.json in the working directory, so the
+# tests run from a scratch directory with the defaults
+os.chdir(tempfile.mkdtemp(prefix='booru-tests-'))
+
+from settings import Settings
+from models import db
+
+settings = Settings()
+settings.set(False, 'cache', 'enabled', save=False)
+settings.set(False, 'metrics', 'enabled', save=False)
+
+@pytest.fixture(autouse=True)
+def restore_settings():
+    """Undo settings.set(..., save=False) calls made by a test."""
+    saved = copy.deepcopy(settings._settings)
+    yield
+    settings._settings = saved
+
+@pytest.fixture
+def app(tmp_path):
+    """The app on an empty database in ``tmp_path``, without background jobs."""
+    from config import Config
+    from app import booru_webui
+
+    class TestConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'booru.db'}"
+
+    for name in ('json', 'images', 'thumbnails'):
+        (tmp_path / name).mkdir()
+    settings.set(str(tmp_path / 'json'), 'paths', 'source_json', save=False)
+    settings.set(str(tmp_path / 'images'), 'paths', 'source_images', save=False)
+    settings.set('direct', 'paths', 'storage_mode', save=False)
+    # Joined onto the static folder, so an absolute path keeps thumbnails out of the checkout
+    settings.set(str(tmp_path / 'thumbnails'), 'paths', 'thumbnails_folder', save=False)
+    app = booru_webui(TestConfig, background=False)
+    yield app
+    app.extensions['thumbnails'].shutdown()
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def write_image(tmp_path):
+    """Write a small solid-colour source image; returns its filename."""
+    from wand.image import Image as WandImage
+    from wand.color import Color
+
+    def write(filename, width=300, height=200):
+        with WandImage(width=width, height=height, background=Color('red')) as img:
+            img.format = os.path.splitext(filename)[1].lstrip('.').replace('jpg', 'jpeg')
+            img.save(filename=str(tmp_path / 'images' / filename))
+        return filename
+
+    return write
+
+@pytest.fixture
+def write_post(tmp_path):
+    """Write a gallery-dl sidecar for a post; returns the JSON file's path."""
+    counter = iter(range(1, 10 ** 6))
+
+    def write(post_id, tags=('tag_a',), **fields):
+        data = {
+            'id': post_id, 'md5': f'{post_id:032x}', 'file_ext': 'jpg', 'rating': 's',
+            'image_width': 100, 'image_height': 100, 'score': post_id,
+            'created_at': '2024-01-01T00:00:00', 'tag_string': ' '.join(tags),
+            'tags_general': list(tags),
+        }
+        data.update(fields)
+        path = tmp_path / 'json' / f'{post_id}.json'
+        path.write_text(json.dumps(data))
+        # Every write gets a later mtime, so the sync always sees it as changed
+        stamp = 1700000000 + next(counter)
+        os.utime(path, (stamp, stamp))
+        return path
+
+    return write
@@ -0,0 +1,53 @@
+import time
+import threading
+from autocomplete import TagCompleter
+from ingest import load_images_from_json
+from settings import Settings
+
+settings = Settings()
+
+def names(results):
+    return [name for name, _, _ in results]
+
+def test_suggestions_most_used_first(app, write_post):
+    write_post(1, tags=('blue_sky', 'blue_eyes'))
+    write_post(2, tags=('blue_eyes',))
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+        completer = TagCompleter(app)
+        assert names(completer.complete('blue', 1)) == ['blue_eyes', 'blue_sky']
+        assert names(completer.complete('blue_s', 1)) == ['blue_sky']
+        assert names(completer.complete('blue', 1, limit=1)) == ['blue_eyes']
+
+def test_memo_is_bounded(app, write_post):
+    write_post(1, tags=[f'tag_{i:03d}' for i in range(50)])
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+        completer = TagCompleter(app, memo_size=8)
+        for i in range(50):
+            completer.complete(f'tag_{i:03d}', 1)
+        assert len(completer._memo) == 8
+        assert 'tag_049' in completer._memo
+
+def test_reload_keeps_serving_the_old_snapshot(app, write_post, monkeypatch):
+    write_post(1, tags=('old_tag',))
+    path = settings.get('paths', 'source_json')
+    with app.app_context():
+        load_images_from_json(path)
+        completer = TagCompleter(app)
+        assert names(completer.complete('old', 1)) == ['old_tag']
+
+        write_post(2, tags=('new_tag',))
+        load_images_from_json(path)
+        release = threading.Event()
+        load = completer.load
+        monkeypatch.setattr(completer, 'load', lambda generation: (release.wait(5), load(generation)))
+
+        # The request that notices the new generation is answered from the old snapshot
+        assert names(completer.complete('new', 2)) == []
+        assert names(completer.complete('old', 2)) == ['old_tag']
+        release.set()
+        deadline = time.monotonic() + 5
+        while names(completer.complete('new', 2)) != ['new_tag']:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
@@ -0,0 +1,57 @@
+from flask import Flask, request
+from models import db, Image
+from cache import PageCache, cache_key
+from ingest import load_images_from_json
+from settings import Settings
+from stats import bump_generation
+
+settings = Settings()
+
+def md5(post_id):
+    return f'{post_id:032x}'
+
+def test_gallery_is_cached_until_the_generation_changes(app, client, write_post):
+    app.extensions['page_cache'] = PageCache(check_interval=0)
+    path = settings.get('paths', 'source_json')
+    write_post(1)
+    with app.app_context():
+        load_images_from_json(path)
+    assert md5(1) in client.get('/gallery').get_data(as_text=True)
+
+    # A change that does not bump the generation is not seen: the page comes from the cache
+    with app.app_context():
+        image = db.session.get(Image, 1)
+        image.md5 = md5(99)
+        db.session.commit()
+    body = client.get('/gallery').get_data(as_text=True)
+    assert md5(1) in body and md5(99) not in body
+
+    # Ingest bumps the generation, which drops every cached page
+    write_post(2)
+    with app.app_context():
+        load_images_from_json(path)
+    body = client.get('/gallery').get_data(as_text=True)
+    assert md5(2) in body and md5(99) in body
+
+def test_cache_key_ignores_argument_order():
+    app = Flask(__name__)
+    with app.test_request_context('/gallery?b=2&a=1'):
+        first = cache_key(request)
+    with app.test_request_context('/gallery?a=1&b=2'):
+        assert cache_key(request) == first == '/gallery?a=1&b=2'
+
+def test_disk_entries_are_shared_and_pruned(app, tmp_path):
+    cache_dir = str(tmp_path / 'pages')
+    with app.app_context():
+        first = PageCache(cache_dir=cache_dir, check_interval=0)
+        second = PageCache(cache_dir=cache_dir, check_interval=0)
+        generation = first.generation()
+        first.set('/gallery', generation, b'page')
+        # Another worker process reads what the first wrote
+        assert second.get('/gallery', second.generation()) == b'page'
+
+        bump_generation()
+        generation = second.generation()
+        assert second.get('/gallery', generation) is None
+        assert first.get('/gallery', first.generation()) is None
+        assert list((tmp_path / 'pages').iterdir()) == []
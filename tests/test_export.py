@@ -0,0 +1,79 @@
+import json
+import pytest
+from ingest import load_images_from_json
+from export import DEFAULT_FIELDS, POST_FIELDS, parse_fields
+from settings import Settings
+
+settings = Settings()
+
+@pytest.fixture
+def posts(app, write_post):
+    for post_id in range(1, 13):
+        write_post(post_id, tags=('cat',) if post_id % 2 else ('dog',), score=post_id % 5)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+
+def test_parse_fields():
+    assert parse_fields('') == DEFAULT_FIELDS
+    assert parse_fields('all') == POST_FIELDS
+    assert parse_fields('md5, id,md5,') == ('md5', 'id')
+    with pytest.raises(ValueError):
+        parse_fields('id,password')
+
+def test_fields_select_columns(client, posts):
+    post = client.get('/api/posts?limit=1').get_json()['posts'][0]
+    assert set(post) == set(DEFAULT_FIELDS)
+    assert post['created_at'] == '2024-01-01T00:00:00'
+
+    post = client.get('/api/posts?limit=1&fields=md5').get_json()['posts'][0]
+    assert post == {'md5': f'{12:032x}'}
+    assert set(client.get('/api/posts?limit=1&fields=all').get_json()['posts'][0]) == set(POST_FIELDS)
+
+@pytest.mark.parametrize('args', [{'fields': 'id,nope'}, {'q': '(cat'}, {'q': 'score:abc'}, {'q': '-cat'}])
+def test_bad_requests_are_400(client, posts, args):
+    for url in ('/api/posts', '/api/posts/export'):
+        response = client.get(url, query_string=args)
+        assert response.status_code == 400
+        assert 'error' in response.get_json()
+
+def test_cursor_walk_by_a_column_that_is_not_returned(client, posts):
+    pages, cursor = [], None
+    while True:
+        args = {'q': 'cat order:score', 'fields': 'md5', 'limit': 2}
+        if cursor:
+            args['cursor'] = cursor
+        data = client.get('/api/posts', query_string=args).get_json()
+        # score and id are in the cursor but not in the posts
+        assert all(set(post) == {'md5'} for post in data['posts'])
+        pages.append([post['md5'] for post in data['posts']])
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+
+    # Odd ids are the cats; order:score is score descending, then id descending
+    expected = [f'{post_id:032x}' for post_id in sorted(range(1, 13, 2), key=lambda i: (-(i % 5), -i))]
+    assert [md5 for page in pages for md5 in page] == expected
+
+    # prev_cursor leads back to the page before
+    args = {'q': 'cat order:score', 'fields': 'md5', 'limit': 2}
+    first = client.get('/api/posts', query_string=args).get_json()
+    second = client.get('/api/posts', query_string=dict(args, cursor=first['next_cursor'])).get_json()
+    back = client.get('/api/posts', query_string=dict(args, cursor=second['prev_cursor'])).get_json()
+    assert back['posts'] == first['posts']
+
+def test_limit_is_clamped(client, posts):
+    settings.set(5, 'api', 'max_limit', save=False)
+    assert len(client.get('/api/posts?limit=100').get_json()['posts']) == 5
+    assert len(client.get('/api/posts?limit=0').get_json()['posts']) == 1
+
+def test_export_streams_ndjson(client, posts):
+    response = client.get('/api/posts/export?q=dog&fields=id,score')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [{'id': i, 'score': i % 5} for i in range(2, 13, 2)]
+
+def test_export_command(app, posts, tmp_path):
+    output = tmp_path / 'posts.ndjson'
+    result = app.test_cli_runner().invoke(args=['export', '-o', str(output), '--fields', 'id'])
+    assert result.exit_code == 0, result.output
+    assert [json.loads(line)['id'] for line in output.read_text().splitlines()] == list(range(1, 13))
@@ -0,0 +1,71 @@
+import logging
+from sqlalchemy import select
+from models import db, Image, Tag, TagCount, ImageTag
+from ingest import load_images_from_json
+from settings import Settings
+
+settings = Settings()
+
+def post_tags(image_id):
+    return set(db.session.execute(
+        select(Tag.name).join(ImageTag, ImageTag.tag_id == Tag.id).where(ImageTag.image_id == image_id)
+    ).scalars())
+
+def tag_count(name):
+    return db.session.execute(
+        select(TagCount.count).join(Tag, Tag.id == TagCount.tag_id)
+        .where(Tag.name == name, TagCount.exclude_deleted == True, TagCount.exclude_banned == True)
+    ).scalar() or 0
+
+def test_sync_adds_posts_and_tags(app, write_post):
+    for post_id in (1, 2, 3):
+        write_post(post_id, tags=('tag_a', 'tag_b'))
+    with app.app_context():
+        assert load_images_from_json(settings.get('paths', 'source_json')) == 3
+        assert db.session.query(Image).count() == 3
+        assert post_tags(2) == {'tag_a', 'tag_b'}
+        assert tag_count('tag_a') == 3
+
+def test_resync_after_tag_edit(app, write_post):
+    for post_id in (1, 2, 3):
+        write_post(post_id, tags=('tag_a', 'tag_b', 'tag_c'))
+    with app.app_context():
+        path = settings.get('paths', 'source_json')
+        load_images_from_json(path)
+
+        # Post 1 loses two tags and gains one; post 2 only loses one
+        write_post(1, tags=('tag_a', 'tag_d'))
+        write_post(2, tags=('tag_a', 'tag_b'))
+        assert load_images_from_json(path) == 2
+
+        assert post_tags(1) == {'tag_a', 'tag_d'}
+        assert post_tags(2) == {'tag_a', 'tag_b'}
+        assert post_tags(3) == {'tag_a', 'tag_b', 'tag_c'}
+        assert db.session.execute(select(Tag.post_count).where(Tag.name == 'tag_c')).scalar() == 1
+        assert tag_count('tag_b') == 2
+        assert tag_count('tag_d') == 1
+
+        # Everything was written, so nothing is left to retry
+        assert load_images_from_json(path) == 0
+
+def test_resync_after_deleting_tags(app, write_post):
+    write_post(1, tags=('tag_a', 'tag_b'))
+    with app.app_context():
+        path = settings.get('paths', 'source_json')
+        load_images_from_json(path)
+        write_post(1, tags=())
+        assert load_images_from_json(path) == 1
+        assert post_tags(1) == set()
+        assert tag_count('tag_a') == 0
+
+def test_sync_with_process_pool(app, write_post, caplog):
+    for post_id in range(1, 6):
+        write_post(post_id, tags=('tag_a', f'tag_{post_id}'))
+    settings.set(1, 'processing', 'batch_size', save=False)
+    settings.set(200, 'processing', 'cpu_usage_percent', save=False)
+    with app.app_context():
+        with caplog.at_level(logging.INFO, logger='ingest'):
+            assert load_images_from_json(settings.get('paths', 'source_json')) == 5
+        assert 'Parsing JSON with 2 processes' in caplog.text
+        assert post_tags(4) == {'tag_a', 'tag_4'}
+        assert tag_count('tag_a') == 5
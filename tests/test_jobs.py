@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import threading
+import pytest
+from models import db, Job
+from jobs import JobRunner
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+@pytest.fixture
+def runner(app):
+    runner = JobRunner(app, progress_interval=0)
+    yield runner
+    runner.shutdown()
+
+def job_status(app, job_id):
+    with app.app_context():
+        return db.session.get(Job, job_id).status
+
+def test_higher_priority_job_preempts(app, runner):
+    events = []
+    release = threading.Event()
+
+    def slow(context):
+        events.append('slow')
+        for i in range(1000):
+            context.progress(i, 1000)
+            release.wait(0.01)
+
+    runner.register('slow', slow)
+    runner.register('urgent', lambda context: events.append('urgent'), priority=1)
+    runner.start()
+    with app.app_context():
+        slow_id = runner.submit('slow')
+        wait_for(lambda: events == ['slow'])
+        urgent_id = runner.submit('urgent')
+    wait_for(lambda: job_status(app, urgent_id) == 'succeeded')
+    release.set()
+    wait_for(lambda: job_status(app, slow_id) == 'succeeded')
+    assert events == ['slow', 'urgent', 'slow']
+
+def test_queue_runs_highest_priority_first(app, runner):
+    events = []
+    runner.register('low', lambda context: events.append('low'))
+    runner.register('high', lambda context: events.append('high'), priority=1)
+    with app.app_context():
+        low_id = runner.submit('low')
+        runner.submit('high')
+    runner.start()
+    wait_for(lambda: job_status(app, low_id) == 'succeeded')
+    assert events == ['high', 'low']
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="per-thread priorities are Linux only")
+def test_prewarm_leaves_the_job_thread_priority_alone(app, write_image):
+    write_image('a.jpg')
+    service = app.extensions['thumbnails']
+    thread_priority = lambda: os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+    before = thread_priority()
+    service.prewarm()
+    assert thread_priority() == before
+    assert service._background.submit(thread_priority).result() == 19
+    assert os.path.exists(os.path.join(service.thumbnails_dir, 'a.jpg'))
+
+@pytest.mark.parametrize('body', [[], 'x', 3, None, {'kind': 'ingest', 'params': []},
+                                  {'kind': 'ingest', 'params': 'x'}, {'kind': 'nope'}])
+def test_job_api_rejects_malformed_bodies(client, body):
+    response = client.post('/api/jobs', json=body)
+    assert response.status_code == 400
+
+def test_job_api_queues_a_job(client):
+    response = client.post('/api/jobs', json={'kind': 'thumbnails', 'params': {'prewarm': True}})
+    assert response.status_code == 202
+    assert response.get_json()['params'] == {'prewarm': True}
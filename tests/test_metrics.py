@@ -0,0 +1,74 @@
+import re
+import logging
+import pytest
+import metrics
+from ingest import load_images_from_json
+from settings import Settings
+
+settings = Settings()
+
+@pytest.fixture
+def metrics_enabled():
+    # Before the app fixture, so booru_webui installs the request hooks
+    settings.set(True, 'metrics', 'enabled', save=False)
+
+def sample(text, name, **labels):
+    """The value of one series in a text exposition, or None if it is absent."""
+    wanted = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    pattern = re.escape(name) + (re.escape('{' + wanted + '}') if labels else '') + r' (\S+)$'
+    match = re.search(pattern, text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+def test_counter_and_histogram_rendering(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    counter = metrics.Counter('test_total', 'A counter.', ('route',))
+    histogram = metrics.Histogram('test_seconds', 'A histogram.', (0.1, 1), ('route',))
+    counter.inc(route='/a')
+    counter.inc(2, route='/a')
+    counter.inc(route='say "hi"\n')
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, route='/a')
+
+    text = metrics.render_metrics()
+    assert '# HELP test_total A counter.\n# TYPE test_total counter' in text
+    assert sample(text, 'test_total', route='/a') == 3
+    assert 'test_total{route="say \\"hi\\"\\n"} 1' in text
+    # Buckets are cumulative and end with +Inf
+    assert sample(text, 'test_seconds_bucket', route='/a', le='0.1') == 1
+    assert sample(text, 'test_seconds_bucket', route='/a', le='1') == 2
+    assert sample(text, 'test_seconds_bucket', route='/a', le='+Inf') == 3
+    assert sample(text, 'test_seconds_count', route='/a') == 3
+    assert sample(text, 'test_seconds_sum', route='/a') == pytest.approx(5.55)
+
+def test_metrics_endpoint(metrics_enabled, app, client, write_post):
+    write_post(1)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+
+    def requests(route, status=200):
+        text = client.get('/metrics').get_data(as_text=True)
+        return sample(text, 'booru_http_requests_total', route=route, method='GET', status=status) or 0
+
+    before = requests('/image/<int:image_id>')
+    assert client.get('/image/1').status_code == 200
+    assert client.get('/api/jobs/999').status_code == 404
+
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    # Routes are labelled by URL rule, so every image page is one series
+    assert sample(text, 'booru_http_requests_total', route='/image/<int:image_id>', method='GET',
+                  status=200) == before + 1
+    assert sample(text, 'booru_http_requests_total', route='/api/jobs/<int:job_id>', method='GET', status=404)
+    assert sample(text, 'booru_sql_queries_total', route='/image/<int:image_id>') > 0
+    assert sample(text, 'booru_http_request_duration_seconds_count', route='/image/<int:image_id>') >= 1
+    assert sample(text, 'booru_job_items_total', job='ingest') >= 1
+
+def test_slow_requests_are_logged(metrics_enabled, app, client, caplog):
+    settings.set(0, 'metrics', 'slow_request_ms', save=False)
+    with caplog.at_level(logging.WARNING, logger='metrics'):
+        client.get('/gallery')
+    assert 'Slow request GET /gallery (/gallery, 200)' in caplog.text
+
+def test_metrics_can_be_turned_off(client):
+    assert client.get('/metrics').status_code == 404
@@ -0,0 +1,77 @@
+import pytest
+from models import db, Image
+from ingest import load_images_from_json
+from neighbors import NeighborIndex
+from settings import Settings
+
+settings = Settings()
+
+@pytest.fixture
+def library(app, write_post):
+    # Scores tie in pairs, so walking by score also exercises the id tie-break
+    for post_id in range(1, 13):
+        write_post(post_id, score=post_id // 2)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+    return app
+
+@pytest.mark.parametrize('sort_by, sort_order', [('id', 'desc'), ('id', 'asc'), ('score', 'desc'), ('score', 'asc')])
+def test_walk_matches_the_full_order(library, sort_by, sort_order):
+    index = NeighborIndex(window=3)
+    queries = []
+
+    def make_query():
+        queries.append(1)
+        return Image.query
+
+    with library.app_context():
+        column = getattr(Image, sort_by)
+        ordering = (column.desc(), Image.id.desc()) if sort_order == 'desc' else (column.asc(), Image.id.asc())
+        ordered = [image.id for image in Image.query.order_by(*ordering)]
+
+        for i, image_id in enumerate(ordered):
+            image = db.session.get(Image, image_id)
+            prev_id, next_id, upcoming = index.neighbors('', make_query, sort_by, sort_order, image, 1, prefetch=2)
+            assert prev_id == (ordered[i - 1] if i > 0 else None)
+            assert next_id == (ordered[i + 1] if i + 1 < len(ordered) else None)
+            assert [image_id for image_id, _ in upcoming] == ordered[i + 1:i + 3]
+
+        # The window was refilled near its edges, not on every step
+        assert 1 < len(queries) < len(ordered)
+
+def test_window_at_the_ends_of_the_list(library):
+    index = NeighborIndex(window=3)
+    with library.app_context():
+        first, last = db.session.get(Image, 12), db.session.get(Image, 1)
+        assert index.neighbors('', lambda: Image.query, 'id', 'desc', first, 1)[:2] == (None, 11)
+        assert index.neighbors('', lambda: Image.query, 'id', 'desc', last, 1)[:2] == (2, None)
+
+        # At the real ends of the list the window is reused instead of refilled
+        def fail():
+            raise AssertionError("window should have been reused")
+        assert index.neighbors('', fail, 'id', 'desc', last, 1)[:2] == (2, None)
+        assert index.neighbors('', fail, 'id', 'desc', db.session.get(Image, 2), 1)[:2] == (3, 1)
+
+def test_generation_change_refills(library):
+    index = NeighborIndex(window=3)
+    calls = []
+
+    def make_query():
+        calls.append(1)
+        return Image.query
+
+    with library.app_context():
+        image = db.session.get(Image, 6)
+        index.neighbors('', make_query, 'id', 'desc', image, 1)
+        index.neighbors('', make_query, 'id', 'desc', image, 1)
+        assert len(calls) == 1
+        index.neighbors('', make_query, 'id', 'desc', image, 2)
+        assert len(calls) == 2
+
+def test_contexts_are_bounded(library):
+    index = NeighborIndex(window=3, max_contexts=2)
+    with library.app_context():
+        image = db.session.get(Image, 6)
+        for context in ('a', 'b', 'c'):
+            index.neighbors(context, lambda: Image.query, 'id', 'desc', image, 1)
+    assert [key[0] for key in index._windows] == ['b', 'c']
@@ -0,0 +1,123 @@
+import json
+import base64
+import pytest
+from datetime import datetime
+from models import Image
+from ingest import load_images_from_json
+from pagination import (SORT_COLUMNS, ListingRow, encode_cursor, decode_cursor, keyset_paginate,
+                        InvalidCursor)
+from settings import Settings
+
+settings = Settings()
+
+@pytest.fixture
+def posts(app, write_post):
+    for post_id in range(1, 31):
+        write_post(post_id, tags=('cat',), score=post_id % 4, fav_count=post_id % 3,
+                   created_at=datetime(2024, 1, 1 + post_id % 6).isoformat())
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+
+@pytest.mark.parametrize('sort_by, value', [
+    ('id', 42), ('score', -3), ('fav_count', 0), ('created_at', datetime(2024, 5, 6, 7, 8, 9, 123456)),
+])
+@pytest.mark.parametrize('direction', ['next', 'prev'])
+def test_cursor_round_trip(sort_by, value, direction):
+    row = ListingRow(id=42, md5='0' * 32, file_ext='jpg', image_width=1, image_height=1,
+                     score=value if sort_by == 'score' else 0,
+                     fav_count=value if sort_by == 'fav_count' else 0,
+                     created_at=value if sort_by == 'created_at' else None)
+    cursor = encode_cursor(sort_by, row, direction)
+    assert '=' not in cursor and '/' not in cursor and '+' not in cursor
+    assert decode_cursor(cursor) == (sort_by, value, 42, direction)
+
+def raw_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+@pytest.mark.parametrize('cursor', ['garbage', '', '!!!', 'e30', 'W10', 'bnVsbA'] + [
+    raw_cursor(payload) for payload in (
+        {'s': 'score', 'v': 1, 'id': 1, 'd': 'sideways'},
+        {'s': 'md5', 'v': 'abc', 'id': 1, 'd': 'next'},
+        {'s': 'score', 'v': 'abc', 'id': 1, 'd': 'next'},
+        {'s': 'score', 'v': True, 'id': 1, 'd': 'next'},
+        {'s': 'created_at', 'v': 5, 'id': 1, 'd': 'next'},
+        {'s': 'created_at', 'v': {'dt': 'not a date'}, 'id': 1, 'd': 'next'},
+        {'s': 'id', 'v': 1, 'id': 'x', 'd': 'next'},
+        {'s': 'id', 'v': 1, 'd': 'next'},
+    )
+])
+def test_invalid_cursors(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+def test_tampered_cursor_on_index_search(app, client, posts, tmp_path):
+    pytest.importorskip('numpy')
+    from tag_index import TagBitmapIndex
+    index = TagBitmapIndex(app, str(tmp_path / 'tag_index'))
+    with app.app_context():
+        index._save(index.build(), 'test')
+    index._load('test')
+    index.ready = lambda generation: True
+    app.extensions['tag_index'] = index
+    cursor = raw_cursor({'s': settings.get('gallery', 'sort_by'), 'v': 'abc', 'id': 1, 'd': 'next'})
+    response = client.get('/search', query_string={'q': 'cat', 'cursor': cursor})
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/search?q=cat')
+
+@pytest.mark.parametrize('sort_by', SORT_COLUMNS)
+@pytest.mark.parametrize('sort_order', ['asc', 'desc'])
+def test_walk_forward_and_back(app, posts, sort_by, sort_order):
+    with app.app_context():
+        query = Image.query
+        expected = sorted(query, key=lambda image: (getattr(image, sort_by), image.id),
+                          reverse=sort_order == 'desc')
+        expected = [image.id for image in expected]
+
+        seen, pages, cursor = [], [], None
+        while True:
+            page = keyset_paginate(query, sort_by, sort_order, 7, cursor)
+            pages.append([row.id for row in page.items])
+            seen.extend(pages[-1])
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        assert seen == expected
+
+        back = []
+        while page.has_prev:
+            page = keyset_paginate(query, sort_by, sort_order, 7, page.prev_cursor)
+            back.insert(0, [row.id for row in page.items])
+        assert back == pages[:-1]
+
+def test_cursor_for_another_sort_starts_over(app, posts):
+    with app.app_context():
+        first = keyset_paginate(Image.query, 'id', 'desc', 7)
+        page = keyset_paginate(Image.query, 'score', 'desc', 7, first.next_cursor)
+        assert page.items == keyset_paginate(Image.query, 'score', 'desc', 7).items
+
+def test_search_with_invalid_cursor_restarts(client, posts):
+    response = client.get('/search?q=cat&cursor=garbage')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/search?q=cat')
+
+def test_gallery_with_invalid_cursor_restarts(client, posts):
+    response = client.get('/gallery?cursor=garbage')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/gallery')
+
+def test_api_invalid_cursor_is_400(client, posts):
+    response = client.get('/api/posts?cursor=garbage')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_api_cursor_walk(client, posts):
+    seen, cursor = [], None
+    while True:
+        response = client.get('/api/posts', query_string={'limit': 8, 'cursor': cursor} if cursor else {'limit': 8})
+        data = response.get_json()
+        seen.extend(post['id'] for post in data['posts'])
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert sorted(seen) == list(range(1, 31))
+    assert len(seen) == len(set(seen))
@@ -0,0 +1,12 @@
+from pools import process_pool
+from settings import Settings
+
+settings = Settings()
+
+def read_setting(keys):
+    return Settings().get(*keys)
+
+def test_workers_see_unsaved_settings():
+    settings.set(77, 'thumbnails', 'quality', save=False)
+    with process_pool(2) as pool:
+        assert pool.map(read_setting, [('thumbnails', 'quality')] * 2) == [77, 77]
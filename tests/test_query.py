@@ -0,0 +1,83 @@
+import pytest
+from models import Image
+from query import parse_query, compile_query, query_order, QueryError, TagTerm, Not, And, Or, Meta
+from ingest import load_images_from_json
+from settings import Settings
+
+settings = Settings()
+
+def test_parse_tree():
+    assert parse_query('blue_sky') == TagTerm('blue_sky', None)
+    assert parse_query('a -b') == And((TagTerm('a', None), Not(TagTerm('b', None))))
+    assert parse_query('a or b') == Or((TagTerm('a', None), TagTerm('b', None)))
+    assert parse_query('a ~b ~c') == And((TagTerm('a', None), Or((TagTerm('b', None), TagTerm('c', None)))))
+    assert parse_query('saber_(fate)') == TagTerm('saber_(fate)', None)
+    assert parse_query('score:>5') == Meta('score', '>5')
+
+@pytest.mark.parametrize('text', [
+    '', '   ', '(a b', 'a )', 'a or', '*', 'a*b', 'x*', '""', '-~a',
+])
+def test_parse_errors(text):
+    with pytest.raises(QueryError):
+        parse_query(text)
+
+@pytest.mark.parametrize('text', ['order:score order:id', 'order:md5'])
+def test_order_errors(text):
+    with pytest.raises(QueryError):
+        query_order(parse_query(text))
+
+def test_order():
+    assert query_order(parse_query('a order:score_asc')) == ('score', 'asc')
+    assert query_order(parse_query('a order:favcount')) == ('fav_count', 'desc')
+    assert query_order(parse_query('a')) == (None, None)
+
+@pytest.mark.parametrize('text', ['score:abc', 'date:yesterday', 'id:..', 'width:>x'])
+def test_compile_errors(app, text):
+    # These parse, and only fail once the metatag value is compiled
+    node = parse_query(text)
+    with app.app_context(), pytest.raises(QueryError):
+        compile_query(Image.query, node)
+
+@pytest.mark.parametrize('text', ['-cat', '-a -b', '-a or -b', '(-a or b) -c', '-(a b)'])
+def test_negation_only_searches_are_rejected(app, text):
+    with app.app_context(), pytest.raises(QueryError):
+        compile_query(Image.query, parse_query(text))
+
+@pytest.mark.parametrize('text', ['a -b', 'rating:s -b', '(a or b) -c', '(a -b) or c', 'order:score'])
+def test_searches_with_a_positive_term_compile(app, text):
+    with app.app_context():
+        compile_query(Image.query, parse_query(text))
+
+def test_too_many_terms(app):
+    settings.set(3, 'search', 'max_terms', save=False)
+    with app.app_context(), pytest.raises(QueryError):
+        compile_query(Image.query, parse_query('a b c d'))
+
+def test_compiled_search_matches(app, write_post):
+    write_post(1, tags=('cat', 'outdoors'), score=10)
+    write_post(2, tags=('cat', 'indoors'), score=3)
+    write_post(3, tags=('dog', 'outdoors'), score=7)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+
+        def ids(text):
+            return sorted(image.id for image in compile_query(Image.query, parse_query(text)).query)
+
+        assert ids('cat') == [1, 2]
+        assert ids('cat -indoors') == [1]
+        assert ids('cat or dog') == [1, 2, 3]
+        assert ids('outdoors score:>8') == [1]
+        assert ids('missing_tag') == []
+
+def test_image_page_with_uncompilable_search(client, write_post, app):
+    write_post(1)
+    write_post(2)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+    assert client.get('/image/1?q=score:abc').status_code == 200
+    assert client.get('/image/1?q=(unbalanced').status_code == 200
+
+def test_search_errors_are_400(client):
+    response = client.get('/search?q=(a')
+    assert response.status_code == 400
+    assert client.get('/search?q=-cat').status_code == 400
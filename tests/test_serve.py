@@ -0,0 +1,53 @@
+import logging
+import pytest
+from sqlalchemy.exc import OperationalError
+from models import db
+from settings import Settings
+from stats import bump_generation, current_generation
+
+settings = Settings()
+
+@pytest.fixture
+def write_route(app):
+    """A route that bumps the library generation, for any method."""
+    @app.route('/test-write', methods=['GET', 'POST'])
+    def test_write():
+        bump_generation()
+        return 'ok'
+    return '/test-write'
+
+def test_get_requests_cannot_write(app, client, write_route):
+    with app.app_context():
+        before = current_generation()
+    with pytest.raises(OperationalError, match='readonly'):
+        client.get(write_route)
+    with app.app_context():
+        db.session.rollback()
+        assert current_generation() == before
+
+    assert client.post(write_route).status_code == 200
+    with app.app_context():
+        assert current_generation() == before + 1
+        # The pooled connection a GET used is writable again for jobs
+        bump_generation()
+        assert current_generation() == before + 2
+
+def test_warm_up(app, write_post, caplog):
+    from serve import warm_up
+    from ingest import load_images_from_json
+    write_post(1, tags=('cat',))
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+    settings.set(['/', '/gallery', '/no-such-page'], 'server', 'warmup_urls', save=False)
+    with caplog.at_level(logging.INFO, logger='serve'):
+        warm_up(app)
+    assert 'Warm-up request /no-such-page returned 404' in caplog.text
+    assert 'Warmed up in' in caplog.text
+    with app.app_context():
+        assert app.extensions['autocomplete'].complete('c', current_generation()) == [('cat', 'general', 1)]
+
+def test_parse_args_defaults_come_from_settings():
+    from serve import parse_args
+    settings.set(3, 'server', 'threads', save=False)
+    args = parse_args(['--workers', '2'])
+    assert (args.threads, args.workers) == (3, 2)
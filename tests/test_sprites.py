@@ -0,0 +1,60 @@
+import os
+import time
+import threading
+from collections import namedtuple
+import pytest
+from wand.image import Image as WandImage
+from settings import Settings
+from sprites import SpriteService, plan_sheet
+from thumbnails import variant_filename
+
+settings = Settings()
+
+Post = namedtuple('Post', 'id md5 file_ext image_width image_height')
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+@pytest.fixture
+def sprites(app, tmp_path):
+    settings.set([100, 200], 'thumbnails', 'sizes', save=False)
+    settings.set(['jpeg'], 'thumbnails', 'formats', save=False)
+    settings.set(2, 'sprites', 'columns', save=False)
+    return SpriteService(app.extensions['thumbnails'], str(tmp_path / 'sprites'))
+
+def test_tile_map(sprites):
+    posts = [Post(1, 'a', 'jpg', 300, 200), Post(2, 'b', 'jpg', 100, 400), Post(3, 'c', 'png', 50, 50)]
+    sheet = plan_sheet(posts)
+    # Rows of two 100px cells; the tall image is capped at twice the tile width, the small one never upscaled
+    assert sheet.tiles == {1: (0, 0, 100, 67), 2: (100, 0, 50, 200), 3: (0, 200, 50, 50)}
+    assert (sheet.width, sheet.height) == (200, 250)
+    assert sheet.members == ['a.jpg', 'b.jpg', 'c.png']
+
+    assert plan_sheet(posts).key == sheet.key
+    settings.set(3, 'sprites', 'columns', save=False)
+    assert plan_sheet(posts).key != sheet.key
+
+def test_cold_sheet_generates_tiles_outside_the_lock(sprites, write_image, caplog):
+    posts = [Post(i, f'{i:032x}', 'jpg', 300, 200) for i in range(1, 5)]
+    for post in posts[:3]:
+        write_image(f'{post.md5}.jpg')
+    sheet = sprites.sheet_for(posts)
+    thumbnails_dir = sprites.thumbnails.thumbnails_dir
+    tiles = [os.path.join(thumbnails_dir, variant_filename(f'{post.md5}.jpg', 100, 'jpeg')) for post in posts[:3]]
+
+    # Another sheet is being written: the tiles for this one are still generated meanwhile
+    with sprites._lock:
+        builder = threading.Thread(target=sprites.ensure, args=(sheet.key,))
+        builder.start()
+        wait_for(lambda: all(os.path.exists(path) for path in tiles))
+    builder.join(timeout=30)
+
+    with WandImage(filename=os.path.join(sprites.sprites_dir, f'{sheet.key}.{sprites.extension}')) as atlas:
+        assert (atlas.width, atlas.height) == (sheet.width, sheet.height)
+    # Only the post without a source image is left blank
+    blank = [record.getMessage() for record in caplog.records if 'leaving its tile blank' in record.getMessage()]
+    assert blank == [f'No thumbnail for {posts[3].md5}.jpg, leaving its tile blank']
@@ -0,0 +1,84 @@
+import time
+import threading
+import pytest
+from datetime import datetime, timedelta
+from models import Image
+from ingest import load_images_from_json
+from pagination import SORT_COLUMNS, keyset_paginate
+from query import parse_query, compile_query
+from settings import Settings
+
+np = pytest.importorskip('numpy')
+
+settings = Settings()
+
+@pytest.fixture
+def index(app, tmp_path, write_post):
+    from tag_index import TagBitmapIndex
+    start = datetime(2024, 1, 1)
+    for post_id in range(1, 121):
+        tags = ['common'] + (['even'] if post_id % 2 == 0 else []) + (['third'] if post_id % 3 == 0 else [])
+        # Few distinct scores and dates, so the sort keys are full of ties
+        write_post(post_id, tags=tags, score=post_id % 7, fav_count=post_id % 4,
+                   created_at=(start + timedelta(days=post_id % 5)).isoformat(),
+                   is_deleted=post_id % 11 == 0)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+    index = TagBitmapIndex(app, str(tmp_path / 'tag_index'), rebuild_interval=0)
+    with app.app_context():
+        index._save(index.build(), 1)
+    assert index._load(1)
+    return index
+
+def walk(paginate):
+    """Every id reached by following next cursors, then back again by prev cursors."""
+    forward, pages, cursor = [], [], None
+    while True:
+        page = paginate(cursor)
+        pages.append([row.id for row in page.items])
+        forward.extend(pages[-1])
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+    backward = []
+    while page.has_prev:
+        page = paginate(page.prev_cursor)
+        backward = [row.id for row in page.items] + backward
+    return forward, backward, pages
+
+@pytest.mark.parametrize('sort_by', SORT_COLUMNS)
+@pytest.mark.parametrize('sort_order', ['asc', 'desc'])
+@pytest.mark.parametrize('text', ['common', 'even -third', 'even or third', 'even ~third ~common'])
+def test_index_pages_match_sql(app, index, sort_by, sort_order, text):
+    with app.app_context():
+        node = parse_query(text)
+        from_index = walk(lambda cursor: index.paginate(node, sort_by, sort_order, 7, cursor, True, True))
+        query = compile_query(Image.query.filter(Image.is_deleted == False, Image.is_banned == False), node).query
+        from_sql = walk(lambda cursor: keyset_paginate(query, sort_by, sort_order, 7, cursor))
+    assert from_index[2] == from_sql[2]
+    assert len(set(from_index[0])) == len(from_index[0])
+    # Walking back from the last page ends where the first page started
+    assert from_index[1] == from_index[0][:len(from_index[1])]
+
+def test_rebuilds_coalesce_to_latest_generation(app, index, monkeypatch):
+    builds = []
+    started, release = threading.Event(), threading.Event()
+    original = index.build
+
+    def build():
+        builds.append(index._wanted)
+        started.set()
+        release.wait(5)
+        return original()
+
+    monkeypatch.setattr(index, 'build', build)
+    assert not index.ready(2)
+    assert started.wait(5)
+    for generation in (3, 4, 5):
+        assert not index.ready(generation)
+    release.set()
+    deadline = time.monotonic() + 10
+    while not index.ready(5):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert builds == [2, 5]
@@ -0,0 +1,64 @@
+import os
+from sqlalchemy import select
+from models import db, Tag, TagCount
+from ingest import load_images_from_json
+from settings import Settings
+from tags import rebuild_tag_counts, top_tags
+
+settings = Settings()
+
+def counts():
+    return sorted(db.session.execute(
+        select(Tag.name, TagCount.exclude_deleted, TagCount.exclude_banned, TagCount.category, TagCount.count)
+        .join(Tag, Tag.id == TagCount.tag_id)
+    ).all())
+
+def assert_matches_rebuild():
+    """The incrementally maintained tag_counts must equal a rebuild from scratch."""
+    incremental = counts()
+    rebuild_tag_counts()
+    db.session.commit()
+    assert counts() == incremental
+
+def test_incremental_counts_match_rebuild(app, write_post):
+    path = settings.get('paths', 'source_json')
+    with app.app_context():
+        write_post(1, tags=('cat', 'outdoors'))
+        write_post(2, tags=('cat', 'indoors'))
+        write_post(3, tags=('dog', 'outdoors'), is_deleted=True)
+        write_post(4, tags=('dog',), is_banned=True)
+        load_images_from_json(path)
+        assert_matches_rebuild()
+
+        # Tag edits
+        write_post(1, tags=('cat', 'indoors', 'night'))
+        write_post(2, tags=('dog',))
+        load_images_from_json(path)
+        assert_matches_rebuild()
+
+        # Deleted and banned flags flip both ways
+        write_post(1, tags=('cat', 'indoors', 'night'), is_deleted=True)
+        write_post(3, tags=('dog', 'outdoors'))
+        write_post(4, tags=('dog',), is_banned=False, is_deleted=True)
+        load_images_from_json(path)
+        assert_matches_rebuild()
+
+        # A flag change together with a tag change
+        write_post(3, tags=('cat',), is_banned=True)
+        load_images_from_json(path)
+        assert_matches_rebuild()
+
+        # A post whose sidecar is gone
+        os.remove(os.path.join(path, '2.json'))
+        load_images_from_json(path)
+        assert_matches_rebuild()
+
+def test_top_tags_respect_filters(app, write_post):
+    write_post(1, tags=('cat',))
+    write_post(2, tags=('cat', 'dog'), is_deleted=True)
+    write_post(3, tags=('dog',), is_banned=True)
+    with app.app_context():
+        load_images_from_json(settings.get('paths', 'source_json'))
+        assert dict(top_tags(10, False, False)) == {'cat': 2, 'dog': 2}
+        assert dict(top_tags(10, True, False)) == {'cat': 1, 'dog': 1}
+        assert dict(top_tags(10, True, True)) == {'cat': 1}
@@ -0,0 +1,120 @@
+import os
+import pytest
+from models import db, ThumbnailManifest
+from settings import Settings
+from thumbnails import (variant_filename, thumbnail_sizes, thumbnail_settings_hash, update_thumbnails,
+                        hash_existing_thumbnails)
+
+settings = Settings()
+
+MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+
+@pytest.fixture
+def service(app):
+    return app.extensions['thumbnails']
+
+@pytest.mark.parametrize('filename, source', [
+    (f'{MD5}.jpg', f'{MD5}.jpg'),
+    (f'{MD5}_128.webp', f'{MD5}.jpg'),
+    (f'{MD5}_128.jpg', f'{MD5}.jpg'),
+    (f'{MD5}_256.png', f'{MD5}.jpg'),
+    ('other_128.jpg', 'other.png'),
+    ('other.png', 'other.png'),
+    ('missing_128.jpg', None),
+    ('missing.jpg', None),
+    (f'{MD5}.txt', None),
+    ('../images/other.png', None),
+])
+def test_source_for(service, write_image, filename, source):
+    write_image(f'{MD5}.jpg')
+    write_image('other.png')
+    assert service.source_for(filename) == source
+
+def test_source_named_like_a_variant(service, write_image):
+    # An original that happens to end in _<digits> is its own base thumbnail
+    write_image('photo_2024.jpg')
+    assert service.source_for('photo_2024.jpg') == 'photo_2024.jpg'
+    assert service.source_for('photo_2024_128.webp') == 'photo_2024.jpg'
+
+@pytest.mark.parametrize('fmt', ['jpeg', 'webp'])
+def test_variant_generated_on_request(app, client, write_image, fmt):
+    write_image(f'{MD5}.jpg')
+    filename = variant_filename(f'{MD5}.jpg', thumbnail_sizes()[0], fmt)
+    response = client.get(f'/static/thumbnails/{filename}')
+    assert response.status_code == 200
+    assert os.path.isfile(os.path.join(app.extensions['thumbnails'].thumbnails_dir, filename))
+
+def test_missing_source_is_404(client):
+    assert client.get(f'/static/thumbnails/{MD5}_128.jpg').status_code == 404
+
+def test_current_thumbnail_is_immutable(client, write_image):
+    write_image(f'{MD5}.jpg')
+    version = thumbnail_settings_hash()
+    response = client.get(f'/static/thumbnails/{MD5}_128.webp?v={version}')
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+
+def test_stale_thumbnail_is_regenerated_before_immutable(app, client, write_image):
+    write_image(f'{MD5}.jpg')
+    filename = f'{MD5}_128.webp'
+    path = os.path.join(app.extensions['thumbnails'].thumbnails_dir, filename)
+    assert client.get(f'/static/thumbnails/{filename}').status_code == 200
+    os.utime(path, (1, 1))
+
+    settings.set(settings.get('thumbnails', 'quality') - 10, 'thumbnails', 'quality', save=False)
+    version = thumbnail_settings_hash()
+    response = client.get(f'/static/thumbnails/{filename}?v={version}')
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert os.stat(path).st_mtime > 1
+    with app.app_context():
+        assert db.session.get(ThumbnailManifest, f'{MD5}.jpg').settings_hash == version
+
+def test_thumbnail_without_manifest_entry_is_regenerated(app, write_image):
+    # A file on disk that the manifest does not vouch for, e.g. copied in by hand
+    write_image(f'{MD5}.jpg')
+    service = app.extensions['thumbnails']
+    path = os.path.join(service.thumbnails_dir, f'{MD5}_128.webp')
+    with open(path, 'wb') as f:
+        f.write(b'stale')
+    with app.app_context():
+        assert not service.is_current(f'{MD5}.jpg')
+        assert service.ensure(f'{MD5}_128.webp', timeout=30)
+        assert service.is_current(f'{MD5}.jpg')
+    with open(path, 'rb') as f:
+        assert f.read() != b'stale'
+
+def test_changed_source_is_not_current(app, write_image):
+    write_image(f'{MD5}.jpg')
+    service = app.extensions['thumbnails']
+    with app.app_context():
+        assert service.ensure(f'{MD5}.jpg', timeout=30)
+        assert service.is_current(f'{MD5}.jpg')
+        write_image(f'{MD5}.jpg', width=400)
+        assert not service.is_current(f'{MD5}.jpg')
+        assert service.ensure(f'{MD5}.jpg', timeout=30)
+        assert service.is_current(f'{MD5}.jpg')
+
+def test_current_memo_is_bounded(app, write_image):
+    service = app.extensions['thumbnails']
+    service.memo_size = 2
+    with app.app_context():
+        for name in ('a', 'b', 'c'):
+            write_image(f'{name}.jpg')
+            assert service.ensure(f'{name}.jpg', timeout=30)
+    assert list(service._current) == ['b.jpg', 'c.jpg']
+
+def test_update_thumbnails_with_process_pool(app, write_image):
+    for name in ('a', 'b', 'c'):
+        write_image(f'{name}.jpg')
+    settings.set(200, 'processing', 'cpu_usage_percent', save=False)
+    service = app.extensions['thumbnails']
+    with app.app_context():
+        assert update_thumbnails(settings.get('paths', 'source_images'), service.thumbnails_dir) == 3
+        rows = db.session.query(ThumbnailManifest).all()
+        assert sorted(row.filename for row in rows) == ['a.jpg', 'b.jpg', 'c.jpg']
+        assert all(row.phash is not None for row in rows)
+
+        db.session.query(ThumbnailManifest).update({'phash': None})
+        db.session.commit()
+        assert hash_existing_thumbnails(service.thumbnails_dir, processes=2) == 3
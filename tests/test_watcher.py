@@ -0,0 +1,138 @@
+import os
+import time
+from models import db, Image, Job
+from watcher import LibraryWatcher, ScanSource
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+def make_watcher(app, tmp_path, handle, **options):
+    options.setdefault('debounce', 0)
+    return LibraryWatcher(app, tmp_path / 'json', tmp_path / 'images', handle, lambda: None, backend='scan',
+                          **options)
+
+def download(watcher, directory, name, now, age=60):
+    """Write a file that finished downloading ``age`` seconds ago and report it to the watcher."""
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write('{}')
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    watcher._add(directory, name, now)
+
+def test_failed_batch_is_retried(app, tmp_path):
+    calls = []
+
+    def handle(json_files, image_files):
+        calls.append((json_files, image_files))
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+
+    watcher = make_watcher(app, tmp_path, handle)
+    now = time.monotonic()
+    download(watcher, watcher.json_dir, 'a.jpg.json', now)
+    download(watcher, watcher.images_dir, 'a.jpg', now)
+
+    watcher._flush(now + 1)
+    assert calls == [(['a.jpg.json'], ['a.jpg'])]
+    assert set(watcher.pending) == {'a.jpg'}
+
+    watcher._flush(time.monotonic() + 1)
+    assert calls[1] == (['a.jpg.json'], ['a.jpg'])
+    assert not watcher.pending
+
+def test_downloads_job_ingests_a_batch(app, write_post):
+    write_post(1, tags=('tag_a',))
+    runner = app.extensions['jobs']
+    runner.start()
+    try:
+        with app.app_context():
+            job_id = runner.submit('downloads', {'json': ['1.json'], 'images': []})
+
+        def succeeded():
+            with app.app_context():
+                return db.session.get(Job, job_id).status == 'succeeded'
+
+        wait_for(succeeded)
+        with app.app_context():
+            assert db.session.get(Image, 1) is not None
+    finally:
+        runner.shutdown()
+
+def test_batches_are_split_by_batch_size(app, tmp_path):
+    watcher = make_watcher(app, tmp_path, None, batch_size=2)
+    now = time.monotonic()
+    for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+        download(watcher, watcher.json_dir, f'{name}.json', now)
+        download(watcher, watcher.images_dir, name, now)
+    batches = watcher._ready(now + 1)
+    assert [sorted(images) for _, images in batches] == [['a.jpg', 'b.jpg'], ['c.jpg']]
+    assert sorted(name for json_files, _ in batches for name in json_files) == [
+        'a.jpg.json', 'b.jpg.json', 'c.jpg.json']
+    assert not watcher.pending
+
+def test_waits_for_quiet_or_max_delay(app, tmp_path):
+    watcher = make_watcher(app, tmp_path, None, debounce=1.0, max_delay=5.0)
+    now = time.monotonic()
+    download(watcher, watcher.json_dir, 'a.jpg.json', now)
+    download(watcher, watcher.images_dir, 'a.jpg', now)
+    # Events still arriving
+    assert watcher._ready(now + 0.5) == []
+    assert len(watcher._ready(now + 1.5)) == 1
+
+    # A steady stream never goes quiet, but the oldest post is handed on after max_delay
+    download(watcher, watcher.json_dir, 'b.jpg.json', now)
+    download(watcher, watcher.images_dir, 'b.jpg', now)
+    watcher.last_event = now + 5.5
+    assert watcher._ready(now + 5.9) != []
+
+def test_half_of_a_pair_waits_for_the_other(app, tmp_path):
+    watcher = make_watcher(app, tmp_path, None, pair_timeout=30.0)
+    now = time.monotonic()
+    download(watcher, watcher.images_dir, 'a.jpg', now)
+    assert watcher._ready(now + 1) == []
+    download(watcher, watcher.json_dir, 'a.jpg.json', now + 2)
+    assert watcher._ready(now + 3) == [(['a.jpg.json'], ['a.jpg'])]
+
+    # Without its sidecar an image is still handed on after pair_timeout
+    download(watcher, watcher.images_dir, 'b.jpg', now)
+    assert watcher._ready(now + 31) == [([], ['b.jpg'])]
+
+def test_a_sidecar_pairs_with_an_image_already_on_disk(app, tmp_path):
+    watcher = make_watcher(app, tmp_path, None)
+    now = time.monotonic()
+    (tmp_path / 'images' / 'a.jpg').write_bytes(b'')
+    download(watcher, watcher.json_dir, 'a.jpg.json', now)
+    assert watcher._ready(now + 1) == [(['a.jpg.json'], [])]
+
+def test_files_written_recently_are_held_back(app, tmp_path):
+    watcher = make_watcher(app, tmp_path, None, debounce=1.0)
+    now = time.monotonic()
+    download(watcher, watcher.json_dir, 'a.jpg.json', now, age=0)
+    download(watcher, watcher.images_dir, 'a.jpg', now, age=60)
+    assert watcher._ready(now + 2) == []
+    assert set(watcher.pending) == {'a.jpg'}
+
+def test_removed_files_are_dropped(app, tmp_path):
+    watcher = make_watcher(app, tmp_path, None)
+    now = time.monotonic()
+    download(watcher, watcher.json_dir, 'a.jpg.json', now)
+    os.remove(tmp_path / 'json' / 'a.jpg.json')
+    assert watcher._ready(now + 31) == []
+    assert not watcher.pending
+
+def test_scan_source_reports_new_files(tmp_path):
+    directory = str(tmp_path / 'json')
+    os.makedirs(directory)
+    (tmp_path / 'json' / 'old.json').write_text('{}')
+    source = ScanSource([directory], interval=0)
+    (tmp_path / 'json' / 'new.json').write_text('{}')
+    (tmp_path / 'json' / 'notes.txt').write_text('')
+    # Directory mtimes this fresh are always re-listed, so the new file is seen
+    events, lost = source.poll(0)
+    assert (events, lost) == ([(directory, 'new.json')], False)
+    assert source.poll(0) == ([], False)
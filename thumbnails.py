@@ -0,0 +1,487 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime
+from math import ceil
+from multiprocessing import cpu_count
+from sqlalchemy import select, delete, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from tqdm import tqdm
+from werkzeug.security import safe_join
+from wand.image import Image as WandImage
+from models import db, ThumbnailManifest
+from similar import HASH_WIDTH, HASH_HEIGHT, dhash, record_phashes
+from metrics import record_job
+from pools import process_pool
+from settings import Settings
+from tags import chunks
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.gif', '.jpeg')
+
+# File extensions for the output formats thumbnail variants can use
+FORMAT_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg', 'png': 'png', 'avif': 'avif'}
+THUMBNAIL_EXTENSIONS = IMAGE_EXTENSIONS + tuple(f'.{ext}' for ext in FORMAT_EXTENSIONS.values())
+
+# Settings that change how a thumbnail looks; anything else can change freely
+RENDER_SETTINGS = ('width', 'quality', 'compression_level', 'sizes', 'formats')
+
+VARIANT_PATTERN = re.compile(r'^(?P<stem>.+)_(?P<width>\d+)\.(?P<ext>[a-z]+)$')
+
+def thumbnail_sizes():
+    """Widths of the srcset variants, smallest first."""
+    return sorted(set(settings.get('thumbnails', 'sizes', default=[settings.get('thumbnails', 'width')])))
+
+def thumbnail_formats():
+    """Output formats of the srcset variants, preferred first."""
+    return [fmt for fmt in settings.get('thumbnails', 'formats', default=['jpeg']) if fmt in FORMAT_EXTENSIONS]
+
+def variant_filename(filename, width, fmt):
+    """Name of the ``width`` px ``fmt`` variant of a source image's thumbnail."""
+    return f"{os.path.splitext(filename)[0]}_{width}.{FORMAT_EXTENSIONS[fmt]}"
+
+def thumbnail_filenames(filename):
+    """Every thumbnail file generated for a source: the base thumbnail plus its variants."""
+    return [filename] + [
+        variant_filename(filename, width, fmt)
+        for width in thumbnail_sizes()
+        for fmt in thumbnail_formats()
+    ]
+
+def _save_atomic(img, path):
+    """Write to a temporary file and rename so readers never see a partial thumbnail."""
+    tmp_path = os.path.join(os.path.dirname(path),
+                            f'.{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            img.save(file=f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def perceptual_hash(img):
+    """dHash of a decoded image, for finding re-encodes and resizes of the same picture."""
+    with img.clone() as small:
+        small.transform_colorspace('gray')
+        small.resize(HASH_WIDTH + 1, HASH_HEIGHT)
+        return dhash(small.export_pixels(channel_map='I', storage='char'))
+
+def hash_thumbnail(thumb_path):
+    """Perceptual hash from an existing thumbnail, for sources rendered before hashing existed."""
+    try:
+        with WandImage(filename=thumb_path) as img:
+            return perceptual_hash(img)
+    except Exception as e:
+        logger.error(f"Error hashing thumbnail {thumb_path}: {str(e)}")
+        return None
+
+def generate_single_thumbnail(args):
+    """Generate a thumbnail and all of its size/format variants using ImageMagick.
+
+    The source is decoded once; every output is resized from that decode,
+    and so is its perceptual hash. Returns the hash, or None on failure.
+    """
+    source_path, thumb_path, width = args
+    quality = settings.get('thumbnails', 'quality')
+    try:
+        with WandImage(filename=source_path) as img:
+            # Strip metadata to reduce size
+            img.strip()
+
+            # Base thumbnail: exactly ``width`` px wide, in the source's format
+            with img.clone() as thumb:
+                # Calculate height maintaining aspect ratio
+                ratio = width / img.width
+                height = int(img.height * ratio)
+
+                # Resize using high-quality Lanczos filter
+                thumb.resize(width, height, filter='lanczos2')
+                thumb.compression_quality = quality
+
+                # Optimize output format based on original
+                if thumb_path.lower().endswith('.png'):
+                    thumb.format = 'png'
+                    thumb.options['png:compression-level'] = str(settings.get('thumbnails', 'compression_level'))
+                else:
+                    thumb.format = 'jpeg'
+                _save_atomic(thumb, thumb_path)
+
+            # srcset variants, never upscaled past the source
+            thumbnails_dir = os.path.dirname(thumb_path)
+            filename = os.path.basename(thumb_path)
+            for variant_width in thumbnail_sizes():
+                target = min(variant_width, img.width)
+                with img.clone() as variant:
+                    variant.resize(target, max(1, int(img.height * target / img.width)), filter='lanczos2')
+                    variant.compression_quality = quality
+                    for fmt in thumbnail_formats():
+                        variant.format = fmt
+                        _save_atomic(variant, os.path.join(thumbnails_dir,
+                                                           variant_filename(filename, variant_width, fmt)))
+            return perceptual_hash(img)
+    except Exception as e:
+        logger.error(f"Error generating thumbnail for {source_path}: {str(e)}")
+        return None
+
+def thumbnail_settings_hash():
+    """Hash the thumbnail settings so entries made with other settings count as stale."""
+    raw = json.dumps({key: settings.get('thumbnails', key) for key in RENDER_SETTINGS},
+                     sort_keys=True).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+def scan_images(path, extensions=IMAGE_EXTENSIONS):
+    """Return {filename: (size, mtime)} for the image files in a directory."""
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(extensions) and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime)
+    return files
+
+def record_thumbnails(entries):
+    """Upsert manifest rows for freshly generated thumbnails, and their hashes onto the images."""
+    if not entries:
+        return
+    stmt = sqlite_insert(ThumbnailManifest.__table__)
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['filename'],
+            set_={name: stmt.excluded[name] for name in ('size', 'mtime', 'settings_hash', 'generated_at', 'phash')}
+        ),
+        entries
+    )
+    record_phashes({entry['filename']: entry['phash'] for entry in entries})
+    db.session.commit()
+
+def hash_existing_thumbnails(thumbnails_dir, processes=None):
+    """Fill in perceptual hashes for manifest entries made before hashing existed.
+
+    The base thumbnail is decoded instead of the original, which is far
+    cheaper and gives the same hash up to a bit or two. With
+    ``processes=1`` the work stays on the calling thread.
+    """
+    unhashed = db.session.execute(
+        select(ThumbnailManifest.filename).where(ThumbnailManifest.phash.is_(None))
+    ).scalars().all()
+    unhashed = [filename for filename in unhashed if os.path.exists(os.path.join(thumbnails_dir, filename))]
+    if not unhashed:
+        return 0
+
+    hashes = {}
+    paths = [os.path.join(thumbnails_dir, filename) for filename in unhashed]
+    processes = processes or pool_size()
+    with process_pool(processes) if processes > 1 else nullcontext() as pool:
+        results = pool.imap(hash_thumbnail, paths, chunksize=64) if pool else map(hash_thumbnail, paths)
+        for filename, phash in tqdm(zip(unhashed, results), total=len(unhashed), desc="Hashing thumbnails"):
+            if phash is not None:
+                hashes[filename] = phash
+    for chunk in chunks(list(hashes.items())):
+        db.session.execute(
+            ThumbnailManifest.__table__.update()
+            .where(ThumbnailManifest.__table__.c.filename == bindparam('b_filename'))
+            .values(phash=bindparam('b_phash')),
+            [{'b_filename': filename, 'b_phash': phash} for filename, phash in chunk]
+        )
+        record_phashes(dict(chunk))
+        db.session.commit()
+    logger.info(f"Hashed {len(hashes)} existing thumbnails")
+    return len(hashes)
+
+def find_stale_thumbnails(images_dir, thumbnails_dir):
+    """Remove orphaned thumbnails and return the sources that need (re)generating.
+
+    A source is stale if it is new, changed (size or mtime), was rendered
+    with different thumbnail settings, or its thumbnail file has gone
+    missing. Returns (pending filenames, {filename: (size, mtime)}).
+    """
+    sources = scan_images(images_dir)
+    thumbnails = set(scan_images(thumbnails_dir, THUMBNAIL_EXTENSIONS))
+    manifest = {
+        row.filename: (row.size, row.mtime, row.settings_hash)
+        for row in db.session.execute(select(
+            ThumbnailManifest.filename, ThumbnailManifest.size,
+            ThumbnailManifest.mtime, ThumbnailManifest.settings_hash
+        ))
+    }
+    settings_hash = thumbnail_settings_hash()
+
+    # Remove orphans (including variants from old sizes/formats) so a reused filename starts clean
+    expected = {name: source for source in sources for name in thumbnail_filenames(source)}
+    orphans = [name for name in thumbnails if name not in expected]
+    for filename in orphans:
+        try:
+            os.remove(os.path.join(thumbnails_dir, filename))
+        except OSError as e:
+            logger.error(f"Error removing orphaned thumbnail {filename}: {str(e)}")
+    stale_rows = [name for name in manifest if name not in sources]
+    for chunk in chunks(stale_rows):
+        db.session.execute(delete(ThumbnailManifest.__table__).where(ThumbnailManifest.filename.in_(chunk)))
+    db.session.commit()
+    if orphans or stale_rows:
+        logger.info(f"Removed {len(orphans)} orphaned thumbnails")
+
+    pending = [
+        filename for filename, (size, mtime) in sources.items()
+        if manifest.get(filename) != (size, mtime, settings_hash)
+        or not all(name in thumbnails for name in thumbnail_filenames(filename))
+    ]
+    return pending, sources
+
+def lower_priority():
+    """Thread initializer: drop the calling thread to the lowest scheduling priority where the OS allows it (Linux)."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+def pool_size():
+    """Worker processes to use: the configured percentage of CPU cores."""
+    return ceil(cpu_count() * (settings.get('processing', 'cpu_usage_percent') / 100))
+
+def manifest_entry(filename, size, mtime, phash=None):
+    return {'filename': filename, 'size': size, 'mtime': mtime,
+            'settings_hash': thumbnail_settings_hash(), 'generated_at': datetime.now(), 'phash': phash}
+
+def update_thumbnails(images_dir, thumbnails_dir, progress=None):
+    """Bring the thumbnails folder in line with the images folder.
+
+    Only stale or missing thumbnails are generated, using a process pool.
+    Returns the number of thumbnails generated. ``progress(done, total)``
+    is called per source; if it raises, the thumbnails made so far are
+    recorded first, so the next run skips them.
+    """
+    pending, sources = find_stale_thumbnails(images_dir, thumbnails_dir)
+    if not pending:
+        logger.info("Thumbnails are up to date")
+        hash_existing_thumbnails(thumbnails_dir)
+        return 0
+
+    width = settings.get('thumbnails', 'width')
+    tasks = [
+        (os.path.join(images_dir, filename), os.path.join(thumbnails_dir, filename), width)
+        for filename in pending
+    ]
+
+    # Use configured percentage of CPU cores
+    num_processes = pool_size()
+    logger.info(f"Generating {len(tasks)} thumbnails with {num_processes} processes")
+
+    generated = 0
+    entries = []
+    batch_started = time.perf_counter()
+    try:
+        with process_pool(num_processes) as pool:
+            results = pool.imap(generate_single_thumbnail, tasks, chunksize=16)
+            for done, (filename, phash) in enumerate(
+                    tqdm(zip(pending, results), total=len(tasks), desc="Generating thumbnails"), 1):
+                if phash is not None:
+                    entries.append(manifest_entry(filename, *sources[filename], phash=phash))
+                    generated += 1
+                if len(entries) >= settings.get('processing', 'batch_size'):
+                    record_thumbnails(entries)
+                    record_job('thumbnail_batch', time.perf_counter() - batch_started, len(entries))
+                    entries = []
+                    batch_started = time.perf_counter()
+                if progress:
+                    progress(done, len(tasks))
+    finally:
+        record_thumbnails(entries)
+        if entries:
+            record_job('thumbnail_batch', time.perf_counter() - batch_started, len(entries))
+    hash_existing_thumbnails(thumbnails_dir)
+
+    logger.info(f"Successfully generated {generated} thumbnails")
+    return generated
+
+class ThumbnailService:
+    """Generates missing thumbnails on demand.
+
+    Work runs on a bounded thread pool, and concurrent requests for the
+    same file share one generation job. Pre-warming has its own
+    low-priority thread, so it never takes a slot from a request.
+    """
+
+    def __init__(self, app, images_dir, thumbnails_dir, max_workers=2, memo_size=65536):
+        self.app = app
+        self.images_dir = images_dir
+        self.thumbnails_dir = thumbnails_dir
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='thumbnail')
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnail-prewarm',
+                                              initializer=lower_priority)
+        self._pending = {}
+        self._lock = threading.Lock()
+        # source -> (size, mtime, settings hash) its thumbnails were last known to be rendered from;
+        # the most recently used ``memo_size`` sources are kept
+        self.memo_size = memo_size
+        self._current = OrderedDict()
+
+    def source_for(self, filename):
+        """Map a thumbnail filename (base or variant) to its source image filename, or None if there is none.
+
+        A name counts as a base thumbnail only if that source exists, since
+        JPEG and PNG variants such as ``<md5>_128.jpg`` share its extensions.
+        """
+        candidates = []
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            candidates.append(filename)
+        match = VARIANT_PATTERN.match(filename)
+        if match:
+            candidates.extend(match.group('stem') + ext for ext in IMAGE_EXTENSIONS)
+        for source in candidates:
+            source_path = safe_join(self.images_dir, source)
+            if source_path and os.path.isfile(source_path):
+                return source
+        return None
+
+    def ensure(self, filename, timeout=None):
+        """Make sure the thumbnail file ``filename`` exists and is current, (re)generating it if needed.
+
+        Requesting any variant generates the base thumbnail and every
+        variant of that source in one job. A file made from an older
+        source or with other thumbnail settings is regenerated, so True
+        means the file matches thumbnail_settings_hash(). Returns False if
+        there is no source image to generate it from. Raises
+        concurrent.futures.TimeoutError if generation takes longer than
+        ``timeout`` seconds.
+        """
+        request = self._request(filename)
+        if request is None:
+            return False
+        thumb_path, future = request
+        return future is None or (future.result(timeout=timeout) and os.path.exists(thumb_path))
+
+    def ensure_all(self, filenames, timeout=None):
+        """ensure() for many thumbnail files: all of them are queued before any is waited on.
+
+        Returns the set of ``filenames`` that exist and are current once
+        they are done or ``timeout`` seconds have passed, whichever is first.
+        """
+        requests = {filename: self._request(filename) for filename in filenames}
+        wait([request[1] for request in requests.values() if request and request[1]], timeout=timeout)
+        ready = set()
+        for filename, request in requests.items():
+            if request is None:
+                continue
+            thumb_path, future = request
+            if future is None or (future.done() and not future.cancelled() and future.exception() is None
+                                  and future.result() and os.path.exists(thumb_path)):
+                ready.add(filename)
+        return ready
+
+    def _request(self, filename):
+        """(path, future) for a thumbnail file, the future None if it is already current; None if it cannot be made."""
+        if not filename.lower().endswith(THUMBNAIL_EXTENSIONS):
+            return None
+        thumb_path = safe_join(self.thumbnails_dir, filename)
+        if thumb_path is None:
+            return None
+        source = self.source_for(filename)
+        if source is None:
+            return None
+        if os.path.exists(thumb_path) and self.is_current(source):
+            return thumb_path, None
+        return thumb_path, self._submit(source)
+
+    def is_current(self, source):
+        """Whether the manifest says ``source``'s thumbnails were rendered from its current file with the current settings.
+
+        A file on disk alone proves nothing: it may predate a change to the
+        source or to the thumbnail settings.
+        """
+        try:
+            stat = os.stat(os.path.join(self.images_dir, source))
+        except OSError:
+            return False
+        key = (stat.st_size, stat.st_mtime, thumbnail_settings_hash())
+        with self._lock:
+            if self._current.get(source) == key:
+                self._current.move_to_end(source)
+                return True
+        with self.app.app_context():
+            row = db.session.get(ThumbnailManifest, source)
+        if row is None or (row.size, row.mtime, row.settings_hash) != key:
+            return False
+        self._remember(source, key)
+        return True
+
+    def _remember(self, source, key):
+        with self._lock:
+            self._current[source] = key
+            self._current.move_to_end(source)
+            if len(self._current) > self.memo_size:
+                self._current.popitem(last=False)
+
+    def _submit(self, source, executor=None):
+        """Queue generation for a source, or join the job already queued for it."""
+        with self._lock:
+            future = self._pending.get(source)
+            if future is None:
+                future = (executor or self._executor).submit(self._generate, source)
+                self._pending[source] = future
+        return future
+
+    def _generate(self, filename):
+        try:
+            source_path = safe_join(self.images_dir, filename)
+            if source_path is None or not os.path.isfile(source_path):
+                return False
+
+            stat = os.stat(source_path)
+            thumb_path = os.path.join(self.thumbnails_dir, filename)
+            started = time.perf_counter()
+            phash = generate_single_thumbnail((source_path, thumb_path, settings.get('thumbnails', 'width')))
+            if phash is None:
+                return False
+            record_job('thumbnail', time.perf_counter() - started, 1)
+            entry = manifest_entry(filename, stat.st_size, stat.st_mtime, phash=phash)
+            with self.app.app_context():
+                record_thumbnails([entry])
+            self._remember(filename, (entry['size'], entry['mtime'], entry['settings_hash']))
+            return True
+        finally:
+            with self._lock:
+                self._pending.pop(filename, None)
+
+    def queue(self, filenames):
+        """Start generating thumbnails for new originals without waiting for them."""
+        for filename in filenames:
+            self._submit(filename)
+
+    def prewarm(self, progress=None):
+        """Fill in stale and missing thumbnails one at a time on the low-priority thread.
+
+        ``progress(done, total)`` is called per source and may raise to stop.
+        """
+        with self.app.app_context():
+            pending, _ = find_stale_thumbnails(self.images_dir, self.thumbnails_dir)
+            hash_existing_thumbnails(self.thumbnails_dir, processes=1)
+        if not pending:
+            return
+        logger.info(f"Pre-warming {len(pending)} thumbnails in the background")
+
+        generated = 0
+        for done, filename in enumerate(pending, 1):
+            try:
+                if self._submit(filename, self._background).result():
+                    generated += 1
+            except Exception as e:
+                logger.error(f"Error pre-warming thumbnail {filename}: {str(e)}")
+            if progress:
+                progress(done, len(pending))
+        logger.info(f"Pre-warmed {generated} thumbnails")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._background.shutdown(wait=False, cancel_futures=True)
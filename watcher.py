@@ -0,0 +1,308 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import logging
+import threading
+from thumbnails import IMAGE_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) event bits
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of NUL-padded name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+WATCHED_SUFFIXES = ('.json',) + IMAGE_EXTENSIONS
+
+# Directory mtimes this close to the present may hide a second change in the same tick
+MTIME_SETTLE_NS = 2 * 10 ** 9
+
+def _libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+class InotifySource:
+    """New files in a set of directories from Linux inotify, via libc.
+
+    Reports files closed after writing or renamed into place, which is
+    when gallery-dl has finished with them (it downloads to ``.part``
+    and renames).
+    """
+
+    def __init__(self, directories):
+        libc = _libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        try:
+            for directory in directories:
+                wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+                if wd < 0:
+                    code = ctypes.get_errno()
+                    raise OSError(code, f"Cannot watch {directory}: {os.strerror(code)}")
+                self.directories[wd] = directory
+        except OSError:
+            self.close()
+            raise
+
+    def poll(self, timeout):
+        """Wait up to ``timeout`` seconds; returns ([(directory, name)], lost) where lost means events overflowed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return [], False
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return [], False
+
+        events, lost = [], False
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            name = data[start:start + length].rstrip(b'\0')
+            offset = start + length
+            if mask & IN_Q_OVERFLOW:
+                lost = True
+            elif name and wd in self.directories:
+                events.append((self.directories[wd], os.fsdecode(name)))
+        return events, lost
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class ScanSource:
+    """New files in a set of directories found by polling.
+
+    Each poll is one stat per directory; a directory is only listed when
+    its mtime moved, and the listing is diffed against the previous one.
+    Listing uses os.scandir without stat calls, and the poll interval
+    stretches so listing a huge directory takes at most a tenth of the
+    time.
+    """
+
+    def __init__(self, directories, interval):
+        self.interval = interval
+        self.mtimes = {}
+        self.listings = {}
+        self.next_scan = 0.0
+        # Seconds the slowest directory listing took, which sets the floor for the poll interval
+        self.cost = 0.0
+        for directory in directories:
+            self.mtimes[directory], self.listings[directory], elapsed = self._list(directory)
+            self.cost = max(self.cost, elapsed)
+
+    @staticmethod
+    def _list(directory):
+        started = time.perf_counter()
+        mtime = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            names = {entry.name for entry in entries if entry.name.lower().endswith(WATCHED_SUFFIXES)}
+        if time.time_ns() - mtime < MTIME_SETTLE_NS:
+            # List again next time in case the directory changes within the same mtime tick
+            mtime = None
+        return mtime, names, time.perf_counter() - started
+
+    def poll(self, timeout):
+        wait = min(timeout, self.next_scan - time.monotonic())
+        if wait > 0:
+            time.sleep(wait)
+            if time.monotonic() < self.next_scan:
+                return [], False
+
+        events = []
+        for directory, previous in self.listings.items():
+            try:
+                if os.stat(directory).st_mtime_ns == self.mtimes[directory]:
+                    continue
+                mtime, names, elapsed = self._list(directory)
+            except OSError as e:
+                logger.error(f"Error scanning {directory}: {str(e)}")
+                continue
+            events.extend((directory, name) for name in names - previous)
+            self.mtimes[directory], self.listings[directory] = mtime, names
+            self.cost = elapsed
+        self.next_scan = time.monotonic() + max(self.interval, self.cost * 10)
+        return events, False
+
+    def close(self):
+        pass
+
+class LibraryWatcher:
+    """Feeds new gallery-dl downloads into the library as they arrive.
+
+    Watches the JSON and image source directories with inotify where
+    available, otherwise with ScanSource. Each image is paired with its
+    ``<image>.json`` sidecar: a file waits up to ``pair_timeout`` seconds
+    for its other half, unless that is already on disk. Files are handed
+    on once events have been quiet for ``debounce`` seconds, or after
+    ``max_delay`` during a long burst, as
+    ``handle(json_files, image_files)`` calls of at most ``batch_size``
+    posts. ``resync()`` is called if inotify dropped events. A batch
+    whose ``handle`` call fails (say, the database stayed locked) goes
+    back to pending and is handed on again after another ``debounce``.
+    """
+
+    def __init__(self, app, json_dir, images_dir, handle, resync, backend='auto', interval=2.0,
+                 debounce=1.0, max_delay=5.0, pair_timeout=30.0, batch_size=100):
+        self.app = app
+        self.json_dir = os.path.realpath(json_dir)
+        self.images_dir = os.path.realpath(images_dir)
+        self.handle = handle
+        self.resync = resync
+        self.backend = backend
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pair_timeout = pair_timeout
+        self.batch_size = batch_size
+        # Pending posts by image filename: {'json': name, 'image': name, 'since': first seen}
+        self.pending = {}
+        self.last_event = 0.0
+        # Set while a resync is owed: inotify dropped events and the last resync() failed or has not run
+        self.lost = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _source(self):
+        directories = sorted({self.json_dir, self.images_dir})
+        if self.backend in ('auto', 'inotify'):
+            try:
+                source = InotifySource(directories)
+                logger.info(f"Watching {', '.join(directories)} with inotify")
+                return source
+            except OSError as e:
+                if self.backend == 'inotify':
+                    logger.warning(f"Cannot use inotify ({str(e)}), falling back to directory scans")
+        logger.info(f"Watching {', '.join(directories)} by directory scans every {self.interval}s")
+        return ScanSource(directories, self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='library-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        """Watch until stop() is called."""
+        source = self._source()
+        try:
+            while not self._stopping.is_set():
+                events, lost = source.poll(0.25 if self.pending else self.interval)
+                now = time.monotonic()
+                for directory, name in events:
+                    self._add(directory, name, now)
+                if lost:
+                    logger.warning("Watcher missed events, resyncing the library")
+                    self.lost = True
+                if self.lost and self._call(self.resync):
+                    self.lost = False
+                self._flush(now)
+        finally:
+            source.close()
+
+    def _flush(self, now):
+        """Hand on the batches that are due, putting any that fail back into pending."""
+        for json_files, image_files in self._ready(now):
+            logger.info(f"New downloads: {len(json_files)} JSON files, {len(image_files)} images")
+            if not self._call(self.handle, json_files, image_files):
+                self._retry(json_files, image_files, time.monotonic())
+
+    def _call(self, function, *args):
+        """Run ``function(*args)`` in an app context; returns False if it raised."""
+        try:
+            with self.app.app_context():
+                function(*args)
+            return True
+        except Exception as e:
+            logger.error(f"Error processing new downloads, will retry: {str(e)}")
+            return False
+
+    def _retry(self, json_files, image_files, now):
+        """Put a batch that failed back into pending."""
+        for name in json_files:
+            self._add(self.json_dir, name, now)
+        for name in image_files:
+            self._add(self.images_dir, name, now)
+
+    def _add(self, directory, name, now):
+        lower = name.lower()
+        if directory == self.json_dir and lower.endswith('.json'):
+            key, kind = name[:-len('.json')], 'json'
+        elif directory == self.images_dir and lower.endswith(IMAGE_EXTENSIONS):
+            key, kind = name, 'image'
+        else:
+            return
+        entry = self.pending.setdefault(key, {'json': None, 'image': None, 'since': now})
+        entry[kind] = name
+        self.last_event = now
+
+    def _paired(self, key, entry):
+        if entry['json'] and entry['image']:
+            return True
+        if entry['json']:
+            return os.path.exists(os.path.join(self.images_dir, key))
+        return os.path.exists(os.path.join(self.json_dir, key + '.json'))
+
+    def _settled(self, entry):
+        """Whether the entry's files have not been written to within ``debounce``; drops files that are gone."""
+        settled = True
+        for kind, directory in (('json', self.json_dir), ('image', self.images_dir)):
+            if entry[kind] is None:
+                continue
+            try:
+                mtime = os.stat(os.path.join(directory, entry[kind])).st_mtime
+            except OSError:
+                entry[kind] = None
+                continue
+            if time.time() - mtime < self.debounce:
+                settled = False
+        return settled
+
+    def _ready(self, now):
+        """Pop the pending posts that are due and return them as (json_files, image_files) batches."""
+        if not self.pending:
+            return []
+        quiet = now - self.last_event >= self.debounce
+        overdue = now - min(entry['since'] for entry in self.pending.values()) >= self.max_delay
+        if not (quiet or overdue or len(self.pending) >= self.batch_size):
+            return []
+
+        ready = []
+        for key, entry in list(self.pending.items()):
+            if not (self._paired(key, entry) or now - entry['since'] >= self.pair_timeout):
+                continue
+            settled = self._settled(entry)
+            if entry['json'] is None and entry['image'] is None:
+                # Removed or renamed away before it was processed
+                del self.pending[key]
+            elif settled:
+                ready.append(self.pending.pop(key))
+
+        return [
+            ([entry['json'] for entry in batch if entry['json']],
+             [entry['image'] for entry in batch if entry['image']])
+            for batch in (ready[i:i + self.batch_size] for i in range(0, len(ready), self.batch_size))
+        ]